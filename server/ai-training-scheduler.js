@@ -14,11 +14,18 @@ const cron = require('node-cron');
 const PYTHON_COMMAND = process.platform === 'win32' ? 'python' : 'python3';
 const SCRIPT_PATH = path.join(__dirname, 'generate_training_data.py');
 const TRAINING_DATA_PATH = path.join(__dirname, 'training_data.json');
+const TRAINING_STORE_META_PATH = path.join(__dirname, 'training_store', 'meta.json');
 const LOG_FILE = path.join(__dirname, 'training_data_generation.log');
 
-// Schedule: Run every day at 3:00 AM
+// Printed by generate_training_data.py when an incremental refresh found nothing to change
+const UNCHANGED_MESSAGE = 'Training store unchanged';
+
+// Schedule: Full rebuild every day at 3:00 AM
 const SCHEDULE = '0 3 * * *'; 
 
+// Schedule: Incremental refresh (only rows created since the last export) every 15 minutes
+const INCREMENTAL_SCHEDULE = '*/15 * * * *';
+
 // Function to append to log file
 function logMessage(message) {
   const timestamp = new Date().toISOString();
@@ -31,14 +38,23 @@ function logMessage(message) {
   fs.appendFileSync(LOG_FILE, logEntry);
 }
 
+// Only one generator run at a time - full and incremental runs write the same store
+let generationRunning = false;
+
 // Function to run the training data generator
-function generateTrainingData() {
-  logMessage('Starting training data generation process...');
+function generateTrainingData(incremental = false) {
+  if (generationRunning) {
+    logMessage(`Skipping ${incremental ? 'incremental' : 'full'} training data generation: previous run still in progress`);
+    return;
+  }
+  generationRunning = true;
+  logMessage(`Starting ${incremental ? 'incremental' : 'full'} training data generation process...`);
   
   // Check if Python is installed
   try {
     const checkPythonProcess = spawn(PYTHON_COMMAND, ['--version']);
     checkPythonProcess.on('error', (err) => {
+      generationRunning = false;
       logMessage(`Error checking Python: ${err.message}`);
       createEmptyTrainingData();
       return;
@@ -46,26 +62,28 @@ function generateTrainingData() {
     
     checkPythonProcess.on('close', (code) => {
       if (code !== 0) {
+        generationRunning = false;
         logMessage(`Python check failed with code ${code}`);
         createEmptyTrainingData();
         return;
       }
       
       // Python is available, run the generator
-      runPythonGenerator();
+      runPythonGenerator(incremental ? ['--incremental'] : []);
     });
   } catch (err) {
+    generationRunning = false;
     logMessage(`Exception checking Python: ${err.message}`);
     createEmptyTrainingData();
   }
 }
 
 // Run the actual Python generator
-function runPythonGenerator() {
+function runPythonGenerator(args = []) {
   // Add database environment variables from process.env
   const env = { ...process.env };
   
-  const pythonProcess = spawn(PYTHON_COMMAND, [SCRIPT_PATH], { env });
+  const pythonProcess = spawn(PYTHON_COMMAND, [SCRIPT_PATH, ...args], { env });
   
   let output = '';
   let errorOutput = '';
@@ -83,16 +101,24 @@ function runPythonGenerator() {
   });
   
   pythonProcess.on('close', (code) => {
+    generationRunning = false;
     if (code === 0) {
-      // Check if training data was generated
+      // The store was left as it was, so its meta.json still describes the previous run
+      if (output.includes(UNCHANGED_MESSAGE)) {
+        logMessage('Refresh: incremental (no transactions added or expired, training store unchanged)');
+        return;
+      }
+      // Check if the columnar training store was generated
       try {
-        const stats = fs.statSync(TRAINING_DATA_PATH);
-        const fileSizeKb = Math.round(stats.size / 1024);
-        logMessage(`Training data generated successfully (${fileSizeKb}KB)`);
-        
-        // Check data contents
-        const trainingData = JSON.parse(fs.readFileSync(TRAINING_DATA_PATH, 'utf8'));
-        logMessage(`Generated ${trainingData.length} training records`);
+        const meta = JSON.parse(fs.readFileSync(TRAINING_STORE_META_PATH, 'utf8'));
+        logMessage(`Training store generated successfully (${meta.categories.length} categories)`);
+        logMessage(`Generated ${meta.rows} training records`);
+        if (meta.refresh) {
+          logMessage(`Refresh: ${meta.refresh} (${meta.rows_added} added, ${meta.rows_expired} expired)`);
+        }
+        if (meta.rows_per_sec !== undefined) {
+          logMessage(`Export throughput: ${meta.rows_per_sec} rows/sec (${meta.export_seconds}s)`);
+        }
       } catch (error) {
         logMessage(`Error verifying training data: ${error.message}`);
         createEmptyTrainingData();
@@ -105,6 +131,7 @@ function runPythonGenerator() {
   });
   
   pythonProcess.on('error', (err) => {
+    generationRunning = false;
     logMessage(`Failed to start Python process: ${err.message}`);
     createEmptyTrainingData();
   });
@@ -127,8 +154,9 @@ logMessage('AI Training Data Scheduler started');
 generateTrainingData();
 
 // Schedule regular runs
-cron.schedule(SCHEDULE, generateTrainingData);
-logMessage(`Training data generation scheduled: ${SCHEDULE}`);
+cron.schedule(SCHEDULE, () => generateTrainingData(false));
+cron.schedule(INCREMENTAL_SCHEDULE, () => generateTrainingData(true));
+logMessage(`Training data generation scheduled: full ${SCHEDULE}, incremental ${INCREMENTAL_SCHEDULE}`);
 
 // Handle graceful shutdown
 process.on('SIGINT', () => {
@@ -1,132 +1,246 @@
 #!/usr/bin/env python3
 """
-Detailed Prophet AI analysis to understand what the prediction means
+CloudExpense Forecast Backtest
+==============================
+
+Rolling-origin backtest of the predictor over the training data. Every complete month
+in the data is replayed as of each of its days. The request holds the month's
+expenses up to that day, the training history is everything before the month, and
+the run_prediction totals are compared against what was actually spent by month end.
+
+Each engine in --engines is replayed separately:
+
+  auto     predict_category as deployed (Prophet or NumPy per series)
+  prophet  Prophet forced for every series
+  numpy    the NumPy least-squares engine forced
+  batch    the batched multi-series engine forced
+  math     the math projection alone (the fallback baseline)
+
+The work is split into one job per (engine, month), and jobs run in parallel across
+--workers processes. Within a job the days run in order, so the folds of a month
+share fitted models. Fitted Prophet models go to a shared on-disk store keyed by
+series content, which every job and engine reuses. Refits of a series warm-start
+from its fit of the previous day.
+
+The report has accuracy (MAE, weighted MAPE, bias, per month phase) next to cost
+(forecast time per category and per fold) for each engine. With those, the
+speed/accuracy trade-off can be tuned from data.
+
+Usage:
+  python analyze_prophet.py [--engines auto,math,numpy,batch] [--day-step 1]
+                            [--months 3] [--workers 0] [--output backtest.json]
 """
 
+import os
 import sys
 import json
-import pandas as pd
+import time
+import shutil
+import argparse
+import tempfile
+import statistics
+from datetime import date, timedelta
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
 import numpy as np
-from datetime import datetime, timedelta
-
-print("🔍 Analyzing Prophet AI Prediction Details...")
-print("=" * 60)
-
-# Sample data (same as before)
-sample_data = [
-    {"date": "2024-01-15", "amount": 50.0, "category": "Food"},
-    {"date": "2024-01-20", "amount": 75.0, "category": "Food"},
-    {"date": "2024-02-10", "amount": 60.0, "category": "Food"},
-    {"date": "2024-02-25", "amount": 80.0, "category": "Food"},
-    {"date": "2024-03-05", "amount": 45.0, "category": "Food"},
-    {"date": "2024-03-15", "amount": 65.0, "category": "Food"},
-    {"date": "2024-04-01", "amount": 70.0, "category": "Food"},
-    {"date": "2024-04-10", "amount": 55.0, "category": "Food"},
-    {"date": "2024-05-05", "amount": 85.0, "category": "Food"},
-    {"date": "2024-05-20", "amount": 90.0, "category": "Food"}
-]
-
-print("📊 Input Data Analysis:")
-df = pd.DataFrame(sample_data)
-df['date'] = pd.to_datetime(df['date'])
-print(f"   • Total transactions: {len(sample_data)}")
-print(f"   • Date range: {df['date'].min().strftime('%Y-%m-%d')} to {df['date'].max().strftime('%Y-%m-%d')}")
-print(f"   • Amount range: ${df['amount'].min():.2f} - ${df['amount'].max():.2f}")
-print(f"   • Average per transaction: ${df['amount'].mean():.2f}")
-
-# Calculate monthly totals to understand the pattern
-df['month'] = df['date'].dt.to_period('M')
-monthly_totals = df.groupby('month')['amount'].sum()
-monthly_counts = df.groupby('month')['amount'].count()
-
-print(f"\n📅 Monthly Spending Pattern:")
-for month, total in monthly_totals.items():
-    count = monthly_counts[month]
-    avg = total / count
-    print(f"   • {month}: ${total:.2f} total ({count} transactions, ${avg:.2f} avg)")
-
-try:
-    from prophet import Prophet
-    import logging
-    logging.getLogger('prophet').setLevel(logging.WARNING)
-    
-    print(f"\n🔮 Prophet AI Analysis:")
-    
-    # Prepare data for Prophet (daily aggregation)
-    # Prophet expects daily data, so let's aggregate by day
-    daily_df = df.groupby(df['date'].dt.date)['amount'].sum().reset_index()
-    daily_df.columns = ['ds', 'y']
-    daily_df['ds'] = pd.to_datetime(daily_df['ds'])
-    
-    print(f"   • Prophet input: {len(daily_df)} daily data points")
-    print(f"   • Daily amounts range: ${daily_df['y'].min():.2f} - ${daily_df['y'].max():.2f}")
-    
-    # Create Prophet model
-    model = Prophet(
-        yearly_seasonality=True,
-        weekly_seasonality=False,
-        daily_seasonality=False,
-        changepoint_prior_scale=0.05
+
+import cloud_predictor
+import forecast_engines
+from forecast_engines import ProphetEngine
+from instrumentation import configure_logging
+from model_store import FittedModelStore, WarmStartStore
+from training_store import TrainingColumns
+
+ENGINES = ['auto', 'prophet', 'numpy', 'batch', 'math']
+
+# Day-of-month ranges reported separately: forecasts get easier as the month fills in
+MONTH_PHASES = (('early', 1, 10), ('mid', 11, 20), ('late', 21, 31))
+
+# Training data shared by the jobs of one worker process (see init_backtest_worker)
+_columns = None
+
+def month_bounds(day):
+    """(first, last) day ordinals of the month containing a day ordinal"""
+    first = date.fromordinal(day).replace(day=1)
+    last = (first + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+    return first.toordinal(), last.toordinal()
+
+def complete_months(columns, min_history_days=28):
+    """First days of the months fully covered by the data, after at least min_history_days of history"""
+    if not len(columns):
+        return []
+    first_day, last_day = int(columns.days.min()), int(columns.days.max())
+    months = []
+    month_start, month_end = month_bounds(first_day + min_history_days)
+    while month_end <= last_day:
+        months.append(month_start)
+        month_start, month_end = month_bounds(month_end + 1)
+    return months
+
+def subset(columns, mask):
+    """TrainingColumns of the selected rows, keeping only the categories that appear in them"""
+    codes = columns.codes[mask]
+    present = np.unique(codes)
+    remap = np.zeros(len(columns.categories), dtype=np.int32)
+    remap[present] = np.arange(len(present), dtype=np.int32)
+    return TrainingColumns([columns.categories[code] for code in present], remap[codes],
+                           columns.days[mask], columns.amounts[mask])
+
+def init_backtest_worker(store_dir, log_level):
+    """Load the training data once per worker and point the Prophet engine at the shared store"""
+    global _columns
+    configure_logging(log_level)
+    _columns = cloud_predictor.load_training_data()
+    # Fits go to the backtest's own stores, never the production model cache
+    cloud_predictor.model_store = FittedModelStore(os.path.join(store_dir, 'models'), max_entries=256)
+    cloud_predictor.ENGINES['prophet'] = ProphetEngine(
+        cloud_predictor.model_store, WarmStartStore(os.path.join(store_dir, 'warm_start'))
     )
-    
-    model.fit(daily_df)
-    
-    # Make predictions for different periods
-    print(f"\n📈 Prophet Predictions:")
-    
-    # 1. Next single day
-    future_1day = model.make_future_dataframe(periods=1)
-    forecast_1day = model.predict(future_1day)
-    next_day_pred = forecast_1day['yhat'].iloc[-1]
-    print(f"   • Next day prediction: ${next_day_pred:.2f}")
-    
-    # 2. Next 7 days
-    future_7days = model.make_future_dataframe(periods=7)
-    forecast_7days = model.predict(future_7days)
-    next_week_pred = forecast_7days['yhat'].iloc[-7:].sum()
-    print(f"   • Next 7 days total: ${next_week_pred:.2f}")
-    
-    # 3. Next 30 days (what our original test showed)
-    future_30days = model.make_future_dataframe(periods=30)
-    forecast_30days = model.predict(future_30days)
-    next_30days_total = forecast_30days['yhat'].iloc[-30:].sum()
-    last_day_30 = forecast_30days['yhat'].iloc[-1]
-    
-    print(f"   • Next 30 days total: ${next_30days_total:.2f}")
-    print(f"   • Day 30 single prediction: ${last_day_30:.2f} (this was our $928!)")
-    
-    # 4. Show what Prophet thinks is happening
-    print(f"\n🤔 What Prophet Thinks is Happening:")
-    print(f"   • Prophet sees your spending pattern increasing over time")
-    print(f"   • It's predicting that by day 30, you'll spend ${last_day_30:.2f} in a SINGLE DAY")
-    print(f"   • This is because Prophet detected an upward trend from your data")
-    
-    # Let's check the trend
-    recent_avg = daily_df['y'].tail(3).mean()
-    early_avg = daily_df['y'].head(3).mean()
-    print(f"   • Early period avg: ${early_avg:.2f}/day")
-    print(f"   • Recent period avg: ${recent_avg:.2f}/day")
-    print(f"   • Prophet extrapolated this trend to ${last_day_30:.2f}/day by month-end")
-    
-    print(f"\n⚡ Reality Check:")
-    print(f"   • Your historical monthly spending: ${monthly_totals.mean():.2f}")
-    print(f"   • Prophet's 30-day prediction: ${next_30days_total:.2f}")
-    print(f"   • Difference: {((next_30days_total / monthly_totals.mean()) - 1) * 100:.1f}% higher!")
-    
-    print(f"\n💡 Analysis:")
-    if next_30days_total > monthly_totals.mean() * 3:
-        print(f"   ❌ Prophet prediction seems TOO HIGH (3x+ your normal spending)")
-        print(f"   📊 Mathematical fallback (${df['amount'].mean():.2f}/transaction) is more realistic")
-        print(f"   🔧 We should use different Prophet parameters or more data")
-    else:
-        print(f"   ✅ Prophet prediction seems reasonable")
-        print(f"   📈 Shows upward trend in your spending pattern")
-    
-except Exception as e:
-    print(f"❌ Prophet analysis failed: {e}")
-
-print(f"\n🎯 Conclusion:")
-print(f"   • The $928 was Prophet predicting you'd spend $928 on a SINGLE DAY (day 30)")
-print(f"   • This seems unrealistic based on your $50-90 transaction history")
-print(f"   • Mathematical fallback ($72/transaction) is more sensible")
-print(f"   • Prophet needs better tuning or more data for realistic predictions")
+
+def math_prediction(request):
+    """The math projection alone for every category, in run_prediction's output shape"""
+    reference_day = int(request.days.max())
+    remaining_days = month_bounds(reference_day)[1] - reference_day
+    predictions = {}
+    for category in request.categories:
+        total = cloud_predictor.math_projection(request.history(category), category, remaining_days)
+        predictions[category] = round(total, 2)
+    return predictions, {'categories': {category: {'method': 'math'} for category in predictions}}
+
+def backtest_month(engine, month_start, day_step):
+    """Replay one month day by day with one engine; returns one record per (day, category)"""
+    columns = _columns
+    month_end = month_bounds(month_start)[1]
+    training = subset(columns, columns.days < month_start)
+    in_month = (columns.days >= month_start) & (columns.days <= month_end)
+    actual = np.bincount(columns.codes[in_month], weights=columns.amounts[in_month], minlength=len(columns.categories))
+    forecast_engines.PREDICTOR_ENGINE = 'auto' if engine == 'math' else engine
+
+    records = []
+    for as_of in range(month_start, month_end, day_step):
+        request = subset(columns, in_month & (columns.days <= as_of))
+        if not len(request):
+            continue
+        started = time.perf_counter()
+        if engine == 'math':
+            predictions, meta = math_prediction(request)
+        else:
+            # A per-month series id keeps warm starts within the month being replayed
+            month_id = date.fromordinal(month_start).strftime('%Y-%m')
+            predictions, meta = cloud_predictor.run_prediction(request, training, 1, f"backtest-{month_id}")
+        fold_ms = (time.perf_counter() - started) * 1000
+        for category, predicted in predictions.items():
+            records.append({
+                'month': date.fromordinal(month_start).strftime('%Y-%m'),
+                'day': as_of - month_start + 1,
+                'category': category,
+                'predicted': predicted,
+                'actual': round(float(actual[columns.category_index[category]]), 2),
+                'method': meta['categories'][category]['method'],
+                'ms': fold_ms / len(predictions),
+            })
+    return engine, month_start, records
+
+def accuracy(records):
+    """MAE, weighted MAPE and bias of a set of (predicted, actual) records"""
+    if not records:
+        return {'forecasts': 0}
+    errors = np.array([r['predicted'] - r['actual'] for r in records])
+    actual_total = sum(abs(r['actual']) for r in records)
+    return {
+        'forecasts': len(records),
+        'mae': round(float(np.mean(np.abs(errors))), 2),
+        'wmape': round(float(np.sum(np.abs(errors)) / actual_total), 4) if actual_total else None,
+        'bias': round(float(np.mean(errors)), 2),
+    }
+
+def summarize(records, job_seconds):
+    """Accuracy overall and per month phase, plus what the forecasts cost"""
+    report = accuracy(records)
+    report['by_phase'] = {
+        phase: accuracy([r for r in records if first <= r['day'] <= last])
+        for phase, first, last in MONTH_PHASES
+    }
+    methods = {}
+    for r in records:
+        methods[r['method']] = methods.get(r['method'], 0) + 1
+    report['methods'] = methods
+    report['cost'] = {
+        'seconds': round(sum(job_seconds), 2),
+        'ms_per_forecast': round(statistics.mean(r['ms'] for r in records), 2) if records else None,
+        'ms_per_forecast_p95': round(float(np.percentile([r['ms'] for r in records], 95)), 2) if records else None,
+    }
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description='Rolling-origin backtest of the predictor engines')
+    parser.add_argument('--engines', default='auto,math,numpy,batch',
+                        help=f"Comma-separated engines to replay ({', '.join(ENGINES)})")
+    parser.add_argument('--day-step', type=int, default=1, help='Replay every Nth day of each month')
+    parser.add_argument('--months', type=int, default=0, help='Only replay the last N complete months (0 = all)')
+    parser.add_argument('--workers', type=int, default=0, help='Worker processes (0 = one per CPU core)')
+    parser.add_argument('--output', help='Also write the report to this JSON file')
+    parser.add_argument('--folds-output', help='Write every (engine, month, day, category) forecast to this NDJSON file')
+    parser.add_argument('--log-level', default='error', help='Predictor log level inside the workers')
+    args = parser.parse_args()
+
+    engines = [engine for engine in args.engines.split(',') if engine]
+    unknown = [engine for engine in engines if engine not in ENGINES]
+    if unknown:
+        parser.error(f"Unknown engines: {', '.join(unknown)}")
+
+    configure_logging(args.log_level)
+    columns = cloud_predictor.load_training_data()
+    months = complete_months(columns)
+    if args.months > 0:
+        months = months[-args.months:]
+    if not months:
+        print("❌ No complete month with history before it in the training data", file=sys.stderr)
+        sys.exit(1)
+    workers = args.workers if args.workers > 0 else (os.cpu_count() or 1)
+    jobs = [(engine, month) for engine in engines for month in months]
+    print(f"🔁 Backtesting {len(engines)} engines over {len(months)} months "
+          f"({len(jobs)} jobs, every {args.day_step} day(s)) on {workers} workers", file=sys.stderr)
+
+    store_dir = tempfile.mkdtemp(prefix='cloudexpense-backtest-')
+    results = {engine: [] for engine in engines}
+    job_seconds = {engine: [] for engine in engines}
+    started = time.perf_counter()
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_backtest_worker,
+                                 initargs=(store_dir, args.log_level)) as executor:
+            futures = [executor.submit(backtest_month, engine, month, args.day_step) for engine, month in jobs]
+            for future in as_completed(futures):
+                engine, month, records = future.result()
+                results[engine].extend(records)
+                # Jobs run concurrently, so the cost is the job's own forecast time rather than wall time
+                job_seconds[engine].append(sum(r['ms'] for r in records) / 1000)
+                print(f"  ✅ {engine} {date.fromordinal(month).strftime('%Y-%m')}: {len(records)} forecasts", file=sys.stderr)
+    finally:
+        shutil.rmtree(store_dir, ignore_errors=True)
+
+    report = {
+        'months': [date.fromordinal(month).strftime('%Y-%m') for month in months],
+        'day_step': args.day_step,
+        'workers': workers,
+        'wall_seconds': round(time.perf_counter() - started, 2),
+        'engines': {engine: summarize(results[engine], job_seconds[engine]) for engine in engines},
+    }
+
+    print("\n📊 Backtest summary (wMAPE = sum |error| / sum actual):", file=sys.stderr)
+    for engine, summary in report['engines'].items():
+        print(f"  • {engine:8s} wMAPE {summary.get('wmape')}  MAE ${summary.get('mae')}  bias ${summary.get('bias')}  "
+              f"{summary['cost']['ms_per_forecast']} ms/forecast", file=sys.stderr)
+
+    if args.folds_output:
+        with open(args.folds_output, 'w') as f:
+            for engine in engines:
+                for record in results[engine]:
+                    f.write(json.dumps(dict(record, engine=engine)) + '\n')
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,25 @@
+"""
+Atomic file writes for the predictor's on-disk stores
+=====================================================
+
+The model store, warm-start store, result cache and holiday cache are shared by every
+predictor process. Their files are written to a temporary file next to the target
+and renamed over it, so concurrent readers see the old contents or the new ones,
+never a partial file.
+"""
+
+import os
+
+def atomic_write(path, text):
+    """Replace path with text in one rename; the temporary file is removed if writing fails"""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'w') as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+CloudExpense Predictor Latency Benchmark
+========================================
+
+Compares per-request latency of the spawn-per-request path used by routes/predict.js
+(one `python3 cloud_predictor.py` process per prediction) against a long-lived
+`cloud_predictor.py --serve` worker answering newline-delimited JSON requests.
+
+Usage:
+  python benchmark_predictor.py [--requests 20] [--input request.json]
+
+The default request is the latest month found in training_data.json.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+import statistics
+
+PREDICTOR_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cloud_predictor.py')
+
+def build_sample_request(training_file='training_data.json'):
+    """Use the most recent month of training data as a realistic request payload"""
+    with open(training_file, 'r') as f:
+        records = json.load(f)
+    if not records:
+        raise ValueError(f"{training_file} is empty - pass --input with a request payload")
+    latest_month = max(record['date'][:7] for record in records)
+    return [record for record in records if record['date'][:7] == latest_month]
+
+def summarize(latencies):
+    """Summarize a list of latencies in seconds as milliseconds"""
+    ordered = sorted(latencies)
+    p95_index = max(0, int(round(len(ordered) * 0.95)) - 1)
+    return {
+        'requests': len(ordered),
+        'mean_ms': round(statistics.mean(ordered) * 1000, 1),
+        'p50_ms': round(statistics.median(ordered) * 1000, 1),
+        'p95_ms': round(ordered[p95_index] * 1000, 1),
+        'max_ms': round(ordered[-1] * 1000, 1),
+    }
+
+def bench_spawn(payload, requests):
+    """Time one fresh predictor process per request"""
+    latencies = []
+    results = None
+    for _ in range(requests):
+        started = time.perf_counter()
+        completed = subprocess.run(
+            [sys.executable, PREDICTOR_SCRIPT],
+            input=payload,
+            capture_output=True,
+            text=True,
+            check=True
+        )
+        latencies.append(time.perf_counter() - started)
+        results = completed.stdout.strip()
+    return latencies, results
+
+def bench_worker(payload, requests):
+    """Time requests answered by a single long-lived --serve worker"""
+    worker = subprocess.Popen(
+        [sys.executable, PREDICTOR_SCRIPT, '--serve'],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        text=True,
+        bufsize=1
+    )
+    latencies = []
+    results = None
+    try:
+        # The first request is excluded: worker start-up is paid once, not per request
+        worker.stdin.write(payload + '\n')
+        worker.stdin.flush()
+        worker.stdout.readline()
+
+        for _ in range(requests):
+            started = time.perf_counter()
+            worker.stdin.write(payload + '\n')
+            worker.stdin.flush()
+            results = worker.stdout.readline().strip()
+            latencies.append(time.perf_counter() - started)
+    finally:
+        worker.stdin.close()
+        worker.wait(timeout=30)
+    return latencies, results
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark predictor spawn vs worker latency')
+    parser.add_argument('--requests', type=int, default=20, help='Requests to time per mode')
+    parser.add_argument('--input', metavar='FILE', help='JSON request payload (list of expense records)')
+    args = parser.parse_args()
+
+    if args.input:
+        with open(args.input, 'r') as f:
+            records = json.load(f)
+    else:
+        records = build_sample_request()
+    payload = json.dumps(records)
+
+    print(f"Benchmarking {args.requests} requests with {len(records)} expense records each")
+
+    spawn_latencies, spawn_output = bench_spawn(payload, args.requests)
+    worker_latencies, worker_output = bench_worker(payload, args.requests)
+
+    report = {
+        'spawn_per_request': summarize(spawn_latencies),
+        'persistent_worker': summarize(worker_latencies),
+        'outputs_match': spawn_output == worker_output,
+    }
+    report['p50_speedup'] = round(report['spawn_per_request']['p50_ms'] / max(report['persistent_worker']['p50_ms'], 0.001), 1)
+
+    print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
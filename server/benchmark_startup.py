@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+CloudExpense Predictor Cold-Start Report
+========================================
+
+Runs cloud_predictor.py under `python -X importtime` and reports where start-up time
+goes, so cold-start regressions show up in CI or next to the latency benchmark.
+
+Two runs are measured:
+  import    `import cloud_predictor` alone
+  fallback  a full request that only needs the math projection (one expense per
+            category), which should never load pandas or Prophet
+
+Usage:
+  python benchmark_startup.py [--top 15] [--max-import-ms 500]
+
+With --max-import-ms the script exits with status 1 when importing cloud_predictor
+takes longer than that, for use as a regression check.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+SERVER_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Modules that should only be loaded once a Prophet fit is actually needed
+HEAVY_MODULES = ['pandas', 'prophet', 'cmdstanpy', 'matplotlib', 'holidays']
+
+# One expense per category in categories with no training history: every category takes
+# the math projection
+FALLBACK_REQUEST = [
+    {'date': '2025-07-03', 'category': 'Startup Check A', 'amount': 12.5},
+    {'date': '2025-07-04', 'category': 'Startup Check B', 'amount': 5.0},
+]
+
+def parse_importtime(stderr):
+    """{module: (self_us, cumulative_us)} from -X importtime output"""
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        modules[name.strip()] = (int(self_us), int(cumulative_us))
+    return modules
+
+def top_level_ms(stderr):
+    """Total import time: the cumulative time of every top-level (unindented) import"""
+    total_us = 0
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        name = line.split('|')[2]
+        if name.startswith(' ') and not name.startswith('  '):
+            total_us += int(line.split('|')[1])
+    return total_us / 1000
+
+def measure(args, stdin=None):
+    """Run the predictor with -X importtime and summarize what it imported"""
+    started = time.perf_counter()
+    completed = subprocess.run(
+        [sys.executable, '-X', 'importtime'] + args,
+        input=stdin,
+        capture_output=True,
+        text=True,
+        cwd=SERVER_DIR
+    )
+    wall_ms = (time.perf_counter() - started) * 1000
+    modules = parse_importtime(completed.stderr)
+    return {
+        'wall_ms': round(wall_ms, 1),
+        'import_ms': round(top_level_ms(completed.stderr), 1),
+        'modules': len(modules),
+        'heavy_modules_loaded': [name for name in HEAVY_MODULES if name in modules],
+        'stdout': completed.stdout.strip(),
+    }, modules
+
+def main():
+    parser = argparse.ArgumentParser(description='Report cloud_predictor.py import and cold-start time')
+    parser.add_argument('--top', type=int, default=15, help='Slowest modules (by cumulative time) to list')
+    parser.add_argument('--max-import-ms', type=float, default=None,
+                        help='Exit with status 1 if importing cloud_predictor takes longer than this')
+    args = parser.parse_args()
+
+    import_run, modules = measure(['-c', 'import cloud_predictor'])
+    fallback_run, _ = measure(['cloud_predictor.py'], stdin=json.dumps(FALLBACK_REQUEST))
+
+    slowest = sorted(modules.items(), key=lambda item: item[1][1], reverse=True)[:args.top]
+    import_run.pop('stdout')
+    report = {
+        'import': import_run,
+        'fallback_request': fallback_run,
+        'slowest_imports_ms': {name: round(cumulative / 1000, 1) for name, (_, cumulative) in slowest},
+    }
+    print(json.dumps(report, indent=2))
+
+    if args.max_import_ms is not None and import_run['import_ms'] > args.max_import_ms:
+        print(f"Import time {import_run['import_ms']}ms exceeds {args.max_import_ms}ms", file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,512 @@
+#!/usr/bin/env python3
+"""
+CloudExpense Predictor Benchmark Suite
+======================================
+
+Reproducible timings of the predictor pipeline on synthetic transactions, written to a
+JSON file that can be compared between commits.
+
+For every combination of --rows and --categories a seeded synthetic dataset with the
+{date, category, amount} schema (plus user ids and timestamps for the database fixture)
+is generated and these benchmarks are run against it:
+
+  load_training_data  cloud_predictor.load_training_data() from training_data.json and
+                      from the columnar store
+  predict_category    one cold forecast per category for each engine in --engines, on
+                      the --fit-categories largest categories (after an untimed warm-up
+                      run, so importing Prophet is not counted), on the full history and
+                      on the history_selection.py selection of it (selection time included)
+  fit_many            every (user, category) series forecast by one BatchEngine.fit_many
+                      pass, against the projected time of fitting each one with Prophet
+                      (measured on --prophet-sample series)
+  main                end-to-end `python cloud_predictor.py` for one user's latest month,
+                      cold (no fitted models), again with the fitted model store warm
+                      (over JSON and over --wire msgpack), and answered from the
+                      prediction result cache
+  generate            `python generate_training_data.py` against a SQLite fixture of the
+                      transactions table (DB_DRIVER=sqlite), standing in for PostgreSQL:
+                      one sequential query, then --export-workers connections fetching
+                      month and user_id partitions (checked to write the same store)
+
+Times are medians over --repeats runs, in milliseconds. Everything runs in a temporary
+directory, so existing training data and caches are never touched.
+
+Usage:
+  python benchmark_suite.py [--rows 1000,100000,1000000] [--categories 8,32]
+                            [--engines numpy,batch,prophet] [--skip main,generate]
+                            [--output benchmark_results.json] [--compare OLD.json]
+  python benchmark_suite.py --compare OLD.json --against NEW.json
+
+--compare prints every timing next to the same timing in an earlier results file.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import sqlite3
+import argparse
+import platform
+import tempfile
+import warnings
+import subprocess
+import statistics
+from datetime import datetime, date, timedelta
+
+import numpy as np
+
+import cloud_predictor
+import forecast_engines
+from forecast_engines import BatchEngine, NumpyEngine, ProphetEngine, prepare_series
+from history_selection import select_history
+from instrumentation import TRACE_PREFIX, configure_logging
+from model_store import FittedModelStore
+from training_store import History, JsonExportWriter, TrainingColumns, write_training_store
+from wire import FRAME_HEADER, decode_response, encode_request
+warnings.filterwarnings('ignore')
+
+SERVER_DIR = os.path.dirname(os.path.abspath(__file__))
+BENCHMARKS = ['load_training_data', 'predict_category', 'fit_many', 'main', 'generate']
+
+# Real category names first, then numbered ones for larger category counts
+CATEGORY_NAMES = ['Food', 'Shopping', 'Bills', 'Transport', 'Education', 'Entertainment', 'Health', 'Others']
+
+def parse_list(value, cast=str):
+    return [cast(item) for item in value.split(',') if item.strip()]
+
+def median_ms(times):
+    return round(statistics.median(times) * 1000, 2)
+
+def synthetic_transactions(rows, categories, months=6, users=50, seed=42):
+    """Seeded synthetic expenses over the last `months` months, in date order
+
+    Category popularity falls off like a Zipf distribution and amounts are log-normal
+    around a per-category typical amount, so a few categories dominate as in real data.
+    """
+    rng = np.random.default_rng(seed)
+    names = CATEGORY_NAMES[:categories] + [f"Category {i + 1}" for i in range(len(CATEGORY_NAMES), categories)]
+    weights = 1.0 / np.arange(1, categories + 1)
+
+    # End yesterday so no row is later than the generator's "now"
+    last_day = date.today().toordinal() - 1
+    first_day = last_day - months * 30 + 1
+    days = np.sort(rng.integers(first_day, last_day + 1, size=rows)).astype(np.int32)
+    codes = rng.choice(categories, size=rows, p=weights / weights.sum()).astype(np.int32)
+    typical = rng.uniform(5, 120, size=categories)
+    amounts = np.round(typical[codes] * rng.lognormal(0, 0.6, size=rows), 2)
+    return {
+        'categories': names,
+        'codes': codes,
+        'days': days,
+        'amounts': amounts,
+        'user_ids': rng.integers(1, users + 1, size=rows).astype(np.int64),
+        'seconds': rng.integers(0, 86400, size=rows),
+    }
+
+def write_json(path, data):
+    """training_data.json in the generator's legacy layout"""
+    writer = JsonExportWriter(path)
+    writer.append([data['categories'][code] for code in data['codes']], data['days'], data['amounts'])
+    return writer.close()
+
+def write_sqlite_fixture(path, data, chunk_size=50000):
+    """SQLite transactions table with the columns generate_training_data.py queries"""
+    conn = sqlite3.connect(path)
+    conn.execute("""
+        CREATE TABLE transactions (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER,
+            category TEXT,
+            amount REAL,
+            transaction_type TEXT,
+            created_at TIMESTAMP
+        )
+    """)
+    conn.execute("CREATE INDEX transactions_created_at ON transactions (created_at, id)")
+
+    def rows():
+        for i in range(len(data['days'])):
+            created_at = datetime.fromordinal(int(data['days'][i])) + timedelta(seconds=int(data['seconds'][i]))
+            # Every 20th row is income, which the export has to filter out
+            yield (
+                i + 1,
+                int(data['user_ids'][i]),
+                data['categories'][data['codes'][i]],
+                float(data['amounts'][i]),
+                'income' if i % 20 == 19 else 'expense',
+                created_at.strftime('%Y-%m-%d %H:%M:%S')
+            )
+
+    generator = rows()
+    while True:
+        chunk = [row for _, row in zip(range(chunk_size), generator)]
+        if not chunk:
+            break
+        conn.executemany("INSERT INTO transactions VALUES (?, ?, ?, ?, ?, ?)", chunk)
+    conn.commit()
+    conn.close()
+
+def build_request(data):
+    """The busiest user's expenses in the latest month of the dataset, as a predictor request"""
+    month_start = date.fromordinal(int(data['days'][-1])).replace(day=1).toordinal()
+    in_month = data['days'] >= month_start
+    user_id = np.bincount(data['user_ids'][in_month]).argmax()
+    mask = in_month & (data['user_ids'] == user_id)
+    return [
+        {
+            'date': date.fromordinal(int(day)).isoformat(),
+            'category': data['categories'][code],
+            'amount': float(amount)
+        }
+        for day, code, amount in zip(data['days'][mask], data['codes'][mask], data['amounts'][mask])
+    ]
+
+def bench_load(workdir, data, repeats):
+    """cloud_predictor.load_training_data() from training_data.json and from the columnar store"""
+    json_dir = os.path.join(workdir, 'json')
+    os.makedirs(json_dir)
+    write_json(os.path.join(json_dir, cloud_predictor.TRAINING_DATA_FILE), data)
+
+    results = {}
+    for name, path in (('json', json_dir), ('columnar', os.path.join(workdir, 'columnar'))):
+        os.chdir(path)
+        times = []
+        for _ in range(repeats):
+            started = time.perf_counter()
+            columns = cloud_predictor.load_training_data()
+            times.append(time.perf_counter() - started)
+        results[name] = {'median_ms': median_ms(times), 'rows': len(columns)}
+    return results
+
+def bench_predict(workdir, engines, fit_categories, repeats):
+    """Cold predict_category per engine on the largest categories of the columnar store"""
+    columns = TrainingColumns.open(os.path.join(workdir, 'columnar', cloud_predictor.TRAINING_STORE_DIR))
+    counts = np.diff(columns.offsets)
+    largest = [columns.categories[code] for code in np.argsort(-counts, kind='stable')[:fit_categories]]
+
+    last_day = int(columns.days.max())
+    reference_date = datetime.fromordinal(last_day)
+    month_start = reference_date.replace(day=1).toordinal()
+    month_end = (reference_date.replace(day=1) + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+    remaining_days = (month_end - reference_date).days
+
+    cache_dir = os.path.join(workdir, 'predict_model_cache')
+    saved_engine, saved_engines = forecast_engines.PREDICTOR_ENGINE, dict(cloud_predictor.ENGINES)
+    results = {}
+    try:
+        for engine in engines:
+            forecast_engines.PREDICTOR_ENGINE = engine
+            per_category = {}
+            for category in largest:
+                history = columns.history(category)
+                current = History(history.days[history.days >= month_start], history.amounts[history.days >= month_start])
+                times, selected_times = [], []
+                # One untimed run first so one-off costs (importing Prophet) are not counted
+                for repeat in range(repeats + 1):
+                    for select, timings in ((False, times), (True, selected_times)):
+                        # A fresh model store and no warm start: every repeat is a cold fit
+                        cloud_predictor.ENGINES['prophet'] = ProphetEngine(FittedModelStore(cache_dir), None)
+                        cloud_predictor.ENGINES['numpy'] = NumpyEngine()
+                        cloud_predictor.ENGINES['batch'] = BatchEngine()
+                        started = time.perf_counter()
+                        fitted = select_history(history, last_day) if select else history
+                        forecast = cloud_predictor.predict_category(current, fitted, category, remaining_days, reference_date)
+                        if repeat:
+                            timings.append(time.perf_counter() - started)
+                        shutil.rmtree(cache_dir, ignore_errors=True)
+                per_category[category] = {
+                    'median_ms': median_ms(times),
+                    'points': len(history.days),
+                    'method': forecast.method,
+                    'selected': {'median_ms': median_ms(selected_times), 'rows': len(fitted.days)},
+                }
+            results[engine] = {
+                'total_ms': round(sum(r['median_ms'] for r in per_category.values()), 2),
+                'selected_total_ms': round(sum(r['selected']['median_ms'] for r in per_category.values()), 2),
+                'categories': per_category,
+            }
+    finally:
+        forecast_engines.PREDICTOR_ENGINE = saved_engine
+        cloud_predictor.ENGINES.update(saved_engines)
+    return results
+
+def user_category_series(data):
+    """(series_id, daily History, future dates) for every (user, category) in the dataset"""
+    last_day = int(data['days'][-1])
+    reference_date = datetime.fromordinal(last_day)
+    month_end = (reference_date.replace(day=1) + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+    future_dates = [reference_date + timedelta(days=i) for i in range(1, max((month_end - reference_date).days, 1) + 1)]
+
+    order = np.lexsort((data['days'], data['codes'], data['user_ids']))
+    keys = data['user_ids'][order] * len(data['categories']) + data['codes'][order]
+    bounds = np.flatnonzero(np.diff(keys)) + 1
+    series = []
+    for rows in np.split(order, bounds):
+        history = prepare_series(History(data['days'][rows], data['amounts'][rows]))
+        if len(history.days) >= 2:
+            series_id = f"{data['user_ids'][rows[0]]}/{data['categories'][data['codes'][rows[0]]]}"
+            series.append((series_id, history, future_dates))
+    return series
+
+def bench_fit_many(workdir, data, prophet_sample, repeats):
+    """One batched pass over every (user, category) series vs separate Prophet fits"""
+    series = user_category_series(data)
+    times = []
+    for _ in range(repeats):
+        engine = BatchEngine()
+        started = time.perf_counter()
+        engine.fit_many(series)
+        times.append(time.perf_counter() - started)
+    result = {'series': len(series), 'batch_ms': median_ms(times)}
+    result['batch_series_per_sec'] = round(len(series) / max(statistics.median(times), 1e-9), 1)
+
+    if prophet_sample > 0 and series:
+        cache_dir = os.path.join(workdir, 'fit_many_model_cache')
+        sample = series[::max(len(series) // prophet_sample, 1)][:prophet_sample]
+        engine = ProphetEngine(FittedModelStore(cache_dir), None)
+        # Untimed first fit so importing Prophet is not counted
+        engine.forecast(sample[0][1], 'Sample', sample[0][2], sample[0][0])
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        prophet_times = []
+        for series_id, history, future_dates in sample:
+            engine = ProphetEngine(FittedModelStore(cache_dir), None)
+            started = time.perf_counter()
+            engine.forecast(history, 'Sample', future_dates, series_id)
+            prophet_times.append(time.perf_counter() - started)
+            shutil.rmtree(cache_dir, ignore_errors=True)
+        projected = statistics.mean(prophet_times) * len(series)
+        result['prophet_sample'] = len(sample)
+        result['prophet_projected_ms'] = round(projected * 1000, 2)
+        result['speedup'] = round(projected / max(statistics.median(times), 1e-9), 1)
+    return result
+
+def run_predictor(path, payload, env, wire='json'):
+    """One end-to-end predictor run: wall time plus the stage timings from its trace line
+    
+    payload is a JSON string, or with wire='msgpack' a request frame body.
+    """
+    if wire == 'msgpack':
+        payload = FRAME_HEADER.pack(len(payload)) + payload
+    started = time.perf_counter()
+    completed = subprocess.run(
+        [sys.executable, os.path.join(SERVER_DIR, 'cloud_predictor.py'), '--wire', wire],
+        input=payload if wire == 'msgpack' else payload.encode('utf-8'), capture_output=True, cwd=path, env=env, check=True
+    )
+    result = {'wall_ms': round((time.perf_counter() - started) * 1000, 2)}
+    for line in completed.stderr.decode('utf-8', 'replace').splitlines():
+        if line.startswith(TRACE_PREFIX):
+            trace = json.loads(line[len(TRACE_PREFIX):])
+            result['total_ms'] = trace['total_ms']
+            result['stages_ms'] = trace['stages_ms']
+    if wire == 'msgpack':
+        result['categories'] = len(decode_response(completed.stdout[FRAME_HEADER.size:]))
+    else:
+        result['categories'] = len(json.loads(completed.stdout or '{}'))
+    return result
+
+def bench_main(workdir, data, engine):
+    """End-to-end request, first with no fitted models and then with the model store warm
+    (over JSON and, when msgpack is installed, over the binary wire protocol)"""
+    path = os.path.join(workdir, 'columnar')
+    records = build_request(data)
+    payload = json.dumps(records)
+    env = dict(os.environ, PREDICTOR_ENGINE=engine, PREDICTOR_TRACE='1', PREDICTOR_LOG_LEVEL='warning', RESULT_CACHE='0')
+    for directory in ('model_cache', 'model_warm_start', 'result_cache'):
+        shutil.rmtree(os.path.join(path, directory), ignore_errors=True)
+    result = {
+        'engine': engine,
+        'request_rows': len(json.loads(payload)),
+        'cold': run_predictor(path, payload, env),
+        'cached': run_predictor(path, payload, env),
+    }
+    try:
+        result['cached_msgpack'] = run_predictor(path, encode_request(records), env, wire='msgpack')
+    except RuntimeError as e:
+        print(f"  ⚠️ Skipping the msgpack run: {e}", file=sys.stderr)
+    # The first run with the result cache on fills it; the second is a hit
+    env['RESULT_CACHE'] = '1'
+    run_predictor(path, payload, env)
+    result['result_cache_hit'] = run_predictor(path, payload, env)
+    return result
+
+def run_generate(path, fixture, months, *args):
+    """One `python generate_training_data.py` run in path; returns its timings"""
+    os.makedirs(path)
+    env = dict(os.environ, DB_DRIVER='sqlite', DB_NAME=fixture, TRAINING_MONTHS_BACK=str(months))
+    env.pop('TRAINING_STORE_DIR', None)
+    env.pop('TRAINING_SHARDS_DIR', None)
+    started = time.perf_counter()
+    subprocess.run(
+        [sys.executable, os.path.join(SERVER_DIR, 'generate_training_data.py'), '--format', 'columnar', *args],
+        capture_output=True, text=True, cwd=path, env=env, check=True
+    )
+    wall_ms = round((time.perf_counter() - started) * 1000, 2)
+    with open(os.path.join(path, 'training_store', 'meta.json'), 'r') as f:
+        meta = json.load(f)
+    return {
+        'wall_ms': wall_ms,
+        'export_ms': round(meta['export_seconds'] * 1000, 2),
+        'rows': meta['rows'],
+        'rows_per_sec': meta['rows_per_sec'],
+    }
+
+def same_store(path, other):
+    """True if two exports wrote identical columnar stores"""
+    for name in ('category_codes.npy', 'day_ordinals.npy', 'amounts.npy', 'category_offsets.npy'):
+        if not np.array_equal(np.load(os.path.join(path, 'training_store', name)),
+                              np.load(os.path.join(other, 'training_store', name))):
+            return False
+    return True
+
+def bench_generate(workdir, data, months, export_workers):
+    """generate_training_data.py exporting the SQLite fixture to the columnar store, with
+    one sequential query and with --workers month and user partitions"""
+    path = os.path.join(workdir, 'generate')
+    os.makedirs(path)
+    fixture = os.path.join(path, 'transactions.sqlite3')
+    write_sqlite_fixture(fixture, data)
+
+    sequential = os.path.join(path, 'sequential')
+    result = run_generate(sequential, fixture, months)
+    if export_workers > 1:
+        result['parallel'] = {}
+        for partition_by in ('month', 'user'):
+            parallel = os.path.join(path, partition_by)
+            timings = run_generate(parallel, fixture, months, '--workers', str(export_workers), '--partition-by', partition_by)
+            timings['matches_sequential'] = same_store(sequential, parallel)
+            result['parallel'][partition_by] = timings
+    return result
+
+def run_scenario(rows, categories, args):
+    """Every selected benchmark on one synthetic dataset"""
+    data = synthetic_transactions(rows, categories, args.months, args.users, args.seed)
+    results = {}
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix='cloudexpense-bench-')
+    try:
+        # The columnar store the predictor benchmarks read
+        write_training_store(
+            os.path.join(workdir, 'columnar', cloud_predictor.TRAINING_STORE_DIR),
+            data['categories'], data['codes'], data['days'], data['amounts']
+        )
+        for name in BENCHMARKS:
+            if name in args.skip:
+                continue
+            print(f"  {name}...", file=sys.stderr)
+            try:
+                if name == 'load_training_data':
+                    results[name] = bench_load(workdir, data, args.repeats)
+                elif name == 'predict_category':
+                    results[name] = bench_predict(workdir, args.engines, args.fit_categories, args.repeats)
+                elif name == 'fit_many':
+                    results[name] = bench_fit_many(workdir, data, args.prophet_sample, args.repeats)
+                elif name == 'main':
+                    results[name] = bench_main(workdir, data, args.main_engine)
+                elif name == 'generate':
+                    results[name] = bench_generate(workdir, data, args.months, args.export_workers)
+            except Exception as e:
+                print(f"  ⚠️ {name} failed: {e}", file=sys.stderr)
+                results[name] = {'error': str(e)}
+            finally:
+                os.chdir(cwd)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, cwd=SERVER_DIR, check=True
+        ).stdout.strip()
+    except Exception:
+        return None
+
+def flatten_timings(results, prefix=''):
+    """{'scenario/benchmark/.../x_ms': value} for every timing in a results tree"""
+    timings = {}
+    for key, value in results.items():
+        path = f"{prefix}/{key}" if prefix else key
+        if isinstance(value, dict):
+            timings.update(flatten_timings(value, path))
+        elif key.endswith('_ms') and isinstance(value, (int, float)):
+            timings[path] = value
+    return timings
+
+def compare(baseline, current):
+    """Print each timing in current next to the baseline and the ratio new/old"""
+    old = flatten_timings(baseline['results'])
+    new = flatten_timings(current['results'])
+    print(f"Comparing {current.get('commit')} against {baseline.get('commit')} (ratio = new / old)")
+    for path in sorted(set(old) | set(new)):
+        before, after = old.get(path), new.get(path)
+        ratio = f"{after / before:6.2f}x" if before and after is not None else '      -'
+        print(f"{ratio}  {path}: {before} -> {after}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the predictor pipeline on synthetic transactions')
+    parser.add_argument('--rows', type=lambda v: parse_list(v, int), default=[1000, 100000, 1000000],
+                        help='Comma-separated dataset sizes in transactions')
+    parser.add_argument('--categories', type=lambda v: parse_list(v, int), default=[8, 32],
+                        help='Comma-separated category counts')
+    parser.add_argument('--engines', type=parse_list, default=['numpy', 'batch', 'prophet'],
+                        help='Engines timed by the predict_category benchmark')
+    parser.add_argument('--main-engine', default='auto', help='PREDICTOR_ENGINE for the end-to-end benchmark')
+    parser.add_argument('--fit-categories', type=int, default=3,
+                        help='Largest categories forecast by the predict_category benchmark')
+    parser.add_argument('--prophet-sample', type=int, default=5,
+                        help='Series fitted with Prophet to project the time of fitting all of them (0 = skip)')
+    parser.add_argument('--repeats', type=int, default=3, help='Runs per in-process timing (the median is kept)')
+    parser.add_argument('--months', type=int, default=6, help='Months of history in the synthetic data')
+    parser.add_argument('--export-workers', type=int, default=4,
+                        help='--workers of the parallel export runs in the generate benchmark (1 = sequential only)')
+    parser.add_argument('--users', type=int, default=50, help='Users in the synthetic data')
+    parser.add_argument('--seed', type=int, default=42, help='Random seed of the synthetic data')
+    parser.add_argument('--skip', type=parse_list, default=[], help=f"Comma-separated benchmarks to skip ({', '.join(BENCHMARKS)})")
+    parser.add_argument('--output', default='benchmark_results.json', help='Results file')
+    parser.add_argument('--compare', metavar='OLD_JSON', help='Compare the results with an earlier results file')
+    parser.add_argument('--against', metavar='NEW_JSON',
+                        help='With --compare, compare this existing results file instead of running the suite')
+    args = parser.parse_args()
+    configure_logging('warning')
+
+    if args.against:
+        if not args.compare:
+            parser.error('--against needs --compare')
+        with open(args.compare, 'r') as f, open(args.against, 'r') as g:
+            compare(json.load(f), json.load(g))
+        return
+
+    report = {
+        'commit': git_commit(),
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'config': {
+            'rows': args.rows, 'categories': args.categories, 'engines': args.engines,
+            'main_engine': args.main_engine, 'fit_categories': args.fit_categories,
+            'prophet_sample': args.prophet_sample, 'repeats': args.repeats,
+            'months': args.months, 'export_workers': args.export_workers, 'users': args.users, 'seed': args.seed, 'skip': args.skip,
+        },
+        'results': {},
+    }
+    for rows in args.rows:
+        for categories in args.categories:
+            scenario = f"rows={rows},categories={categories}"
+            print(f"Benchmarking {scenario}...", file=sys.stderr)
+            report['results'][scenario] = run_scenario(rows, categories, args)
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}", file=sys.stderr)
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            compare(json.load(f), report)
+    else:
+        print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
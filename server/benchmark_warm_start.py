@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+CloudExpense Warm-Start Refit Benchmark
+=======================================
+
+Measures how much faster Prophet refits are when started from the previous fit's
+parameters (what ProphetEngine does when a series gains a few new points) than a
+cold fit of the same series.
+
+For every category in the training data the series is fitted once without its last
+--new-days days, then the full series is refitted both cold and warm-started from
+that fit. Fit times are the median over --repeats runs.
+
+Usage:
+  python benchmark_warm_start.py [--new-days 1] [--repeats 3] [--category Food]
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import statistics
+import warnings
+
+import pandas as pd
+
+from forecast_engines import ProphetEngine, prepare_series, series_summary, warm_start_params
+from model_store import WarmStartStore
+from training_store import TRAINING_STORE_DIR, TrainingColumns, ordinals_to_datetime64
+warnings.filterwarnings('ignore')
+
+def load_columns(training_file='training_data.json'):
+    """Training data from the columnar store if there is one, otherwise training_data.json"""
+    if os.path.exists(os.path.join(TRAINING_STORE_DIR, 'meta.json')):
+        return TrainingColumns.open(TRAINING_STORE_DIR)
+    with open(training_file, 'r') as f:
+        return TrainingColumns.from_records(json.load(f))
+
+def fit_frame(history):
+    """Prophet fit frame of a category's daily series"""
+    series = prepare_series(history)
+    return pd.DataFrame({'ds': ordinals_to_datetime64(series.days), 'y': series.amounts})
+
+def timed_fit(engine, df, category, series_id=None, warm_start=False):
+    """Seconds taken by one fit through the engine"""
+    started = time.perf_counter()
+    engine.fit(df, category, series_id, warm_start=warm_start)
+    return time.perf_counter() - started
+
+def bench_category(engine, store, columns, category, new_days, repeats):
+    """Cold vs warm-started refit times for one category after new_days of new data"""
+    df = fit_frame(columns.history(category))
+    if len(df) <= new_days + 2:
+        return None
+    previous = df.iloc[:-new_days]
+
+    # The fit the series had before the new days arrived
+    started = time.perf_counter()
+    model = engine.build_model(category, set(previous['ds'].dt.year))
+    model.fit(previous)
+    base = {
+        'summary': series_summary(previous),
+        'params': warm_start_params(model),
+        'cold_seconds': time.perf_counter() - started
+    }
+
+    cold_times, warm_times = [], []
+    for _ in range(repeats):
+        cold_times.append(timed_fit(engine, df, category))
+        store.put(category, base)
+        warm_before = engine.fit_stats['warm']
+        warm_times.append(timed_fit(engine, df, category, category, warm_start=True))
+        if engine.fit_stats['warm'] == warm_before:
+            # The engine refused the warm start (series changed too much or fit failed)
+            return {'rows': len(df), 'warm_started': False}
+
+    cold, warm = statistics.median(cold_times), statistics.median(warm_times)
+    return {
+        'rows': len(df),
+        'warm_started': True,
+        'cold_ms': round(cold * 1000, 1),
+        'warm_ms': round(warm * 1000, 1),
+        'reduction': round(1 - warm / cold, 3) if cold > 0 else 0.0,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark warm-started vs cold Prophet refits')
+    parser.add_argument('--new-days', type=int, default=1, help='Days of new data added since the previous fit')
+    parser.add_argument('--repeats', type=int, default=3, help='Fits timed per category and mode')
+    parser.add_argument('--category', action='append', help='Only benchmark this category (repeatable)')
+    args = parser.parse_args()
+
+    columns = load_columns()
+    categories = args.category or columns.categories
+
+    with tempfile.TemporaryDirectory() as warm_dir:
+        store = WarmStartStore(warm_dir)
+        engine = ProphetEngine(None, store)
+        results = {}
+        for category in categories:
+            print(f"Benchmarking {category}...", file=sys.stderr)
+            result = bench_category(engine, store, columns, category, args.new_days, args.repeats)
+            if result is not None:
+                results[category] = result
+
+    timed = [r for r in results.values() if r['warm_started']]
+    report = {'new_days': args.new_days, 'repeats': args.repeats, 'categories': results}
+    if timed:
+        cold_total = sum(r['cold_ms'] for r in timed)
+        warm_total = sum(r['warm_ms'] for r in timed)
+        report['total_cold_ms'] = round(cold_total, 1)
+        report['total_warm_ms'] = round(warm_total, 1)
+        report['overall_reduction'] = round(1 - warm_total / cold_total, 3) if cold_total > 0 else 0.0
+    print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+"""
+Equivalence check for incremental_state.py
+==========================================
+
+Replays random streams of transaction insert, update and delete events into an
+IncrementalState. After every event, the answer for the changed user month is compared
+against the full recompute path: the month's surviving transactions are rebuilt as a
+request and run through current_stats, math_projection, dynamic_cap and
+velocity_factor as predict_category would call them. Caps come from the spending
+sketches of a temporary shard set, built from random 2023 history for most users: some
+categories have a usable sketch of the user's own, some only the population's, and one
+has none, so every kind of cap is compared. Updates that move a transaction
+to another month or category, deletes of the latest expense and months that empty out
+are all covered. The stream spans more months than the state keeps per user, so months
+are evicted and events dated before the kept months are ignored, as the reference
+model expects; deletes and updates of those ids follow. Invalid events (missing or unparseable fields) are mixed in as well;
+each must be rejected with a ValueError and leave the state exactly as it was.
+
+A few refreshes at the end are also compared against run_prediction on the same
+records with the same shards, using the NumPy engine so the check stays fast.
+
+Usage:
+  python check_incremental_state.py [--events 5000] [--users 3] [--seed 7]
+"""
+
+import sys
+import random
+import argparse
+import tempfile
+from datetime import date, timedelta
+
+import cloud_predictor
+import forecast_engines
+from cloud_predictor import cap_sketch, current_stats, dynamic_cap, math_projection, usable_sketch, velocity_factor
+from incremental_state import IncrementalState
+from instrumentation import configure_logging
+from training_store import ShardedStoreWriter, TrainingColumns, TrainingShards
+
+CATEGORIES = ['Food', 'Transport', 'Shopping', 'Bills', 'Entertainment', 'Health', 'Education', 'Others']
+
+# Answers are rounded to cents, so a recompute may differ by half a cent plus float noise
+TOLERANCE = 0.005 + 1e-6
+
+def random_event(rng, live, gone, months, users, next_id):
+    """One insert (most of the time), update or delete; updates may send only some fields
+    
+    A few deletes and updates name transactions the state evicted or never kept (gone).
+    """
+    roll = rng.random()
+    if gone and roll < 0.04:
+        event = {'event': rng.choice(['delete', 'update']), 'id': rng.choice(sorted(gone))}
+        if event['event'] == 'update':
+            event.update(random_fields(rng, months, users))
+        return event, next_id
+    if live and roll < 0.2:
+        return {'event': 'delete', 'id': rng.choice(sorted(live))}, next_id
+    if live and roll < 0.45:
+        event = {'event': 'update', 'id': rng.choice(sorted(live))}
+        for field, value in random_fields(rng, months, users).items():
+            if field != 'user_id' and rng.random() < 0.5:
+                event[field] = value
+        return event, next_id
+    return dict(random_fields(rng, months, users), event='insert', id=next_id), next_id + 1
+
+def random_fields(rng, months, users):
+    month = rng.choice(months)
+    last_day = ((month + timedelta(days=32)).replace(day=1) - timedelta(days=1)).day
+    return {
+        'user_id': rng.choice(users),
+        'date': month.replace(day=rng.randint(1, last_day)).isoformat(),
+        'category': rng.choice(CATEGORIES),
+        'amount': round(rng.uniform(1, 400), 2),
+    }
+
+def invalid_event(rng, live, months, users, next_id):
+    """An insert or update the state must reject: a field missing or unparseable"""
+    if live and rng.random() < 0.5:
+        event = {'event': 'update', 'id': rng.choice(sorted(live))}
+    else:
+        event = dict(random_fields(rng, months, users), event='insert', id=next_id)
+    field, value = rng.choice([
+        ('date', 'not-a-date'), ('date', '2024-02-30'), ('category', ''), ('category', 7),
+        ('amount', 'abc'), ('amount', float('nan')), ('amount', True), ('amount', None),
+    ])
+    if value is None or (event['event'] == 'insert' and rng.random() < 0.3):
+        # Inserts need every field; a missing one is as invalid as a bad value
+        if event['event'] == 'update':
+            return {'event': 'update', 'id': 'unknown', 'date': '2024-01-05'}
+        event.pop(rng.choice(['user_id', 'date', 'category', 'amount']))
+    else:
+        event[field] = value
+    return event
+
+def snapshot(state):
+    """Everything an event may change: the stored transactions and every month's answer"""
+    return dict(state.transactions), [
+        state.figures(user_id, month_start) for user_id, months in state.users.items() for month_start in months
+    ]
+
+def check_rejected(state, event):
+    """An invalid event must raise ValueError without changing the state"""
+    before = snapshot(state)
+    try:
+        state.apply(event)
+    except ValueError:
+        return [] if snapshot(state) == before else [f"rejected event {event} changed the state"]
+    return [f"invalid event {event} was accepted"]
+
+def month_of(row):
+    return date.fromisoformat(row['date']).replace(day=1).toordinal()
+
+def expect_event(event, live, gone, kept, months_per_user):
+    """Apply an event to the reference model: the surviving rows (live) and each user's kept months"""
+    previous = live.pop(event['id'], None)
+    if event['event'] == 'delete':
+        gone.discard(event['id'])
+        return previous
+    row = dict(previous or {}, **{k: v for k, v in event.items() if k not in ('event', 'id')})
+    months = kept.setdefault(row['user_id'], set())
+    month = month_of(row)
+    if month not in months and len(months) >= months_per_user and month < min(months):
+        gone.add(event['id'])
+        return previous
+    gone.discard(event['id'])
+    live[event['id']] = row
+    months.add(month)
+    if len(months) > months_per_user:
+        oldest = min(months)
+        months.discard(oldest)
+        for transaction_id, other in list(live.items()):
+            if other['user_id'] == row['user_id'] and month_of(other) == oldest:
+                del live[transaction_id]
+                gone.add(transaction_id)
+    return previous
+
+def write_shards(path, rng, users):
+    """Shards of random 2023 history: the last user has too few days for sketches of their own,
+    and nobody has spent on Others"""
+    categories, days, amounts, user_ids = [], [], [], []
+    first_day = date(2023, 1, 1).toordinal()
+    for user in users:
+        spending_days = 8 if user == users[-1] else 200
+        for category in CATEGORIES[:-1]:
+            for day in rng.sample(range(365), spending_days):
+                categories.append(category)
+                days.append(first_day + day)
+                amounts.append(round(rng.uniform(1, 150), 2))
+                user_ids.append(user)
+    writer = ShardedStoreWriter(path, shard_count=2)
+    writer.append(categories, days, amounts, user_ids)
+    writer.close()
+    return TrainingShards.open(path)
+
+def recompute(rows, shards=None):
+    """The answer's figures for a month's rows, computed from scratch the way predict_category does"""
+    user_history = shards.for_user(rows[0]['user_id']) if shards is not None else None
+    request = TrainingColumns.from_records(rows)
+    reference = date.fromordinal(int(request.days.max()))
+    month_end = (reference.replace(day=1) + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+    remaining_days = (month_end - reference).days
+    categories = {}
+    for category in request.categories:
+        history = request.history(category)
+        stats = current_stats(history)
+        if remaining_days <= 0:
+            fallback = cap = stats.total
+        else:
+            fallback = math_projection(history, category, remaining_days)
+            cap = dynamic_cap(stats, category, remaining_days, cap_sketch(category, user_history, shards))
+        categories[category] = {
+            'current': stats.total,
+            'fallback': fallback,
+            'cap': cap,
+            'velocity_factor': velocity_factor(stats, category),
+        }
+    return reference.isoformat(), remaining_days, categories
+
+def compare(answer, rows, shards=None):
+    """Differences between an incremental answer and the full recompute of the same rows"""
+    if not rows:
+        return [] if not answer['categories'] else [f"expected no categories, got {sorted(answer['categories'])}"]
+    reference_date, remaining_days, expected = recompute(rows, shards)
+    problems = []
+    if answer['reference_date'] != reference_date or answer['remaining_days'] != remaining_days:
+        problems.append(f"reference {answer['reference_date']}/{answer['remaining_days']} != {reference_date}/{remaining_days}")
+    if sorted(answer['categories']) != sorted(expected):
+        problems.append(f"categories {sorted(answer['categories'])} != {sorted(expected)}")
+        return problems
+    for category, figures in expected.items():
+        for field, value in figures.items():
+            got = answer['categories'][category][field]
+            if abs(got - value) > TOLERANCE * max(1.0, abs(value) / 100):
+                problems.append(f"{category}.{field}: incremental {got} != recompute {value}")
+    return problems
+
+def check_refreshes(state, rows_by_month, count, shards):
+    """Refreshed forecasts must be run_prediction's totals for the same records"""
+    forecast_engines.PREDICTOR_ENGINE = 'numpy'
+    training = cloud_predictor.load_training_data()
+    failures = 0
+    for user_id, month_start in state.stale()[:count]:
+        rows = rows_by_month[(user_id, month_start)]
+        expected, _ = cloud_predictor.run_prediction(TrainingColumns.from_records(rows), training, 1, user_id, shards)
+        answer = state.refresh(
+            user_id, month_start, lambda request: cloud_predictor.run_prediction(request, training, 1, user_id, shards)
+        )
+        for category, figures in answer['categories'].items():
+            stale_left = figures['stale']
+            if stale_left or abs(figures['forecast'] - expected[category]) > TOLERANCE:
+                failures += 1
+                print(f"  ❌ refresh {user_id} {answer['month']} {category}: {figures['forecast']} != {expected[category]}"
+                      f"{' (still stale)' if stale_left else ''}", file=sys.stderr)
+            elif not figures['current'] - TOLERANCE <= figures['estimate'] <= figures['cap'] + TOLERANCE:
+                failures += 1
+                print(f"  ❌ refresh {user_id} {answer['month']} {category}: estimate {figures['estimate']} "
+                      f"outside [{figures['current']}, {figures['cap']}]", file=sys.stderr)
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the incremental prediction state against a full recompute')
+    parser.add_argument('--events', type=int, default=5000, help='Random events to replay')
+    parser.add_argument('--users', type=int, default=3, help='Users the events are spread over')
+    parser.add_argument('--seed', type=int, default=7, help='Random seed')
+    parser.add_argument('--refreshes', type=int, default=3, help='Stale months to refresh and compare (0 = none)')
+    args = parser.parse_args()
+    configure_logging('error')
+
+    rng = random.Random(args.seed)
+    users = [str(user) for user in range(1, args.users + 1)]
+    shard_dir = tempfile.TemporaryDirectory(prefix='check_incremental_')
+    shards = write_shards(f"{shard_dir.name}/training_shards", rng, users)
+    own_sketches = sum(usable_sketch(shards.for_user(user).sketch(category)) is not None
+                       for user in users for category in CATEGORIES)
+    print(f"📐 Caps from {own_sketches} per-user sketches, the population sketch or multipliers", file=sys.stderr)
+    # More months than the state keeps, so evictions and out-of-window events are replayed too
+    months = [date(2024, month, 1) for month in range(1, 5)]
+    months_per_user = 2
+    state = IncrementalState(months_per_user=months_per_user, shards=shards)
+    live = {}
+    gone = set()
+    kept = {}
+    next_id = 1
+    failures = 0
+    rejected = 0
+
+    for number in range(args.events):
+        if rng.random() < 0.05:
+            event = invalid_event(rng, live, months, users, next_id)
+            problems = check_rejected(state, event)
+            rejected += 1
+            if problems:
+                failures += 1
+                print(f"  ❌ event {number}: {'; '.join(problems)}", file=sys.stderr)
+            continue
+        event, next_id = random_event(rng, live, gone, months, users, next_id)
+        previous = expect_event(event, live, gone, kept, months_per_user)
+        key = state.apply(event)
+        kept_months = {user_id: set(user_months) for user_id, user_months in state.users.items() if user_months}
+        if kept_months != {user_id: user_months for user_id, user_months in kept.items() if user_months}:
+            failures += 1
+            print(f"  ❌ event {number} {event}: kept months {kept_months} != {kept}", file=sys.stderr)
+        if key is None:
+            continue
+        touched = {key}
+        if previous is not None:
+            touched.add((previous['user_id'], month_of(previous)))
+        for user_id, month_start in touched:
+            rows = [row for row in live.values() if row['user_id'] == user_id and month_of(row) == month_start]
+            problems = compare(state.figures(user_id, month_start), rows, shards)
+            if problems:
+                failures += 1
+                print(f"  ❌ event {number} {event}: {'; '.join(problems)}", file=sys.stderr)
+
+    print(f"🔁 Replayed {args.events} events ({state.events_applied} applied, {rejected} invalid ones rejected, "
+          f"{len(live)} transactions live, {len(gone)} evicted or ignored)",
+          file=sys.stderr)
+
+    if args.refreshes:
+        rows_by_month = {}
+        for row in live.values():
+            rows_by_month.setdefault((row['user_id'], month_of(row)), []).append(row)
+        failures += check_refreshes(state, rows_by_month, args.refreshes, shards)
+    shard_dir.cleanup()
+
+    if failures:
+        print(f"❌ {failures} mismatches against the full recompute", file=sys.stderr)
+        sys.exit(1)
+    print("✅ Incremental state matches the full recompute", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
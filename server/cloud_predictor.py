@@ -1,123 +1,186 @@
 import sys
 import json
 import os
-import pandas as pd
-from prophet import Prophet
+import time
+import signal
+import shutil
+import logging
+import threading
+import contextlib
+import numpy as np
 import warnings
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, as_completed, wait
+from concurrent.futures.process import BrokenProcessPool
+from collections import namedtuple
+from forecast_engines import (
+    BatchEngine, DeadlineExceeded, NumpyEngine, ProphetEngine, batch_engine_selected, engine_config, fit_deadline,
+    fits_daily_totals, prepare_series, select_engine, stan_running
+)
+from history_selection import HISTORY_MAX_POINTS, select_history, selection_config, selection_summary
+from instrumentation import (
+    RequestTrace, configure_logging, emit_trace, get_logger, quiet_library_loggers, record_stage, stage,
+    start_category_timing
+)
+from model_store import MODEL_CONFIG_VERSION, FittedModelStore, WarmStartStore
+from result_cache import ResultCache, request_key
+from wire import WIRE_FORMATS, decode_request, encode_response, read_frame, write_frame
+from training_store import (
+    TRAINING_SHARDS_DIR, TRAINING_STORE_DIR, History, TrainingColumns, TrainingShards, concat_histories,
+    date_to_ordinal, day_of_month, history_points, parse_days, user_category_key
+)
 warnings.filterwarnings('ignore')
 
+configure_logging()
+logger = get_logger()
+
+TRAINING_DATA_FILE = 'training_data.json'
+
+# Fitted models survive across requests (and across processes via disk)
+model_store = FittedModelStore()
+
+# Last fitted parameters per (user, category) series, used to warm-start refits
+warm_start_store = WarmStartStore()
+
+# Finished predictions per request fingerprint, shared across processes via disk
+result_cache = ResultCache()
+
+# Forecasting engines available to predict_category (see forecast_engines.py)
+ENGINES = {
+    'prophet': ProphetEngine(model_store, warm_start_store),
+    'numpy': NumpyEngine(),
+    'batch': BatchEngine(),
+}
+
+# A category's predicted month total, the method that produced it, its stage timings (ms) and
+# whether the request deadline cut its model fit short
+Forecast = namedtuple('Forecast', ['total', 'method', 'timings', 'deadline_hit'], defaults=(None, False))
+
+# Running statistics of a category's expenses this month: total, distinct days with spending,
+# latest day of the month with spending (0 without any) and the latest expense's day ordinal
+CurrentStats = namedtuple('CurrentStats', ['total', 'days_with_spending', 'last_day_of_month', 'latest_day'])
+
+# One request's per-category prediction jobs and the month context they share, with the
+# history points each category had available before history selection
+PredictionPlan = namedtuple('PredictionPlan', ['jobs', 'reference_date', 'remaining_days', 'ai_count', 'fallback_count',
+                                               'available_points'], defaults=(None,))
+
+# Worker processes used to fit categories concurrently (1 = serial, 0 = one per CPU core)
+PREDICTOR_WORKERS = int(os.environ.get('PREDICTOR_WORKERS', '1'))
+
+# How per-user forecasts use the pooled history: 'none', 'fallback' (only for categories where
+# the user has fewer than 3 points of their own) or 'always'
+GLOBAL_BLEND = os.environ.get('PREDICTOR_GLOBAL_BLEND', 'fallback')
+
+# Months of training history used per category before the reference date (0 = all of it)
+HISTORY_MONTHS = int(os.environ.get('PREDICTOR_HISTORY_MONTHS', '0'))
+
+# Read training history from the stores' daily rollups instead of raw transactions whenever
+# the engines are fitted on per-day totals anyway (PREDICTOR_ROLLUPS=0 reads raw rows)
+ROLLUPS = os.environ.get('PREDICTOR_ROLLUPS', '1') != '0'
+
+# Caps from the training shards' spending sketches (see quantile_sketch.py) instead of fixed
+# multipliers, once a sketch has seen at least PREDICTOR_SKETCH_MIN_DAYS days of spending: the
+# current total plus, for each remaining day, the spending frequency times the
+# PREDICTOR_SKETCH_CAP_QUANTILE of daily totals. A month whose daily average so far is above the
+# PREDICTOR_SKETCH_ANOMALY_QUANTILE of past daily totals is flagged in the metadata.
+SKETCH_CAPS = os.environ.get('PREDICTOR_SKETCH_CAPS', '1') != '0'
+SKETCH_MIN_DAYS = int(os.environ.get('PREDICTOR_SKETCH_MIN_DAYS', '14'))
+SKETCH_CAP_QUANTILE = float(os.environ.get('PREDICTOR_SKETCH_CAP_QUANTILE', '0.95'))
+SKETCH_ANOMALY_QUANTILE = float(os.environ.get('PREDICTOR_SKETCH_ANOMALY_QUANTILE', '0.99'))
+
+# Batch mode: input rows parsed per chunk, and how often (in seconds) progress is reported
+BATCH_CHUNK_SIZE = int(os.environ.get('BATCH_CHUNK_SIZE', '10000'))
+BATCH_PROGRESS_SECONDS = float(os.environ.get('BATCH_PROGRESS_SECONDS', '10'))
+
+# Latency budget per request in milliseconds (0 = none). Categories whose model fit has not
+# finished when it runs out keep the math projection computed up front
+DEADLINE_MS = float(os.environ.get('PREDICTOR_DEADLINE_MS', '0'))
+# How soon a deadline alarm that landed during a CmdStan run checks again once cmdstanpy has stopped it
+DEADLINE_RECHECK_SECONDS = 0.05
+
+# First line of a batch's .partial file: {BATCH_HEADER_KEY: batch_header()}
+BATCH_HEADER_KEY = 'batch_header'
+
+# Users whose series are fitted together per batch job when PREDICTOR_ENGINE=batch
+BATCH_ENGINE_USERS = int(os.environ.get('BATCH_ENGINE_USERS', '256'))
+
+_executor = None
+_executor_workers = None
+
+# Training data held by each batch worker process (see init_batch_worker)
+_batch_training_data = None
+_batch_shards = None
+
 def load_training_data():
-    """Load training data for AI learning"""
+    """Load training data for AI learning as memory-mapped columns"""
     try:
-        print(f"🔍 Attempting to load training_data.json from: {os.getcwd()}", file=sys.stderr)
+        logger.debug(f"🔍 Attempting to load training data from: {os.getcwd()}")
+        
+        # Prefer the columnar store written by generate_training_data.py
+        if os.path.exists(os.path.join(TRAINING_STORE_DIR, 'meta.json')):
+            columns = TrainingColumns.open(TRAINING_STORE_DIR)
+            logger.info(f"✅ Opened columnar training store with {len(columns)} records for AI")
+            logger.debug(f"📂 Categories in training data: {sorted(columns.categories)}")
+            return columns
         
         # Check if file exists
-        if not os.path.exists('training_data.json'):
-            print("❌ training_data.json does not exist in current directory", file=sys.stderr)
-            return []
+        if not os.path.exists(TRAINING_DATA_FILE):
+            logger.warning("❌ No training store or training_data.json in current directory")
+            return TrainingColumns.empty()
             
-        print("✅ training_data.json file exists", file=sys.stderr)
+        logger.debug("✅ training_data.json file exists")
         
         # Check file size
-        file_size = os.path.getsize('training_data.json')
-        print(f"📊 training_data.json file size: {file_size} bytes", file=sys.stderr)
+        file_size = os.path.getsize(TRAINING_DATA_FILE)
+        logger.debug(f"📊 training_data.json file size: {file_size} bytes")
         
-        with open('training_data.json', 'r') as f:
-            data = json.load(f)
-            print(f"✅ Successfully loaded {len(data)} training records for AI", file=sys.stderr)
-            
-            # Show sample of data structure
-            if data:
-                sample = data[0]
-                print(f"📋 Sample training record: {sample}", file=sys.stderr)
-                
-                # Check categories in training data
-                categories = set(record.get('category', 'unknown') for record in data)
-                print(f"📂 Categories in training data: {sorted(categories)}", file=sys.stderr)
-            
-            return data
+        with open(TRAINING_DATA_FILE, 'r') as f:
+            columns = TrainingColumns.from_records(json.load(f))
+            logger.info(f"✅ Successfully loaded {len(columns)} training records for AI")
+            logger.debug(f"📂 Categories in training data: {sorted(columns.categories)}")
+            return columns
     except FileNotFoundError:
-        print("⚠️ training_data.json not found - using current data only", file=sys.stderr)
-        return []
+        logger.warning("⚠️ training_data.json not found - using current data only")
+        return TrainingColumns.empty()
     except json.JSONDecodeError as e:
-        print(f"❌ JSON decode error in training_data.json: {e}", file=sys.stderr)
-        return []
+        logger.error(f"❌ JSON decode error in training_data.json: {e}")
+        return TrainingColumns.empty()
     except Exception as e:
-        print(f"⚠️ Error loading training data: {e} - using current data only", file=sys.stderr)
-        return []
-
-def parse_date(date_str):
-    """Parse date string to datetime"""
-    if 'T' in str(date_str):
-        # ISO format from database
-        return datetime.fromisoformat(str(date_str).replace('Z', '+00:00')).replace(tzinfo=None)
-    else:
-        # Simple YYYY-MM-DD format
-        return datetime.strptime(str(date_str), '%Y-%m-%d')
+        logger.warning(f"⚠️ Error loading training data: {e} - using current data only")
+        return TrainingColumns.empty()
 
-def predict_category(current_data, all_historical_data, category, remaining_days, reference_date=None):
-    """Smart Prophet AI prediction with realistic constraints"""
-    current_total = sum(expense['amount'] for expense in current_data)
+def predict_category(current_data, all_historical_data, category, remaining_days, reference_date=None, series_id=None,
+                     sketch=None):
+    """Smart AI prediction with realistic constraints, returned as a Forecast(total, method)
+    
+    current_data and all_historical_data are History columns (day ordinals and amounts)
+    for this month's expenses and for this month plus training history respectively;
+    training history may be daily rollup rows carrying their transaction counts.
+    series_id identifies the series across requests so refits can be warm-started.
+    sketch is the series' SpendingSketch, when the training shards have one, for the cap.
+    """
+    stats = current_stats(current_data)
+    current_total = stats.total
     
     if remaining_days <= 0:
-        return current_total
+        return Forecast(current_total, 'current')
     
-    print(f"{category}: Current total={current_total:.2f}, Remaining days={remaining_days}", file=sys.stderr)
+    logger.debug(f"{category}: Current total={current_total:.2f}, Remaining days={remaining_days}")
     
-    # Use Prophet AI if we have at least a minimal amount of data
-    if len(all_historical_data) >= 3:  # Lowered to 3 to maximize AI usage
+    # Use an AI engine if we have at least a minimal amount of data
+    if history_points(all_historical_data) >= 3:  # Lowered to 3 to maximize AI usage
         try:
-            print(f"{category}: ⚡ Attempting Prophet AI with {len(all_historical_data)} data points", file=sys.stderr)
-            
-            # Check if we have sufficient temporal diversity for Prophet
-            unique_dates = set(parse_date(record['date']).date() for record in all_historical_data)
+            # Check if we have sufficient temporal diversity for a model
+            unique_dates = np.unique(all_historical_data.days)
             if len(unique_dates) < 2:
-                print(f"{category}: ❌ Only {len(unique_dates)} unique dates - Prophet needs temporal diversity, using fallback", file=sys.stderr)
-                raise ValueError("Insufficient temporal diversity for Prophet AI")
-            
-            print(f"{category}: ✅ Using Prophet AI with {len(all_historical_data)} data points across {len(unique_dates)} dates", file=sys.stderr)
-            
-            # Prepare data for Prophet
-            prophet_data = []
-            for record in all_historical_data:
-                date_obj = parse_date(record['date'])
-                prophet_data.append({
-                    'ds': date_obj,
-                    'y': float(record['amount'])
-                })
-            
-            df = pd.DataFrame(prophet_data).sort_values('ds')
-            
-            # Create Prophet model with optimized settings for expense prediction
-            model = Prophet(
-                daily_seasonality=True,         # Daily patterns matter for expenses
-                yearly_seasonality=True,        # Capture annual patterns (holidays, etc.)
-                weekly_seasonality=True,        # Weekly patterns (weekends vs weekdays)
-                changepoint_prior_scale=0.15,   # More flexible to capture expense pattern changes
-                seasonality_prior_scale=20.0,   # Strongly enhanced seasonal component
-                interval_width=0.9,            # Wider prediction interval for better coverage
-                seasonality_mode='multiplicative',  # Better for expense patterns
-                growth='linear'                # Linear growth model works best for expenses
-            )
+                logger.debug(f"{category}: ❌ Only {len(unique_dates)} unique dates - AI needs temporal diversity, using fallback")
+                raise ValueError("Insufficient temporal diversity for AI engines")
             
-            # Add country-specific holidays for better prediction around spending patterns
-            try:
-                # Prophet API changed in newer versions - try the safe way
-                country_holidays = None
-                
-                # Try to determine user's country from spending patterns
-                # For now, default to US holidays but could be expanded
-                try:
-                    model.add_country_holidays(country_code='US')
-                    print(f"{category}: Added country-specific holidays to AI model", file=sys.stderr)
-                except (AttributeError, ImportError, ValueError) as e:
-                    print(f"{category}: Could not add specific holidays: {e}", file=sys.stderr)
-            except Exception as holiday_error:
-                print(f"{category}: Could not add holidays: {holiday_error}", file=sys.stderr)
-            
-            # Train the model
-            model.fit(df)
+            # Fit on the daily spending series rather than one row per transaction
+            series = prepare_series(all_historical_data)
+            engine = select_engine(ENGINES, series)
+            logger.debug(f"{category}: ✅ Using {engine.name} engine with {history_points(all_historical_data)} data points across {len(unique_dates)} dates ({len(series.days)} series rows)")
             
             # Create future dates for remaining days from reference date
             future_dates = []
@@ -125,123 +188,171 @@ def predict_category(current_data, all_historical_data, category, remaining_days
             for i in range(1, remaining_days + 1):
                 future_dates.append(start_date + timedelta(days=i))
             
-            future_df = pd.DataFrame({'ds': future_dates})
-            forecast = model.predict(future_df)
-            
             # Sum predicted values for remaining days
-            predicted_additional = max(0, forecast['yhat'].sum())
+            predicted_additional = engine.forecast(series, category, future_dates, series_id)
             
             # SMART AI APPROACH - Consider spending velocity and month context
-            predicted_total = current_total + predicted_additional
+            cap_started = time.perf_counter()
             
             # Calculate spending velocity context for intelligent adjustments
-            if current_data:
-                current_dates = [parse_date(exp['date']) for exp in current_data]
-                earliest_expense = min(current_dates)
-                latest_expense = max(current_dates)
-                
-                # Calculate how far into the month we are based on expense dates
-                days_into_month = latest_expense.day
-                total_days_in_month = (latest_expense.replace(day=1) + timedelta(days=32)).replace(day=1) - timedelta(days=1)
-                total_days_in_month = total_days_in_month.day
-                month_progress = days_into_month / total_days_in_month
-                
-                # Calculate current spending rate (daily average so far this month)
-                days_with_expenses = len(set(d.day for d in current_dates))
-                current_daily_rate = current_total / max(days_with_expenses, 1)
-                
-                print(f"{category}: Month progress: {month_progress:.1%}, Daily rate: ${current_daily_rate:.2f}, Days active: {days_with_expenses}", file=sys.stderr)
-                
-                # AI velocity intelligence: Adjust based on spending pace context
-                if month_progress < 0.2:  # Early month (first 20%)
-                    if current_daily_rate > 30:  # High spending rate early
-                        velocity_factor = 1.3  # AI expects continued high spending
-                        print(f"{category}: Early month + high velocity = aggressive AI prediction", file=sys.stderr)
-                    else:
-                        velocity_factor = 1.1  # Moderate increase
-                        print(f"{category}: Early month + normal velocity = moderate AI increase", file=sys.stderr)
-                        
-                elif month_progress < 0.6:  # Mid month (20-60%)
-                    if current_daily_rate > 20:  # Decent spending rate
-                        velocity_factor = 1.0  # Trust AI prediction as-is
-                        print(f"{category}: Mid month + good velocity = trust AI prediction", file=sys.stderr)
-                    else:
-                        velocity_factor = 0.9  # Slightly conservative
-                        print(f"{category}: Mid month + low velocity = slightly reduce AI prediction", file=sys.stderr)
-                        
-                else:  # Late month (60%+)
-                    if current_daily_rate > 15:  # Still spending late in month
-                        velocity_factor = 0.8  # More conservative
-                        print(f"{category}: Late month + continued spending = conservative AI", file=sys.stderr)
-                    else:
-                        velocity_factor = 0.6  # Very conservative
-                        print(f"{category}: Late month + low velocity = very conservative AI", file=sys.stderr)
-                
+            if stats.latest_day is not None:
                 # Apply velocity intelligence to AI prediction
-                predicted_additional = predicted_additional * velocity_factor
-                predicted_total = current_total + predicted_additional
-                
-                print(f"{category}: Applied velocity factor {velocity_factor:.2f} to AI prediction", file=sys.stderr)
+                velocity = velocity_factor(stats, category)
+                predicted_additional = predicted_additional * velocity
+                logger.debug(f"{category}: Applied velocity factor {velocity:.2f} to AI prediction")
             else:
-                print(f"{category}: No current data for velocity analysis", file=sys.stderr)
+                logger.debug(f"{category}: No current data for velocity analysis")
+            predicted_total = current_total + predicted_additional
             
             # Only apply dynamic daily-based caps (not fixed multipliers)
-            # Calculate realistic daily-based maximum based on remaining days
-            if current_data:
-                current_dates = [parse_date(exp['date']) for exp in current_data]
-                days_with_expenses = len(set(d.day for d in current_dates))
-                current_daily_avg = current_total / max(days_with_expenses, 1)
-                
-                # Dynamic cap: current total + (daily average × remaining days)
-                # This means you could theoretically spend your daily average every remaining day
-                max_additional_per_day = current_daily_avg
-                
-                # Category-specific daily spending limits
-                if category.lower() in ['bills']:
-                    max_additional_per_day = current_daily_avg * 0.3  # Bills don't repeat daily
-                elif category.lower() in ['education']:
-                    max_additional_per_day = current_daily_avg * 0.2  # Education is irregular
-                elif category.lower() in ['food', 'transport']:
-                    max_additional_per_day = current_daily_avg * 1.5  # Daily essentials can vary
-                elif category.lower() in ['shopping', 'entertainment']:
-                    max_additional_per_day = current_daily_avg * 1.0  # Normal spending rate
-                else:
-                    max_additional_per_day = current_daily_avg * 0.8  # Conservative for others
-                
-                # Calculate dynamic maximum based on remaining days
-                max_reasonable_additional = max_additional_per_day * remaining_days
-                max_reasonable_total = current_total + max_reasonable_additional
-                
-                print(f"{category}: Daily avg: ${current_daily_avg:.2f}, Max per day: ${max_additional_per_day:.2f}, Remaining days: {remaining_days}", file=sys.stderr)
-                print(f"{category}: Dynamic cap: ${current_total:.2f} + (${max_additional_per_day:.2f} × {remaining_days} days) = ${max_reasonable_total:.2f}", file=sys.stderr)
-            else:
-                # Fallback if no current data
-                max_reasonable_total = current_total * 2
-                print(f"{category}: No current data for dynamic cap, using 2x current total", file=sys.stderr)
+            max_reasonable_total = dynamic_cap(stats, category, remaining_days, sketch)
             
             if predicted_total > max_reasonable_total:
-                print(f"{category}: AI prediction {predicted_total:.2f} exceeds reasonable limit {max_reasonable_total:.2f}, capping", file=sys.stderr)
+                logger.debug(f"{category}: AI prediction {predicted_total:.2f} exceeds reasonable limit {max_reasonable_total:.2f}, capping")
                 predicted_total = max_reasonable_total
             elif predicted_total < current_total:
                 # AI predicts less than current - this can happen, but ensure we don't go below current
-                print(f"{category}: AI predicts decrease, using current total as minimum", file=sys.stderr)
+                logger.debug(f"{category}: AI predicts decrease, using current total as minimum")
                 predicted_total = current_total
             else:
-                print(f"{category}: Using pure Prophet AI prediction", file=sys.stderr)
+                logger.debug(f"{category}: Using the {engine.name} engine prediction as is")
             
-            print(f"{category}: Prophet AI predicts {predicted_total:.2f} (additional: {predicted_total - current_total:.2f})", file=sys.stderr)
-            return predicted_total
+            logger.debug(f"{category}: {engine.name} engine predicts {predicted_total:.2f} (additional: {predicted_total - current_total:.2f})")
+            record_stage('cap', cap_started)
+            return Forecast(predicted_total, engine.name)
             
         except Exception as e:
-            print(f"{category}: ❌ Prophet AI failed: {str(e)}", file=sys.stderr)
-            print(f"{category}: 🔄 Falling back to mathematical projection", file=sys.stderr)
+            logger.warning(f"{category}: ❌ AI engine failed: {str(e)}")
+            logger.debug(f"{category}: 🔄 Falling back to mathematical projection")
     
     # Fallback: Smart mathematical projection
-    print(f"{category}: 📊 Using smart math projection (Prophet AI requires 3+ points with temporal diversity)", file=sys.stderr)
+    logger.debug(f"{category}: 📊 Using smart math projection (AI engines require 3+ points with temporal diversity)")
+    with stage('math'):
+        return Forecast(projection_from_stats(stats, category, remaining_days), 'math')
+
+def current_stats(current_data):
+    """The running statistics of this month's expenses that the projection and caps use"""
+    unique_dates = np.unique(day_of_month(current_data.days))
+    return CurrentStats(
+        total=float(np.sum(current_data.amounts)),
+        days_with_spending=len(unique_dates),
+        last_day_of_month=int(unique_dates.max()) if len(unique_dates) else 0,
+        latest_day=int(np.max(current_data.days)) if len(current_data.days) else None
+    )
+
+def velocity_factor(stats, category):
+    """AI velocity intelligence: how much of the model's predicted additional spending to keep,
+    based on how far into the month the latest expense is and the spending pace so far"""
+    latest_expense = date.fromordinal(stats.latest_day)
+    
+    # Calculate how far into the month we are based on expense dates
+    days_into_month = latest_expense.day
+    total_days_in_month = (latest_expense.replace(day=1) + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+    total_days_in_month = total_days_in_month.day
+    month_progress = days_into_month / total_days_in_month
+    
+    # Calculate current spending rate (daily average so far this month)
+    current_daily_rate = stats.total / max(stats.days_with_spending, 1)
+    
+    logger.debug(f"{category}: Month progress: {month_progress:.1%}, Daily rate: ${current_daily_rate:.2f}, Days active: {stats.days_with_spending}")
+    
+    if month_progress < 0.2:  # Early month (first 20%)
+        if current_daily_rate > 30:  # High spending rate early
+            logger.debug(f"{category}: Early month + high velocity = aggressive AI prediction")
+            return 1.3  # AI expects continued high spending
+        logger.debug(f"{category}: Early month + normal velocity = moderate AI increase")
+        return 1.1  # Moderate increase
+    
+    if month_progress < 0.6:  # Mid month (20-60%)
+        if current_daily_rate > 20:  # Decent spending rate
+            logger.debug(f"{category}: Mid month + good velocity = trust AI prediction")
+            return 1.0  # Trust AI prediction as-is
+        logger.debug(f"{category}: Mid month + low velocity = slightly reduce AI prediction")
+        return 0.9  # Slightly conservative
+    
+    # Late month (60%+)
+    if current_daily_rate > 15:  # Still spending late in month
+        logger.debug(f"{category}: Late month + continued spending = conservative AI")
+        return 0.8  # More conservative
+    logger.debug(f"{category}: Late month + low velocity = very conservative AI")
+    return 0.6  # Very conservative
+
+def usable_sketch(sketch):
+    """The sketch if sketch caps are on and it has seen enough days of spending, otherwise None"""
+    if not SKETCH_CAPS or sketch is None or sketch.daily.count < SKETCH_MIN_DAYS:
+        return None
+    return sketch
+
+def sketch_cap(stats, sketch, remaining_days):
+    """Highest realistic month total from the spending distribution: the current total plus, for
+    every remaining day, the chance of spending that day times a high quantile of daily totals"""
+    frequency = min(sketch.daily.count / max(sketch.span_days, 1), 1.0)
+    return stats.total + remaining_days * frequency * sketch.daily.quantile(SKETCH_CAP_QUANTILE)
+
+def spending_anomaly(stats, sketch):
+    """True when this month's daily average is above the anomaly quantile of past daily totals"""
+    if sketch is None or not stats.days_with_spending:
+        return False
+    return stats.total / stats.days_with_spending > sketch.daily.quantile(SKETCH_ANOMALY_QUANTILE)
+
+def cap_sketch(category, user_history=None, shards=None):
+    """The SpendingSketch a category's cap comes from: the user's own spending distribution, or
+    everyone's per-user one until the user's has enough days. Pooled training data sums everyone's
+    spending per day, so without shards there is none."""
+    if shards is None:
+        return None
+    if user_history is not None:
+        sketch = user_history.sketch(category)
+        if usable_sketch(sketch) is not None:
+            return sketch
+    return shards.population_sketch(category)
+
+def dynamic_cap(stats, category, remaining_days, sketch=None):
+    """Highest realistic month total: from the series' spending sketch when there is a usable
+    one, otherwise the current total plus a category-scaled daily average for every remaining
+    day (twice the current total without any expenses)"""
+    if stats.latest_day is None:
+        # Fallback if no current data
+        logger.debug(f"{category}: No current data for dynamic cap, using 2x current total")
+        return stats.total * 2
+    
+    sketch = usable_sketch(sketch)
+    if sketch is not None:
+        max_reasonable_total = sketch_cap(stats, sketch, remaining_days)
+        logger.debug(f"{category}: Sketch cap over {sketch.daily.count} days of spending: ${max_reasonable_total:.2f}")
+        return max_reasonable_total
+    
+    current_daily_avg = stats.total / max(stats.days_with_spending, 1)
+    
+    # Category-specific daily spending limits
+    if category.lower() in ['bills']:
+        max_additional_per_day = current_daily_avg * 0.3  # Bills don't repeat daily
+    elif category.lower() in ['education']:
+        max_additional_per_day = current_daily_avg * 0.2  # Education is irregular
+    elif category.lower() in ['food', 'transport']:
+        max_additional_per_day = current_daily_avg * 1.5  # Daily essentials can vary
+    elif category.lower() in ['shopping', 'entertainment']:
+        max_additional_per_day = current_daily_avg * 1.0  # Normal spending rate
+    else:
+        max_additional_per_day = current_daily_avg * 0.8  # Conservative for others
+    
+    # Dynamic cap: current total + (daily average × remaining days)
+    # This means you could theoretically spend your daily average every remaining day
+    max_reasonable_total = stats.total + max_additional_per_day * remaining_days
     
-    unique_dates = set(parse_date(expense['date']).day for expense in current_data)
-    days_with_spending = len(unique_dates)
-    days_passed = max(unique_dates) if unique_dates else 1
+    logger.debug(f"{category}: Daily avg: ${current_daily_avg:.2f}, Max per day: ${max_additional_per_day:.2f}, Remaining days: {remaining_days}")
+    logger.debug(f"{category}: Dynamic cap: ${stats.total:.2f} + (${max_additional_per_day:.2f} × {remaining_days} days) = ${max_reasonable_total:.2f}")
+    return max_reasonable_total
+
+def math_projection(current_data, category, remaining_days):
+    """Smart mathematical projection used when Prophet AI can't be used"""
+    return projection_from_stats(current_stats(current_data), category, remaining_days)
+
+def projection_from_stats(stats, category, remaining_days):
+    """math_projection from a month's running statistics (see current_stats)"""
+    current_total = stats.total
+    days_with_spending = stats.days_with_spending
+    days_passed = stats.last_day_of_month or 1
     spending_frequency = days_with_spending / days_passed
     daily_avg = current_total / max(days_with_spending, 1)
     
@@ -266,7 +377,7 @@ def predict_category(current_data, all_historical_data, category, remaining_days
             
             predicted_additional = avg_meal_cost * expected_paid_meals
             
-            print(f"{category}: Avg meal cost: ${avg_meal_cost:.2f}, Expected meals: {expected_paid_meals:.1f}", file=sys.stderr)
+            logger.debug(f"{category}: Avg meal cost: ${avg_meal_cost:.2f}, Expected meals: {expected_paid_meals:.1f}")
         else:
             # If only 1 day of food spending, estimate based on realistic meal needs
             avg_meal_cost = current_total / 2  # Assume 2 meals on that day
@@ -275,110 +386,900 @@ def predict_category(current_data, all_historical_data, category, remaining_days
             # Be slightly conservative but realistic
             predicted_additional = avg_meal_cost * remaining_meals * 0.8
             
-            print(f"{category}: Single day estimate - meal cost: ${avg_meal_cost:.2f}, meals needed: {remaining_meals}", file=sys.stderr)
+            logger.debug(f"{category}: Single day estimate - meal cost: ${avg_meal_cost:.2f}, meals needed: {remaining_meals}")
         
         # Ensure minimum daily food budget (RM15/day minimum in Malaysia)
         min_daily_food = 15
         min_additional = remaining_days * min_daily_food
         if predicted_additional < min_additional:
             predicted_additional = min_additional
-            print(f"{category}: Applied minimum food budget (RM{min_daily_food}/day)", file=sys.stderr)
+            logger.debug(f"{category}: Applied minimum food budget (RM{min_daily_food}/day)")
     else:
         expected_spending_days = remaining_days * spending_frequency * 0.8  # Slightly conservative
         predicted_additional = daily_avg * expected_spending_days
     
-    print(f"{category}: 📈 Math projection: Current ${current_total:.2f} + Additional ${predicted_additional:.2f} = ${current_total + predicted_additional:.2f}", file=sys.stderr)
+    logger.debug(f"{category}: 📈 Math projection: Current ${current_total:.2f} + Additional ${predicted_additional:.2f} = ${current_total + predicted_additional:.2f}")
     
     return current_total + predicted_additional
 
-def main():
+def resolve_workers(workers=None):
+    """Number of processes used to fit categories; 0 means one per CPU core"""
+    if workers is None:
+        workers = PREDICTOR_WORKERS
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+    return workers
+
+def get_executor(workers):
+    """Return a process pool of the requested size, reused across requests in --serve mode"""
+    global _executor, _executor_workers
+    if _executor is None or _executor_workers != workers:
+        if _executor is not None:
+            _executor.shutdown(wait=False)
+        _executor = ProcessPoolExecutor(max_workers=workers)
+        _executor_workers = workers
+    return _executor
+
+def reset_executor():
+    """Drop a pool whose worker processes died so the next request starts a fresh one"""
+    global _executor, _executor_workers
+    if _executor is not None:
+        _executor.shutdown(wait=False)
+    _executor = None
+    _executor_workers = None
+
+@contextlib.contextmanager
+def deadline_alarm(deadline):
+    """Interrupt the enclosed block with DeadlineExceeded at deadline (a time.time() value)
+    
+    Uses SIGALRM, so it only applies in a process's main thread on platforms that have it;
+    elsewhere the deadline is only checked between categories. While a CmdStan child is
+    fitting, the alarm leaves it to cmdstanpy's own timeout (see forecast_engines.fit_prophet)
+    and checks again shortly after.
+    """
+    if deadline is None or not hasattr(signal, 'setitimer') or threading.current_thread() is not threading.main_thread():
+        yield
+        return
+    remaining = deadline - time.time()
+    if remaining <= 0:
+        raise DeadlineExceeded()
+    
+    def on_alarm(signum, frame):
+        if stan_running():
+            signal.setitimer(signal.ITIMER_REAL, DEADLINE_RECHECK_SECONDS)
+            return
+        raise DeadlineExceeded()
+    
+    previous_handler = signal.signal(signal.SIGALRM, on_alarm)
+    signal.setitimer(signal.ITIMER_REAL, remaining)
     try:
-        # Debug environment information
-        print(f"🔍 Python version: {sys.version}", file=sys.stderr)
-        print(f"🔍 Current working directory: {os.getcwd()}", file=sys.stderr)
-        print(f"🔍 Available files: {os.listdir('.')}", file=sys.stderr)
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous_handler)
+
+def predict_category_safe(current_data, all_historical_data, category, remaining_days, reference_date=None, series_id=None,
+                          sketch=None, deadline=None):
+    """predict_category that falls back to the math projection instead of raising
+    
+    The returned Forecast carries the category's stage timings (fit, predict, cap, math).
+    With a deadline, a fit still running when it passes is abandoned for the math projection.
+    """
+    timer = start_category_timing()
+    try:
+        with deadline_alarm(deadline), fit_deadline(deadline):
+            forecast = predict_category(current_data, all_historical_data, category, remaining_days, reference_date, series_id,
+                                        sketch)
+    except DeadlineExceeded:
+        logger.warning(f"{category}: ⏱️ Request deadline reached before the model finished - using math projection")
+        with timer.stage('math'):
+            forecast = Forecast(math_projection(current_data, category, remaining_days), 'math', deadline_hit=True)
+    except Exception as e:
+        logger.warning(f"{category}: ❌ Prediction failed: {str(e)} - using math projection")
+        with timer.stage('math'):
+            forecast = Forecast(math_projection(current_data, category, remaining_days), 'math')
+    return forecast._replace(timings=timer.as_dict())
+
+def predict_categories_parallel(jobs, workers, deadline=None):
+    """Fit categories concurrently; results come back in the same order as jobs
+    
+    Each worker enforces the deadline on its own fit, so every future settles by then.
+    """
+    try:
+        executor = get_executor(workers)
+        futures = [executor.submit(predict_category_safe, *job, deadline=deadline) for job in jobs]
+    except Exception as e:
+        logger.warning(f"⚠️ Could not start worker pool ({e}) - predicting serially")
+        reset_executor()
+        return predict_categories_serial(jobs, deadline)
+    
+    predicted_totals = []
+    for job, future in zip(jobs, futures):
+        current_data, _, category, remaining_days = job[:4]
+        try:
+            predicted_totals.append(future.result())
+        except Exception as e:
+            # A worker crash only costs this category its model forecast
+            logger.warning(f"{category}: ❌ Worker failed: {str(e)} - using math projection")
+            if isinstance(e, BrokenProcessPool):
+                reset_executor()
+            predicted_totals.append(Forecast(math_projection(current_data, category, remaining_days), 'math'))
+    return predicted_totals
+
+def predict_categories_serial(jobs, deadline=None):
+    """Fit categories one after another in this process, in the same order as jobs
+    
+    With a deadline, every category's math projection is computed first; categories not
+    reached before the deadline keep it instead of starting a fit.
+    """
+    if deadline is None:
+        return [predict_category_safe(*job) for job in jobs]
+    
+    projections = [
+        Forecast(math_projection(current_data, category, remaining_days), 'math', {}, True)
+        for current_data, _, category, remaining_days, *_ in jobs
+    ]
+    predicted_totals = []
+    for job, projection in zip(jobs, projections):
+        if time.time() >= deadline:
+            logger.debug(f"{job[2]}: ⏱️ Request deadline passed - keeping the math projection")
+            predicted_totals.append(projection)
+        else:
+            predicted_totals.append(predict_category_safe(*job, deadline=deadline))
+    return predicted_totals
+
+def run_prediction(input_data, training_data, workers=None, user_id=None, shards=None, trace=None, deadline=None):
+    """Generate predictions for one batch of current month expense records
+    
+    Parse time and each category's stage timings are recorded on trace when one is given.
+    deadline (a time.time() value) bounds how long model fits may run; see complete_prediction.
+    """
+    trace = trace or RequestTrace(profile='')
+    plan = plan_prediction(input_data, training_data, user_id, shards, trace)
+    if batch_engine_selected():
+        # Every category is fitted in one vectorized pass, so there is nothing left to spread over processes
+        with trace.stage('batch_fit'):
+            prefit_batch(plan.jobs)
+        workers = 1
+    return complete_prediction(plan, workers, trace, deadline)
+
+def plan_prediction(input_data, training_data, user_id=None, shards=None, trace=None):
+    """Parse a request and build its per-category prediction jobs"""
+    trace = trace or RequestTrace(profile='')
+    if model_store.set_training_version(training_data_stamp()) and shards is not None:
+        # Series that left the training data would never use their warm starts again
+        warm_start_store.prune(shards.series_keys() | set(training_data.categories))
+    
+    # Parse every current month expense once into typed columns grouped by category
+    # (batch mode hands over columns it has already built)
+    with trace.stage('parse'):
+        request = input_data if isinstance(input_data, TrainingColumns) else TrainingColumns.from_records(input_data)
+    
+    # Calculate remaining days in month based on the latest expense date (context-aware)
+    if len(request):
+        # Find the latest expense date to use as our "current" reference point
+        reference_date = datetime.fromordinal(int(np.max(request.days)))
+        logger.debug(f"Using latest expense date as reference: {reference_date.strftime('%Y-%m-%d')}")
+    else:
+        # Fallback to actual current date if no expense data
+        reference_date = datetime.now()
+        logger.debug(f"Using actual current date as reference: {reference_date.strftime('%Y-%m-%d')}")
+    
+    # Calculate remaining days from reference date to end of month
+    last_day_of_month = (reference_date.replace(day=1) + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+    remaining_days = (last_day_of_month - reference_date).days
+    
+    logger.debug(f"Days remaining in {reference_date.strftime('%B')} from reference date: {remaining_days}")
+    
+    # Optionally restrict training history to the last N months before the reference date
+    history_since_day = None
+    if HISTORY_MONTHS > 0:
+        history_since_day = date_to_ordinal(reference_date - timedelta(days=HISTORY_MONTHS * 30))
+        logger.debug(f"Using training history since {(reference_date - timedelta(days=HISTORY_MONTHS * 30)).strftime('%Y-%m-%d')} ({HISTORY_MONTHS} months)")
+    
+    # The engines only see per-day totals, so the daily rollups give the same series from a
+    # table bounded by days rather than by transactions
+    use_rollups = ROLLUPS and fits_daily_totals()
+    
+    # Build one prediction job per category
+    ai_prediction_count = 0
+    fallback_count = 0
+    jobs = []
+    available_points = {}
+    reference_day = date_to_ordinal(reference_date)
+    
+    # With per-user shards, train on the requesting user's own history instead of everyone's
+    user_history = None
+    if user_id is not None and shards is not None:
+        user_history = shards.for_user(user_id)
+        logger.debug(f"Using per-user training history for user {user_id} (global blend: {GLOBAL_BLEND})")
+    
+    for category in request.categories:
+        current_expenses = request.history(category)
+        # Get all historical data for this category (current + training)
+        if user_history is not None:
+            if use_rollups:
+                category_training_data = user_history.daily_history(category, since_day=history_since_day)
+            else:
+                category_training_data = user_history.history(category, since_day=history_since_day)
+            own_points = history_points(category_training_data) + len(current_expenses.days)
+            if GLOBAL_BLEND == 'always' or (GLOBAL_BLEND == 'fallback' and own_points < 3):
+                # Blend in the average user's daily spending in this category
+                global_daily = training_data.daily_totals(category, since_day=history_since_day)
+                global_daily = History(global_daily.days, global_daily.amounts / max(shards.users, 1))
+                logger.debug(f"🔍 {category}: blending {len(global_daily.days)} days of global per-user average spending")
+                category_training_data = concat_histories(category_training_data, global_daily)
+        elif use_rollups:
+            category_training_data = training_data.daily_history(category, since_day=history_since_day)
+        else:
+            category_training_data = training_data.history(category, since_day=history_since_day)
+        sketch = cap_sketch(category, user_history, shards)
         
-        # Read current month data
-        input_data = json.loads(sys.stdin.read())
-        print(f"Received {len(input_data)} current expense records", file=sys.stderr)
+        logger.debug(f"🔍 {category} training data: {history_points(category_training_data)} records in {len(category_training_data.days)} rows")
+        logger.debug(f"🔍 {category} current data: {len(current_expenses.days)} records")
         
-        # Load training data for AI
-        training_data = load_training_data()
-        print(f"Using {len(training_data)} historical records + {len(input_data)} current records", file=sys.stderr)
+        # Bound the fit: per-day totals and down-sampling to the point cap (see history_selection.py),
+        # leaving room for this month's expenses, which are always used whole
+        available_points[category] = history_points(category_training_data) + len(current_expenses.days)
+        with trace.stage('select'):
+            training_cap = max(HISTORY_MAX_POINTS - len(current_expenses.days), 1) if HISTORY_MAX_POINTS > 0 else 0
+            category_training_data = select_history(category_training_data, reference_day, training_cap)
         
-        # Group current month expenses by category
-        categories = {}
-        for record in input_data:
-            category = record['category']
-            if category not in categories:
-                categories[category] = []
-            categories[category].append(record)
+        category_historical = concat_histories(current_expenses, category_training_data)
         
-        # Calculate remaining days in month based on the latest expense date (context-aware)
-        if input_data:
-            # Find the latest expense date to use as our "current" reference point
-            latest_expense_date = max(parse_date(record['date']) for record in input_data)
-            reference_date = latest_expense_date
-            print(f"Using latest expense date as reference: {reference_date.strftime('%Y-%m-%d')}", file=sys.stderr)
+        logger.debug(f"🔍 {category} total historical: {history_points(category_historical)} records")
+        
+        # Track what method is used for metrics
+        data_point_count = history_points(category_historical)
+        will_use_ai = data_point_count >= 3
+        if will_use_ai:
+            ai_prediction_count += 1
         else:
-            # Fallback to actual current date if no expense data
-            reference_date = datetime.now()
-            print(f"Using actual current date as reference: {reference_date.strftime('%Y-%m-%d')}", file=sys.stderr)
+            fallback_count += 1
+            
+        logger.debug(f"Predicting {category}: {data_point_count} data points, using {'AI' if will_use_ai else 'fallback'}")
+        
+        jobs.append((
+            current_expenses, 
+            category_historical, 
+            category, 
+            remaining_days,
+            reference_date,
+            user_category_key(user_id, category) if user_id is not None else category,
+            usable_sketch(sketch)
+        ))
+    
+    return PredictionPlan(jobs, reference_date, remaining_days, ai_prediction_count, fallback_count, available_points)
+
+def prefit_batch(jobs):
+    """Fit every job's series with the batch engine at once; predict_category then picks up the results"""
+    series = []
+    for current_data, all_historical_data, category, remaining_days, reference_date, series_id, _ in jobs:
+        if remaining_days <= 0 or len(np.unique(all_historical_data.days)) < 2:
+            continue
+        future_dates = [reference_date + timedelta(days=i) for i in range(1, remaining_days + 1)]
+        series.append((series_id, prepare_series(all_historical_data), future_dates))
+    return ENGINES['batch'].fit_many(series)
+
+def complete_prediction(plan, workers=None, trace=None, deadline=None):
+    """Run a plan's jobs and return (predictions, meta) in input category order
+    
+    With a deadline, categories whose model fit could not finish in time get the math
+    projection instead; they are tagged method 'math' with deadline_hit in the metadata.
+    """
+    trace = trace or RequestTrace(profile='')
+    jobs, reference_date, remaining_days = plan.jobs, plan.reference_date, plan.remaining_days
+    predictions = {}
+    
+    workers = resolve_workers(workers)
+    if workers > 1 and len(jobs) > 1:
+        logger.debug(f"⚡ Fitting {len(jobs)} categories across {workers} worker processes")
+        predicted_totals = predict_categories_parallel(jobs, workers, deadline)
+    else:
+        predicted_totals = predict_categories_serial(jobs, deadline)
+    
+    # Merge in input order so the output is the same whichever mode produced it
+    category_meta = {}
+    deadline_hits = 0
+    ai_deadline_hits = 0
+    for job, forecast in zip(jobs, predicted_totals):
+        predictions[job[2]] = round(forecast.total, 2)
+        points = history_points(job[1])
+        category_meta[job[2]] = {
+            'method': forecast.method,
+            'points': points,
+            'points_available': (plan.available_points or {}).get(job[2], points),
+            'rows': len(job[1].days),
+        }
+        if job[6] is not None:
+            category_meta[job[2]]['sketch'] = {
+                'days': job[6].daily.count,
+                'cap_quantile': round(job[6].daily.quantile(SKETCH_CAP_QUANTILE), 2),
+                'anomaly': spending_anomaly(current_stats(job[0]), job[6]),
+            }
+        if forecast.deadline_hit:
+            category_meta[job[2]]['deadline_hit'] = True
+            deadline_hits += 1
+            # Planned for a model (see plan_prediction) but cut short
+            if points >= 3:
+                ai_deadline_hits += 1
+        trace.add_category(job[2], forecast.method, forecast.timings)
+    
+    logger.info(f"Prediction complete: {plan.ai_count - ai_deadline_hits} categories used AI, {plan.fallback_count} used fallback, "
+                f"{ai_deadline_hits} fell back to math at the deadline")
+    meta = {
+        'reference_date': reference_date.strftime('%Y-%m-%d'),
+        'remaining_days': remaining_days,
+        'categories': category_meta,
+        'history': selection_summary(category_meta),
+    }
+    if deadline is not None:
+        meta['deadline_hits'] = deadline_hits
+    return predictions, meta
+
+def load_training_shards():
+    """Open the per-user shard manifest if the generator wrote one"""
+    try:
+        if os.path.exists(os.path.join(TRAINING_SHARDS_DIR, 'manifest.json')):
+            shards = TrainingShards.open(TRAINING_SHARDS_DIR)
+            logger.info(f"✅ Per-user training shards available for {shards.users} users")
+            return shards
+    except Exception as e:
+        logger.warning(f"⚠️ Error opening per-user training shards: {e} - using pooled history")
+    return None
+
+def parse_request(payload):
+    """Split a request into (records, user_id, with_meta, profile, deadline_ms); a bare list of records has no user"""
+    if isinstance(payload, dict):
+        return (payload.get('records', []), payload.get('user_id'), bool(payload.get('meta')), payload.get('profile'),
+                payload.get('deadline_ms'))
+    return payload, None, False, None, None
+
+def request_deadline(started, deadline_ms=None):
+    """Absolute time.time() deadline for a request started at `started`, or None without a budget"""
+    if deadline_ms is None:
+        deadline_ms = DEADLINE_MS
+    deadline_ms = float(deadline_ms)
+    return started + deadline_ms / 1000 if deadline_ms > 0 else None
+
+def request_columns(input_data):
+    """A request's records as typed columns (the binary protocol already delivers them that way)"""
+    return input_data if isinstance(input_data, TrainingColumns) else TrainingColumns.from_records(input_data)
+
+def request_reference_date(request):
+    """The date a request is forecast from: its latest expense, or today without any"""
+    return (date.fromordinal(int(np.max(request.days))) if len(request) else date.today()).isoformat()
+
+def prediction_config():
+    """The predictor settings that change forecasts, for cache keys and batch resume headers"""
+    return dict(engine_config(), history_months=HISTORY_MONTHS, global_blend=GLOBAL_BLEND, rollups=ROLLUPS,
+                history_selection=selection_config(), sketch_caps=[SKETCH_CAPS, SKETCH_MIN_DAYS, SKETCH_CAP_QUANTILE],
+                model_config_version=MODEL_CONFIG_VERSION)
+
+def cached_prediction(request, user_id, compute):
+    """compute()'s (predictions, meta), reused from the result cache for identical requests"""
+    key = request_key(request, user_id, training_data_stamp(), request_reference_date(request), prediction_config())
+    # Results cut short by a deadline are not kept, so the next refresh can get the full forecast
+    return result_cache.get_or_compute(key, compute, cacheable=lambda result: not result[1].get('deadline_hits'))
+
+def format_output(predictions, meta, with_meta, wire='json'):
+    """Predictions alone (the default), or wrapped together with the run metadata, as a JSON
+    string or (wire='msgpack') a msgpack frame body"""
+    payload = {'predictions': predictions, 'meta': meta} if with_meta else predictions
+    if wire == 'msgpack':
+        return encode_response(payload)
+    return json.dumps(payload)
+
+def training_data_stamp():
+    """Return a (mtime, size) stamp used to detect regenerated training data"""
+    store_meta = os.path.join(TRAINING_STORE_DIR, 'meta.json')
+    try:
+        stat = os.stat(store_meta if os.path.exists(store_meta) else TRAINING_DATA_FILE)
+        return (stat.st_mtime_ns, stat.st_size)
+    except OSError:
+        return None
+
+# Request keys handled by the incremental state (see PredictionWorker.handle_state)
+STATE_REQUEST_KEYS = ('event', 'events', 'refresh')
+
+def is_state_request(payload):
+    return isinstance(payload, dict) and any(key in payload for key in STATE_REQUEST_KEYS)
+
+class PredictionWorker:
+    """Long-lived predictor that keeps imports and training data in memory between requests"""
+    
+    def __init__(self, workers=None, with_meta=False, profile=None, deadline_ms=None, wire='json'):
+        self.workers = workers
+        self.with_meta = with_meta
+        self.profile = profile
+        self.deadline_ms = deadline_ms
+        self.wire = wire
+        self.training_data = []
+        self.shards = None
+        self.training_stamp = None
+        self.requests_served = 0
+        self.state = None
+        self.refresh_training_data()
         
-        # Calculate remaining days from reference date to end of month
-        last_day_of_month = (reference_date.replace(day=1) + timedelta(days=32)).replace(day=1) - timedelta(days=1)
-        remaining_days = (last_day_of_month - reference_date).days
+        # Instantiating a model loads Prophet and the Stan backend once, so the first request doesn't pay for it
+        try:
+            from prophet import Prophet
+            quiet_library_loggers()
+            Prophet()
+        except Exception as e:
+            logger.warning(f"⚠️ Could not warm up Prophet backend: {e}")
+    
+    def refresh_training_data(self):
+        """Reload training data only when the file on disk has changed"""
+        stamp = training_data_stamp()
+        if stamp != self.training_stamp:
+            self.training_data = load_training_data()
+            self.shards = load_training_shards()
+            self.training_stamp = stamp
+    
+    def handle_state(self, payload, trace):
+        """Answer a transaction event request from the incremental state (see incremental_state.py)
+
+        {"event": {...}} returns the figures of the user month the event changed, {"events": [...]}
+        returns {"updates": [...]} for every month changed. {"refresh": true} reruns the full
+        prediction for the stale months of "user_id" (or of every user without one).
+        """
+        if self.state is None:
+            from incremental_state import IncrementalState
+            self.state = IncrementalState()
+        # Caps come from the same shard sketches as the full prediction's
+        with trace.stage('load'):
+            self.refresh_training_data()
+        self.state.use_shards(self.shards)
+        if 'event' in payload:
+            with trace.stage('state'):
+                updates = self.state.apply_events([payload['event']])
+            return updates[0] if updates else {}
+        if 'events' in payload:
+            with trace.stage('state'):
+                return {'updates': self.state.apply_events(payload['events'])}
         
-        print(f"Days remaining in {reference_date.strftime('%B')} from reference date: {remaining_days}", file=sys.stderr)
+        user_id = payload.get('user_id')
+        stale = [key for key in self.state.stale() if user_id is None or key[0] == str(user_id)]
         
-        # Generate AI predictions for each category
-        predictions = {}
-        ai_prediction_count = 0
-        fallback_count = 0
+        def predict(month_id):
+            return lambda request: run_prediction(request, self.training_data, self.workers, month_id, self.shards, trace)
         
-        for category, current_expenses in categories.items():
-            # Get all historical data for this category (current + training)
-            category_training_data = [
-                record for record in training_data 
-                if record['category'] == category
-            ]
-            
-            print(f"🔍 {category} training data: {len(category_training_data)} records", file=sys.stderr)
-            print(f"🔍 {category} current data: {len(current_expenses)} records", file=sys.stderr)
-            
-            category_historical = current_expenses + category_training_data
+        return {'updates': [self.state.refresh(month_user, month_start, predict(month_user))
+                            for month_user, month_start in stale]}
+    
+    def handle(self, message):
+        """Answer one request (a JSON line, or a msgpack frame body with wire='msgpack') with the
+        same output main() prints"""
+        started = time.time()
+        with_meta = self.with_meta
+        trace = RequestTrace(self.profile)
+        try:
+            with trace.stage('parse'):
+                payload = decode_request(message) if self.wire == 'msgpack' else json.loads(message)
+            if is_state_request(payload):
+                answer = self.handle_state(payload, trace)
+                self.requests_served += 1
+                emit_trace(trace.finish())
+                return encode_response(answer) if self.wire == 'msgpack' else json.dumps(answer)
+            with trace.stage('parse'):
+                input_data, user_id, request_meta, profile, deadline_ms = parse_request(payload)
+                request = request_columns(input_data)
+            trace.start_profiling(profile)
+            with_meta = with_meta or request_meta
+            deadline = request_deadline(started, deadline_ms if deadline_ms is not None else self.deadline_ms)
             
-            print(f"🔍 {category} total historical: {len(category_historical)} records", file=sys.stderr)
+            def compute():
+                with trace.stage('load'):
+                    self.refresh_training_data()
+                return run_prediction(request, self.training_data, self.workers, user_id, self.shards, trace, deadline)
             
-            # Track what method is used for metrics
-            data_point_count = len(category_historical)
-            will_use_ai = data_point_count >= 3
-            if will_use_ai:
-                ai_prediction_count += 1
+            predictions, meta = cached_prediction(request, user_id, compute)
+        except Exception as e:
+            logger.error(f"Error in prediction: {str(e)}")
+            import traceback
+            logger.error(f"Stacktrace: {traceback.format_exc()}")
+            predictions, meta = {}, {'error': str(e)}
+        self.requests_served += 1
+        with trace.stage('serialize'):
+            output = format_output(predictions, meta, with_meta, self.wire)
+        emit_trace(trace.finish())
+        return output
+
+def serve_frames(worker, rfile, wfile):
+    """Answer length-prefixed msgpack requests from a binary stream until it ends"""
+    while True:
+        body = read_frame(rfile)
+        if body is None:
+            return
+        write_frame(wfile, worker.handle(body))
+
+def serve_stdio(worker):
+    """Answer newline-delimited JSON requests (or msgpack frames) from stdin until EOF"""
+    logger.info(f"🚀 Prediction worker ready on stdin/stdout ({worker.wire})")
+    if worker.wire == 'msgpack':
+        serve_frames(worker, sys.stdin.buffer, sys.stdout.buffer)
+        return
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        sys.stdout.write(worker.handle(line) + '\n')
+        sys.stdout.flush()
+
+def serve_socket(worker, socket_path):
+    """Answer newline-delimited JSON requests (or msgpack frames) on a local Unix socket"""
+    import socketserver
+    
+    class PredictionHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            if worker.wire == 'msgpack':
+                serve_frames(worker, self.rfile, self.wfile)
+                return
+            for raw_line in self.rfile:
+                line = raw_line.decode('utf-8')
+                if not line.strip():
+                    continue
+                self.wfile.write((worker.handle(line) + '\n').encode('utf-8'))
+                self.wfile.flush()
+    
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    
+    # Requests are handled one at a time so concurrent fits don't compete for the same cores
+    with socketserver.UnixStreamServer(socket_path, PredictionHandler) as server:
+        logger.info(f"🚀 Prediction worker listening on {socket_path} ({worker.wire})")
+        try:
+            server.serve_forever()
+        finally:
+            os.unlink(socket_path)
+
+def read_batch_rows(input_file, chunk_size=None):
+    """Stream newline-delimited {user_id, date, category, amount} records as column chunks"""
+    chunk_size = chunk_size or BATCH_CHUNK_SIZE
+    
+    def to_chunk(records):
+        return (
+            [record['category'] for record in records],
+            parse_days([record['date'] for record in records]),
+            np.fromiter((float(record['amount']) for record in records), dtype=np.float64, count=len(records)),
+            [record['user_id'] for record in records]
+        )
+    
+    f = sys.stdin if input_file == '-' else open(input_file, 'r')
+    try:
+        records = []
+        for line in f:
+            if not line.strip():
+                continue
+            records.append(json.loads(line))
+            if len(records) >= chunk_size:
+                yield to_chunk(records)
+                records = []
+        if records:
+            yield to_chunk(records)
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+def read_batch_rows_from_db(chunk_size=None):
+    """Stream every user's current month expenses with the training data export query"""
+    from generate_training_data import connect_to_db, fetch_historical_data
+    
+    conn = connect_to_db()
+    try:
+        month_start = datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        for chunk in fetch_historical_data(conn, chunk_size=chunk_size or BATCH_CHUNK_SIZE, start_date=month_start):
+            yield chunk.categories, chunk.days, chunk.amounts, chunk.user_ids
+    finally:
+        conn.close()
+
+def group_rows_by_user(chunks):
+    """Collect streamed column chunks into one TrainingColumns request per user"""
+    categories, days, amounts, user_ids = [], [], [], []
+    for chunk_categories, chunk_days, chunk_amounts, chunk_user_ids in chunks:
+        categories.extend(chunk_categories)
+        days.append(np.asarray(chunk_days, dtype=np.int32))
+        amounts.append(np.asarray(chunk_amounts, dtype=np.float64))
+        user_ids.extend(str(user_id) for user_id in chunk_user_ids)
+    if not user_ids:
+        return {}
+    
+    days = np.concatenate(days)
+    amounts = np.concatenate(amounts)
+    users = list(dict.fromkeys(user_ids))
+    user_index = {user_id: i for i, user_id in enumerate(users)}
+    user_codes = np.fromiter((user_index[user_id] for user_id in user_ids), dtype=np.int64, count=len(user_ids))
+    
+    # Stable sort keeps each user's rows in input order, so categories keep first-appearance order
+    order = np.argsort(user_codes, kind='stable')
+    bounds = np.searchsorted(user_codes[order], np.arange(len(users) + 1))
+    requests = {}
+    for i, user_id in enumerate(users):
+        rows = order[bounds[i]:bounds[i + 1]]
+        user_categories = [categories[row] for row in rows]
+        names = list(dict.fromkeys(user_categories))
+        name_index = {name: code for code, name in enumerate(names)}
+        codes = np.fromiter((name_index[name] for name in user_categories), dtype=np.int32, count=len(rows))
+        requests[user_id] = TrainingColumns(names, codes, days[rows], amounts[rows])
+    return requests
+
+def init_batch_worker():
+    """Load training data once per batch worker process"""
+    global _batch_training_data, _batch_shards
+    _batch_training_data = load_training_data()
+    _batch_shards = load_training_shards()
+
+def predict_user_batch(user_id, request):
+    """Forecast one user's categories inside a batch worker, returned as an output record"""
+    try:
+        predictions, meta = run_prediction(request, _batch_training_data, 1, user_id, _batch_shards)
+    except Exception as e:
+        logger.error(f"❌ Batch prediction failed for user {user_id}: {e}")
+        predictions, meta = {}, {'error': str(e)}
+    return {'user_id': user_id, 'predictions': predictions, 'meta': meta}
+
+def predict_users_batch(users):
+    """Forecast several users' categories with one batch engine pass, returned as output records"""
+    if not batch_engine_selected():
+        return [predict_user_batch(user_id, request) for user_id, request in users]
+    
+    plans = {}
+    results = {}
+    for user_id, request in users:
+        try:
+            plans[user_id] = plan_prediction(request, _batch_training_data, user_id, _batch_shards)
+        except Exception as e:
+            logger.error(f"❌ Batch prediction failed for user {user_id}: {e}")
+            results[user_id] = {'user_id': user_id, 'predictions': {}, 'meta': {'error': str(e)}}
+    
+    # Series keys include the user, so every user's categories can share the pass
+    try:
+        prefit_batch([job for plan in plans.values() for job in plan.jobs])
+    except Exception as e:
+        logger.warning(f"⚠️ Batch engine pass failed ({e}) - fitting each series on its own")
+    
+    for user_id, plan in plans.items():
+        try:
+            predictions, meta = complete_prediction(plan, 1)
+        except Exception as e:
+            logger.error(f"❌ Batch prediction failed for user {user_id}: {e}")
+            predictions, meta = {}, {'error': str(e)}
+        results[user_id] = {'user_id': user_id, 'predictions': predictions, 'meta': meta}
+    return [results[user_id] for user_id, _ in users]
+
+def batch_header(input_file=None):
+    """What a batch's results depend on: its input (path, mtime and size, or the database),
+    the month, the training data and the predictor settings"""
+    header = {'input': 'database'}
+    if input_file == '-':
+        header['input'] = '-'
+    elif input_file:
+        stat = os.stat(input_file)
+        header.update(input=os.path.abspath(input_file), input_mtime_ns=stat.st_mtime_ns, input_size=stat.st_size)
+    header.update(month=datetime.now().strftime('%Y-%m'), training=training_data_stamp(), config=prediction_config())
+    # As it reads back from the file (tuples become lists)
+    return json.loads(json.dumps(header))
+
+def load_completed_users(partial_file, header):
+    """User ids already written by an interrupted run of the same batch; a torn last line is cut off
+    
+    A partial file whose header doesn't match (another input, month, training data or engine),
+    or any partial file of a batch read from stdin, is discarded.
+    """
+    completed = set()
+    if not os.path.exists(partial_file):
+        return completed
+    with open(partial_file, 'rb') as f:
+        first_line = f.readline()
+    try:
+        stored = json.loads(first_line).get(BATCH_HEADER_KEY) if first_line.endswith(b'\n') else None
+    except (ValueError, AttributeError):
+        stored = None
+    if stored != header or header['input'] == '-':
+        logger.warning(f"⚠️ Discarding {partial_file}: it was not written by this batch (input, month, training data or settings differ)")
+        os.remove(partial_file)
+        return completed
+    
+    good_bytes = len(first_line)
+    with open(partial_file, 'rb') as f:
+        f.readline()
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            try:
+                completed.add(str(json.loads(line)['user_id']))
+            except (ValueError, KeyError):
+                break
+            good_bytes += len(line)
+    with open(partial_file, 'r+b') as f:
+        f.truncate(good_bytes)
+    return completed
+
+def finish_batch(partial_file, output_file):
+    """Move a finished batch's results to output_file, leaving the header line behind"""
+    tmp_path = f"{output_file}.{os.getpid()}.tmp"
+    with open(partial_file, 'rb') as partial, open(tmp_path, 'wb') as out:
+        partial.readline()
+        shutil.copyfileobj(partial, out)
+    os.replace(tmp_path, output_file)
+    os.remove(partial_file)
+
+def run_batch(output_file, input_file=None, workers=None):
+    """Precompute every user's forecasts into an NDJSON file, one {user_id, predictions, meta} per line
+    
+    Results are appended to OUTPUT.partial as each user finishes, so a crashed run picks up
+    where it stopped; they move to OUTPUT once every user is done. The partial file starts
+    with a batch_header() line, and a run only resumes one written for the same batch.
+    """
+    started = time.perf_counter()
+    rows = read_batch_rows(input_file) if input_file else read_batch_rows_from_db()
+    # The export query logs to stdout; keep stdout for the batch summary
+    with contextlib.redirect_stdout(sys.stderr):
+        requests = group_rows_by_user(rows)
+    logger.info(f"📥 Batch input: {sum(len(r) for r in requests.values())} expenses for {len(requests)} users")
+    
+    partial_file = f"{output_file}.partial"
+    header = batch_header(input_file)
+    completed = load_completed_users(partial_file, header)
+    if completed:
+        logger.info(f"↩️ Resuming batch: {len(completed)} users already done in {partial_file}")
+    elif not os.path.exists(partial_file):
+        with open(partial_file, 'w') as f:
+            f.write(json.dumps({BATCH_HEADER_KEY: header}) + '\n')
+    pending = [(user_id, request) for user_id, request in requests.items() if user_id not in completed]
+    
+    workers = resolve_workers(workers)
+    # With the batch engine, each job fits a group of users' series together
+    users_per_job = max(BATCH_ENGINE_USERS, 1) if batch_engine_selected() else 1
+    jobs = [pending[i:i + users_per_job] for i in range(0, len(pending), users_per_job)]
+    users_done = 0
+    series_done = 0
+    fit_started = time.perf_counter()
+    last_report = fit_started
+    
+    def report(final=False):
+        elapsed = time.perf_counter() - fit_started
+        rate = series_done / elapsed if elapsed > 0 else 0.0
+        remaining = len(pending) - users_done
+        eta = remaining * elapsed / users_done if users_done else 0.0
+        label = 'Batch complete' if final else 'Batch progress'
+        logger.info(f"📊 {label}: {users_done}/{len(pending)} users, {series_done} series, {rate:.1f} series/sec, ETA {eta:.0f}s")
+        return rate
+    
+    with open(partial_file, 'a') as out:
+        def write_results(results):
+            nonlocal users_done, series_done, last_report
+            for result in results:
+                out.write(json.dumps(result) + '\n')
+                users_done += 1
+                series_done += len(result['predictions'])
+            out.flush()
+            if time.perf_counter() - last_report >= BATCH_PROGRESS_SECONDS:
+                last_report = time.perf_counter()
+                report()
+        
+        if workers > 1 and len(jobs) > 1:
+            logger.info(f"⚡ Forecasting {len(pending)} users across {workers} worker processes")
+            with ProcessPoolExecutor(max_workers=workers, initializer=init_batch_worker) as executor:
+                # Keep a bounded number of jobs in flight so huge batches don't queue every request at once
+                in_flight = set()
+                for users in jobs:
+                    in_flight.add(executor.submit(predict_users_batch, users))
+                    if len(in_flight) >= workers * 4:
+                        done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            write_results(future.result())
+                for future in as_completed(in_flight):
+                    write_results(future.result())
+        else:
+            init_batch_worker()
+            for users in jobs:
+                write_results(predict_users_batch(users))
+    
+    series_per_sec = report(final=True)
+    finish_batch(partial_file, output_file)
+    summary = {
+        'output': output_file,
+        'users': len(requests),
+        'users_predicted': users_done,
+        'users_resumed': len(completed),
+        'series': series_done,
+        'seconds': round(time.perf_counter() - started, 3),
+        'series_per_sec': round(series_per_sec, 1),
+    }
+    logger.info(f"✅ Batch forecasts written to {output_file}")
+    return summary
+
+def parse_args(argv=None):
+    """Parse command line options"""
+    import argparse
+    parser = argparse.ArgumentParser(description='CloudExpense AI expense predictor')
+    parser.add_argument('--serve', action='store_true',
+                        help='Run as a long-lived worker answering newline-delimited JSON requests')
+    parser.add_argument('--socket', metavar='PATH',
+                        help='With --serve, listen on this Unix socket instead of stdin/stdout')
+    parser.add_argument('--user-id', default=None,
+                        help='Train on this user\'s per-user history shard instead of pooled history')
+    parser.add_argument('--meta', action='store_true',
+                        help='Print {"predictions": ..., "meta": ...} including the engine used per category')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Processes used to fit categories concurrently (default PREDICTOR_WORKERS or 1, 0 = all cores)')
+    parser.add_argument('--profile', choices=['cprofile', 'tracemalloc', 'all'], default=None,
+                        help='Profile each request and write the dumps to PREDICTOR_PROFILE_DIR (default PREDICTOR_PROFILE)')
+    parser.add_argument('--deadline-ms', type=float, default=None,
+                        help='Latency budget per request; slower model fits fall back to the math projection (default PREDICTOR_DEADLINE_MS, 0 = none)')
+    parser.add_argument('--wire', choices=WIRE_FORMATS, default='json',
+                        help='Request/response encoding: JSON, or length-prefixed msgpack frames with typed columns (see wire.py)')
+    parser.add_argument('--batch', metavar='OUTPUT',
+                        help='Precompute every user\'s current month forecasts into this NDJSON file')
+    parser.add_argument('--batch-input', metavar='FILE',
+                        help='With --batch, read NDJSON {user_id, date, category, amount} records from FILE (- for stdin) instead of the database')
+    return parser.parse_args(argv)
+
+def main(workers=None, user_id=None, with_meta=False, profile=None, deadline_ms=None, wire='json'):
+    started = time.time()
+    trace = RequestTrace(profile)
+    try:
+        # Debug environment information
+        logger.debug(f"🔍 Python version: {sys.version}")
+        logger.debug(f"🔍 Current working directory: {os.getcwd()}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"🔍 Available files: {os.listdir('.')}")
+        
+        # Read current month data
+        with trace.stage('parse'):
+            if wire == 'msgpack':
+                body = read_frame(sys.stdin.buffer)
+                if body is None:
+                    raise ValueError("No request frame on stdin")
+                payload = decode_request(body)
             else:
-                fallback_count += 1
-                
-            print(f"Predicting {category}: {data_point_count} data points, using {'AI' if will_use_ai else 'fallback'}", file=sys.stderr)
-            
-            predicted_total = predict_category(
-                current_expenses, 
-                category_historical, 
-                category, 
-                remaining_days,
-                reference_date
-            )
-            predictions[category] = round(predicted_total, 2)
+                payload = json.loads(sys.stdin.read())
+            input_data, request_user_id, request_meta, request_profile, request_deadline_ms = parse_request(payload)
+            request = request_columns(input_data)
+        trace.start_profiling(request_profile)
+        if user_id is None:
+            user_id = request_user_id
+        with_meta = with_meta or request_meta
+        deadline = request_deadline(started, request_deadline_ms if request_deadline_ms is not None else deadline_ms)
+        logger.debug(f"Received {len(request)} current expense records")
+        
+        def compute():
+            # Load training data for AI
+            with trace.stage('load'):
+                training_data = load_training_data()
+                shards = load_training_shards() if user_id is not None else None
+            logger.debug(f"Using {len(training_data)} historical records + {len(request)} current records")
+            return run_prediction(request, training_data, workers, user_id, shards, trace, deadline)
+        
+        # Identical requests (a refreshed reports page) are answered from the result cache
+        predictions, meta = cached_prediction(request, user_id, compute)
         
-        # Output results with metrics
-        print(f"Prediction complete: {ai_prediction_count} categories used AI, {fallback_count} used fallback", file=sys.stderr)
-        print(json.dumps(predictions))
+        # Output results
+        with trace.stage('serialize'):
+            output = format_output(predictions, meta, with_meta, wire)
         
     except Exception as e:
-        print(f"Error in prediction: {str(e)}", file=sys.stderr)
+        logger.error(f"Error in prediction: {str(e)}")
         # Include stacktrace for better debugging
         import traceback
-        print(f"Stacktrace: {traceback.format_exc()}", file=sys.stderr)
-        print(json.dumps({}))  # Return empty predictions on error
+        logger.error(f"Stacktrace: {traceback.format_exc()}")
+        output = format_output({}, {}, False, wire)  # Return empty predictions on error
+    if wire == 'msgpack':
+        write_frame(sys.stdout.buffer, output)
+    else:
+        print(output)
+    emit_trace(trace.finish())
 
 if __name__ == "__main__":
-    main()
+    args = parse_args()
+    if args.batch:
+        print(json.dumps(run_batch(args.batch, args.batch_input, args.workers)))
+    elif args.serve:
+        worker = PredictionWorker(args.workers, args.meta, args.profile, args.deadline_ms, args.wire)
+        if args.socket:
+            serve_socket(worker, args.socket)
+        else:
+            serve_stdio(worker)
+    else:
+        main(args.workers, args.user_id, args.meta, args.profile, args.deadline_ms, args.wire)
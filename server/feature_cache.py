@@ -0,0 +1,79 @@
+"""
+On-disk holiday table cache for Prophet fits
+============================================
+
+Prophet's add_country_holidays() regenerates the holiday calendar from the `holidays`
+package on every fit and every predict. Instead, the calendar for a range of years is
+generated once, written to HOLIDAY_CACHE_DIR as JSON, and shared by every fit and
+every process; ProphetEngine passes the rows for the years it needs as Prophet's
+`holidays` table, which gives the same holiday features.
+
+pandas and Prophet are imported only when a table is built, so importing this module
+stays cheap for requests that never reach a Prophet fit.
+"""
+
+import os
+import json
+from datetime import date
+
+from atomic_file import atomic_write
+from instrumentation import get_logger
+
+logger = get_logger('predictor.feature_cache')
+
+HOLIDAY_CACHE_DIR = os.environ.get('HOLIDAY_CACHE_DIR', 'feature_cache')
+
+# Years covered when the cache is first built; later years extend it on demand
+HOLIDAY_CACHE_FIRST_YEAR = int(os.environ.get('HOLIDAY_CACHE_FIRST_YEAR', '2015'))
+HOLIDAY_CACHE_YEARS_AHEAD = 2
+
+_tables = {}
+
+def _cache_path(country, cache_dir):
+    return os.path.join(cache_dir, f"holidays_{country}.json")
+
+def build_holiday_rows(country, first_year, last_year):
+    """[ds, holiday] rows of a country's holidays, as Prophet's make_holidays_df lists them"""
+    from prophet.make_holidays import make_holidays_df
+    df = make_holidays_df(year_list=list(range(first_year, last_year + 1)), country=country)
+    return [[ds.strftime('%Y-%m-%d'), name] for ds, name in zip(df['ds'], df['holiday'])]
+
+def load_holiday_rows(country, years, cache_dir=None):
+    """Cached holiday rows for a country, rebuilt when years fall outside the cached range"""
+    cache_dir = cache_dir or HOLIDAY_CACHE_DIR
+    table = _tables.get((country, cache_dir))
+    if table is None:
+        try:
+            with open(_cache_path(country, cache_dir), 'r') as f:
+                table = json.load(f)
+        except (OSError, ValueError):
+            table = None
+
+    if table is None or min(years) < table['first_year'] or max(years) > table['last_year']:
+        first_year = min([HOLIDAY_CACHE_FIRST_YEAR] + list(years))
+        last_year = max([date.today().year + HOLIDAY_CACHE_YEARS_AHEAD] + list(years))
+        logger.info(f"📅 Building {country} holiday cache for {first_year}-{last_year}")
+        table = {
+            'country': country,
+            'first_year': first_year,
+            'last_year': last_year,
+            'rows': build_holiday_rows(country, first_year, last_year)
+        }
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            atomic_write(_cache_path(country, cache_dir), json.dumps(table))
+        except OSError as e:
+            logger.warning(f"⚠️ Could not persist holiday cache: {e}")
+
+    _tables[(country, cache_dir)] = table
+    return table['rows']
+
+def holidays_frame(country, years, cache_dir=None):
+    """Prophet holidays DataFrame (ds, holiday) for the given years"""
+    import pandas as pd
+    years = set(years)
+    rows = [row for row in load_holiday_rows(country, years, cache_dir) if int(row[0][:4]) in years]
+    return pd.DataFrame({
+        'ds': pd.to_datetime([row[0] for row in rows]),
+        'holiday': [row[1] for row in rows]
+    })
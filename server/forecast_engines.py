@@ -0,0 +1,478 @@
+"""
+Forecasting engines used by predict_category
+============================================
+
+Each engine forecasts how much will be spent on the remaining days of the month from
+a category's (days, amounts) history. predict_category picks one with select_engine()
+and applies the same velocity factors and dynamic caps whichever engine ran.
+
+  prophet  full Prophet fit (daily/weekly/yearly seasonality + holidays)
+  numpy    day-of-week profile plus a robust linear trend, solved in closed form with
+           least squares on the daily spending series
+  batch    trend plus weekly and yearly Fourier seasonality with per-series coefficients,
+           fitted for many (user, category) series at once as one batched ridge
+           least-squares problem (see BatchEngine.fit_many); opt-in with
+           PREDICTOR_ENGINE=batch
+
+Engines are fitted on prepare_series(history): one row per day with spending (the sum
+of that day's transactions) rather than one row per transaction, optionally zero-filled
+so days without spending count as 0.
+
+When a series (a user's category) was fitted before, ProphetEngine starts the optimizer
+from the previous fit's parameters instead of Prophet's default initialisation, and
+only fits cold when the series has changed a lot or the warm fit fails.
+
+Prophet is only worth its fit cost on series that are long enough, and span enough
+time, for its seasonalities to mean anything. Shorter series go to the NumPy engine.
+
+pandas and Prophet are imported inside ProphetEngine, so requests that only reach the
+NumPy engine or the math fallback never pay for loading them.
+
+Prophet's optimizer runs in a CmdStan child process. Under a request deadline
+(fit_deadline), the time left is passed to cmdstanpy as its timeout, so it terminates
+and reaps the child itself; an exception raised while cmdstanpy waits on the child would
+leave it running.
+"""
+
+import os
+import time
+import contextlib
+
+import numpy as np
+
+from feature_cache import holidays_frame
+from instrumentation import get_logger, quiet_library_loggers, stage
+from model_store import series_key
+from training_store import History, aggregate_daily, date_to_ordinal, ordinals_to_datetime64
+
+logger = get_logger('predictor.engines')
+
+# 'auto' picks an engine per series from the thresholds below; 'prophet', 'numpy' or 'batch' forces one
+PREDICTOR_ENGINE = os.environ.get('PREDICTOR_ENGINE', 'auto')
+
+# Minimum data points and minimum span (first to last day) before a series is sent to Prophet
+PROPHET_MIN_POINTS = int(os.environ.get('PROPHET_MIN_POINTS', '30'))
+PROPHET_MIN_SPAN_DAYS = int(os.environ.get('PROPHET_MIN_SPAN_DAYS', '56'))
+
+# Fit on per-day totals instead of per-transaction rows; optionally zero-fill days without spending
+DAILY_AGGREGATE = os.environ.get('PREDICTOR_DAILY_AGGREGATE', '1') != '0'
+ZERO_FILL = os.environ.get('PREDICTOR_ZERO_FILL', '0') == '1'
+
+# Warm-start Prophet refits from the series' previous parameters unless the series changed by
+# more than WARM_START_MAX_CHANGE (relative change in row count or mean amount)
+WARM_START = os.environ.get('PREDICTOR_WARM_START', '1') != '0'
+WARM_START_MAX_CHANGE = float(os.environ.get('WARM_START_MAX_CHANGE', '0.2'))
+
+# Country holidays added to Prophet models when PREDICTOR_HOLIDAYS=1. Off by default: the old
+# add_country_holidays(country_code=...) call never succeeded, so models have been fitted without them
+HOLIDAY_COUNTRY = 'US'
+HOLIDAYS_ENABLED = os.environ.get('PREDICTOR_HOLIDAYS', '0') == '1'
+
+# Prophet's fitted parameters, as accepted by Prophet.fit(init=...)
+SCALAR_PARAMS = ('k', 'm', 'sigma_obs')
+VECTOR_PARAMS = ('delta', 'beta')
+
+# Fewest days of series needed before the NumPy engine fits a day-of-week profile
+NUMPY_MIN_DAYS_FOR_WEEKLY = 14
+
+# Batch engine: Fourier orders of the shared seasonal design, the ridge penalty that keeps
+# seasonal coefficients of short series near zero (like Prophet's seasonality prior), and how
+# many series are solved together per pass (bounds the padded design tensor's memory)
+BATCH_WEEKLY_ORDER = 3
+BATCH_YEARLY_ORDER = 4
+BATCH_RIDGE = float(os.environ.get('BATCH_ENGINE_RIDGE', '1.0'))
+BATCH_CHUNK_SERIES = int(os.environ.get('BATCH_ENGINE_CHUNK', '1024'))
+
+class DeadlineExceeded(BaseException):
+    """Raised inside a running model fit when the request's deadline passes
+    
+    A BaseException so the broad `except Exception` fallbacks in the engines (and
+    Prophet's own retry on optimizer errors) don't swallow it and keep fitting.
+    """
+
+# Deadline (a time.time() value) of the fit running in this process, and whether CmdStan is running
+_fit_deadline = None
+_stan_running = False
+
+@contextlib.contextmanager
+def fit_deadline(deadline):
+    """Bound the Prophet fits in the enclosed block by deadline (None = unbounded)"""
+    global _fit_deadline
+    _fit_deadline = deadline
+    try:
+        yield
+    finally:
+        _fit_deadline = None
+
+def stan_running():
+    """True while a CmdStan child process is fitting; it has to be stopped through cmdstanpy"""
+    return _stan_running
+
+def fit_prophet(model, df, **kwargs):
+    """model.fit(df), with the time left before the fit deadline as cmdstanpy's timeout"""
+    global _stan_running
+    if _fit_deadline is not None:
+        remaining = _fit_deadline - time.time()
+        if remaining <= 0:
+            raise DeadlineExceeded()
+        kwargs['timeout'] = remaining
+    _stan_running = True
+    try:
+        model.fit(df, **kwargs)
+    except TimeoutError:
+        # cmdstanpy has terminated and waited on the child before raising
+        raise DeadlineExceeded()
+    finally:
+        _stan_running = False
+
+def daily_series(history):
+    """Total spending per day from the first to the last day of a history, zero-filled"""
+    days = np.asarray(history.days, dtype=np.int64)
+    first_day = int(days.min())
+    totals = np.bincount(days - first_day, weights=np.asarray(history.amounts, dtype=np.float64))
+    return np.arange(first_day, first_day + len(totals), dtype=np.int64), totals
+
+def prepare_series(history, aggregate=None, zero_fill=None):
+    """The series an engine is fitted on: daily totals (optionally zero-filled) of a history"""
+    aggregate = DAILY_AGGREGATE if aggregate is None else aggregate
+    zero_fill = ZERO_FILL if zero_fill is None else zero_fill
+    if len(history.days) == 0 or not (aggregate or zero_fill):
+        return history
+    if zero_fill:
+        days, totals = daily_series(history)
+        return History(days.astype(np.int32), totals)
+    return aggregate_daily(history)
+
+def fits_daily_totals(aggregate=None, zero_fill=None):
+    """True when engines are fitted on per-day totals, so daily rollups can stand in for raw rows"""
+    aggregate = DAILY_AGGREGATE if aggregate is None else aggregate
+    zero_fill = ZERO_FILL if zero_fill is None else zero_fill
+    return aggregate or zero_fill
+
+def warm_start_params(model):
+    """A fitted model's parameters in the JSON-friendly form stored by WarmStartStore"""
+    params = {name: float(np.asarray(model.params[name]).ravel()[0]) for name in SCALAR_PARAMS}
+    params.update({name: np.asarray(model.params[name])[0].tolist() for name in VECTOR_PARAMS})
+    return params
+
+def series_summary(df):
+    """Row count and mean of a fit frame, used to tell whether a warm start still applies"""
+    return {'rows': len(df), 'mean': float(df['y'].mean())}
+
+def series_changed(previous, current, max_change=None):
+    """True when a series moved too far from the one its stored parameters were fitted on"""
+    max_change = WARM_START_MAX_CHANGE if max_change is None else max_change
+    rows_change = abs(current['rows'] - previous['rows']) / max(previous['rows'], 1)
+    mean_change = abs(current['mean'] - previous['mean']) / max(abs(previous['mean']), 1e-9)
+    return rows_change > max_change or mean_change > max_change
+
+class ProphetEngine:
+    """Full Prophet fit, reusing fitted models from the model store"""
+
+    name = 'prophet'
+
+    def __init__(self, model_store, warm_start_store=None):
+        self.model_store = model_store
+        self.warm_start_store = warm_start_store
+        # Fit counts and seconds by kind, for reporting what warm starts save
+        self.fit_stats = {'cold': 0, 'cold_seconds': 0.0, 'warm': 0, 'warm_seconds': 0.0}
+
+    def build_model(self, category, years=None):
+        """Create Prophet model with optimized settings for expense prediction
+        
+        With years, holidays come from the on-disk holiday cache for those years instead
+        of being regenerated by add_country_holidays on every fit and predict.
+        """
+        from prophet import Prophet
+        quiet_library_loggers()
+        
+        holidays = None
+        if years and HOLIDAYS_ENABLED:
+            try:
+                holidays = holidays_frame(HOLIDAY_COUNTRY, years)
+            except Exception as e:
+                logger.warning(f"{category}: Could not load cached holidays: {e}")
+        
+        model = Prophet(
+            holidays=holidays,              # Cached holiday calendar (None: added below)
+            daily_seasonality=True,         # Daily patterns matter for expenses
+            yearly_seasonality=True,        # Capture annual patterns (holidays, etc.)
+            weekly_seasonality=True,        # Weekly patterns (weekends vs weekdays)
+            changepoint_prior_scale=0.15,   # More flexible to capture expense pattern changes
+            seasonality_prior_scale=20.0,   # Strongly enhanced seasonal component
+            interval_width=0.9,            # Wider prediction interval for better coverage
+            seasonality_mode='multiplicative',  # Better for expense patterns
+            growth='linear'                # Linear growth model works best for expenses
+        )
+
+        if holidays is not None:
+            logger.debug(f"{category}: Added cached country-specific holidays to AI model")
+            return model
+        if not HOLIDAYS_ENABLED:
+            return model
+        
+        # Add country-specific holidays for better prediction around spending patterns
+        # For now, default to US holidays but could be expanded
+        try:
+            model.add_country_holidays(country_name=HOLIDAY_COUNTRY)
+            logger.debug(f"{category}: Added country-specific holidays to AI model")
+        except (AttributeError, ImportError, ValueError) as e:
+            logger.warning(f"{category}: Could not add specific holidays: {e}")
+        except Exception as holiday_error:
+            logger.warning(f"{category}: Could not add holidays: {holiday_error}")
+        return model
+
+    def fit(self, df, category, series_id=None, warm_start=None, years=None):
+        """Fit a new model on df, warm-started from the series' previous fit when possible
+        
+        years are the calendar years the model needs holidays for (default: those in df).
+        """
+        warm_start = WARM_START if warm_start is None else warm_start
+        years = years or set(df['ds'].dt.year)
+        store = self.warm_start_store if warm_start and series_id is not None else None
+        summary = series_summary(df)
+        previous = store.get(series_id) if store is not None else None
+        # Series where a warm start turned out slower than a cold fit stay cold until they change a lot
+        allow_warm = True
+        
+        if previous is not None and series_changed(previous['summary'], summary):
+            logger.debug(f"{category}: Series changed too much since the last fit - fitting cold")
+        elif previous is not None and not previous.get('warm_start', True):
+            logger.debug(f"{category}: Warm starts were slower than cold fits for this series - fitting cold")
+            allow_warm = False
+        elif previous is not None:
+            try:
+                init = {name: (np.asarray(value) if name in VECTOR_PARAMS else value)
+                        for name, value in previous['params'].items()}
+                started = time.perf_counter()
+                model = self.build_model(category, years)
+                fit_prophet(model, df, init=init)
+                elapsed = time.perf_counter() - started
+                
+                # Prophet quietly falls back to its default init for parameters whose shape changed
+                params = warm_start_params(model)
+                if all(len(params[name]) == len(init[name]) for name in VECTOR_PARAMS):
+                    self.fit_stats['warm'] += 1
+                    self.fit_stats['warm_seconds'] += elapsed
+                    cold_seconds = previous.get('cold_seconds') or elapsed
+                    logger.debug(f"{category}: 🔥 Warm-started fit in {elapsed:.3f}s vs {cold_seconds:.3f}s cold ({1 - elapsed / cold_seconds:.0%} less)")
+                    store.put(series_id, {
+                        'summary': summary,
+                        'params': params,
+                        'cold_seconds': cold_seconds,
+                        'warm_start': elapsed <= cold_seconds
+                    })
+                    return model
+                logger.debug(f"{category}: Warm start parameters no longer fit the model shape - fitting cold")
+            except Exception as e:
+                logger.warning(f"{category}: Warm-started fit failed ({e}) - fitting cold")
+        
+        started = time.perf_counter()
+        model = self.build_model(category, years)
+        fit_prophet(model, df)
+        elapsed = time.perf_counter() - started
+        self.fit_stats['cold'] += 1
+        self.fit_stats['cold_seconds'] += elapsed
+        if store is not None:
+            store.put(series_id, {
+                'summary': summary,
+                'params': warm_start_params(model),
+                'cold_seconds': elapsed,
+                'warm_start': allow_warm
+            })
+        return model
+
+    def forecast(self, history, category, future_dates, series_id=None):
+        """Sum of Prophet's predicted values over future_dates (never negative)"""
+        import pandas as pd
+        
+        # Prepare data for Prophet straight from the history columns
+        df = pd.DataFrame({
+            'ds': ordinals_to_datetime64(history.days),
+            'y': np.asarray(history.amounts, dtype=np.float64)
+        }).sort_values('ds')
+
+        # Reuse a model already fitted on this exact series when we have one
+        with stage('fit'):
+            model_key = series_key(category, df, f"holidays={HOLIDAY_COUNTRY}" if HOLIDAYS_ENABLED else None)
+            model = self.model_store.get(model_key)
+            if model is not None:
+                logger.debug(f"{category}: ♻️ Reusing fitted model from store")
+            else:
+                years = set(df['ds'].dt.year) | {d.year for d in future_dates}
+                model = self.fit(df, category, series_id, years=years)
+                self.model_store.put(model_key, model)
+
+        with stage('predict'):
+            forecast = model.predict(pd.DataFrame({'ds': future_dates}))
+            return max(0, forecast['yhat'].sum())
+
+class NumpyEngine:
+    """Day-of-week profile plus robust linear trend, fitted by closed-form least squares"""
+
+    name = 'numpy'
+
+    @staticmethod
+    def design_matrix(days, origin, with_weekly):
+        """Intercept, trend (in weeks) and, optionally, one indicator per weekday but Monday"""
+        columns = [np.ones(len(days)), (days - origin) / 7.0]
+        if with_weekly:
+            # date.toordinal() is 1 for Monday 0001-01-01, so (ordinal - 1) % 7 is date.weekday()
+            weekdays = (days - 1) % 7
+            columns.extend((weekdays == weekday).astype(np.float64) for weekday in range(1, 7))
+        return np.column_stack(columns)
+
+    def forecast(self, history, category, future_dates, series_id=None):
+        """Sum of the fitted daily spending over future_dates (never negative)"""
+        with stage('fit'):
+            days, totals = daily_series(history)
+
+            # Winsorize one-off spikes so a single large purchase doesn't tilt the trend
+            if len(totals) >= 7:
+                totals = np.minimum(totals, np.percentile(totals, 95))
+
+            with_weekly = len(days) >= NUMPY_MIN_DAYS_FOR_WEEKLY
+            origin = days[0]
+            X = self.design_matrix(days, origin, with_weekly)
+            coefficients, _, _, _ = np.linalg.lstsq(X, totals, rcond=None)
+
+        with stage('predict'):
+            future_days = np.array([date_to_ordinal(d) for d in future_dates], dtype=np.int64)
+            predicted = self.design_matrix(future_days, origin, with_weekly) @ coefficients
+            logger.debug(f"{category}: NumPy engine fitted {len(days)} days (weekly profile: {with_weekly})")
+            return max(0.0, float(np.clip(predicted, 0, None).sum()))
+
+class BatchEngine:
+    """Shared trend and Fourier seasonality design with per-series coefficients, solved in batches
+
+    Prophet pays a fixed cost per fit (building the model, writing Stan input, starting the
+    optimizer) for every small series. Here every series gets the same design (intercept,
+    linear trend, weekly and yearly Fourier terms) evaluated on its own days, the series are
+    padded to a common length, and all their ridge-regularized normal equations are built
+    and solved as one (series, p, p) batch. Like the NumPy engine, it is fitted on the
+    zero-filled daily spending series with one-off spikes winsorized.
+
+    fit_many() forecasts a whole set of series up front; forecast() then hands back each
+    series' result, and only fits on its own for series that were not part of the batch.
+    """
+
+    name = 'batch'
+
+    def __init__(self, ridge=None, chunk_series=None):
+        self.ridge = BATCH_RIDGE if ridge is None else ridge
+        self.chunk_series = chunk_series or BATCH_CHUNK_SERIES
+        self.forecasts = {}
+
+    @staticmethod
+    def forecast_key(series_id, history, future_dates):
+        """Identifies one series' forecast: the series, its size and the days forecast"""
+        return (series_id, len(history.days), date_to_ordinal(future_dates[0]) if future_dates else None, len(future_dates))
+
+    @staticmethod
+    def design(days, origin):
+        """(series, rows, p) design: intercept, trend in weeks, weekly and yearly Fourier terms"""
+        days = days.astype(np.float64)
+        columns = [np.ones_like(days), (days - origin[:, None]) / 7.0]
+        for period, order in ((7.0, BATCH_WEEKLY_ORDER), (365.25, BATCH_YEARLY_ORDER)):
+            for k in range(1, order + 1):
+                angle = 2 * np.pi * k * days / period
+                columns.extend((np.sin(angle), np.cos(angle)))
+        return np.stack(columns, axis=-1)
+
+    def solve(self, series):
+        """Forecast totals for a list of (days, totals, future_days) daily series in one pass"""
+        lengths = np.array([len(totals) for _, totals, _ in series])
+        horizons = np.array([len(future) for _, _, future in series])
+        rows, horizon = int(lengths.max()), int(horizons.max())
+        mask = np.arange(rows) < lengths[:, None]
+        future_mask = np.arange(horizon) < horizons[:, None]
+
+        # Pad every series to the longest one; padded rows get zero weight
+        origin = np.array([days[0] for days, _, _ in series], dtype=np.float64)
+        days = origin[:, None] + np.arange(rows)
+        y = np.zeros((len(series), rows))
+        y[mask] = np.concatenate([totals for _, totals, _ in series])
+        future_days = np.array([future[0] for _, _, future in series], dtype=np.float64)[:, None] + np.arange(horizon)
+
+        # Winsorize one-off spikes so a single large purchase doesn't tilt the trend
+        winsorize = lengths >= 7
+        if winsorize.any():
+            caps = np.nanpercentile(np.where(mask, y, np.nan)[winsorize], 95, axis=1)
+            y[winsorize] = np.minimum(y[winsorize], caps[:, None])
+
+        X = self.design(days, origin)
+        weighted = X * mask[..., None]
+        gram = np.einsum('nrp,nrq->npq', weighted, X)
+        moments = np.einsum('nrp,nr->np', weighted, y)
+        # Seasonal terms are shrunk towards zero; the tiny trend penalty only guards against singular systems
+        penalty = np.full(X.shape[-1], self.ridge)
+        penalty[:2] = 1e-9
+        gram += np.diag(penalty)
+        coefficients = np.linalg.solve(gram, moments[..., None])[..., 0]
+
+        predicted = np.einsum('nfp,np->nf', self.design(future_days, origin), coefficients)
+        return np.where(future_mask, np.clip(predicted, 0, None), 0.0).sum(axis=1)
+
+    @staticmethod
+    def daily_input(history, future_dates):
+        days, totals = daily_series(history)
+        future_days = np.array([date_to_ordinal(d) for d in future_dates], dtype=np.int64)
+        return days, totals, future_days
+
+    def fit_many(self, series):
+        """Forecast every (series_id, history, future_dates) together; forecast() returns the results
+
+        Series are sorted by length before being cut into passes of chunk_series so that
+        little of each pass is padding. Results of the previous fit_many are dropped.
+        """
+        self.forecasts = {}
+        series = [item for item in series if len(item[1].days) and len(item[2])]
+        if not series:
+            return 0
+        inputs = [self.daily_input(history, future_dates) for _, history, future_dates in series]
+        order = sorted(range(len(series)), key=lambda i: len(inputs[i][1]))
+        for start in range(0, len(order), self.chunk_series):
+            chunk = order[start:start + self.chunk_series]
+            totals = self.solve([inputs[i] for i in chunk])
+            for i, total in zip(chunk, totals):
+                series_id, history, future_dates = series[i]
+                self.forecasts[self.forecast_key(series_id, history, future_dates)] = max(0.0, float(total))
+        logger.debug(f"Batch engine fitted {len(series)} series in {-(-len(series) // self.chunk_series)} passes")
+        return len(series)
+
+    def forecast(self, history, category, future_dates, series_id=None):
+        """The series' total from the last fit_many, or a fit of this series alone"""
+        key = self.forecast_key(series_id, history, future_dates)
+        if key in self.forecasts:
+            with stage('predict'):
+                return self.forecasts.pop(key)
+        with stage('fit'):
+            return max(0.0, float(self.solve([self.daily_input(history, future_dates)])[0]))
+
+def engine_config():
+    """The engine settings that change forecasts, e.g. for keying cached results"""
+    return {
+        'engine': PREDICTOR_ENGINE,
+        'prophet_min_points': PROPHET_MIN_POINTS,
+        'prophet_min_span_days': PROPHET_MIN_SPAN_DAYS,
+        'daily_aggregate': DAILY_AGGREGATE,
+        'zero_fill': ZERO_FILL,
+        'holidays': HOLIDAYS_ENABLED,
+        'batch_ridge': BATCH_RIDGE,
+    }
+
+def batch_engine_selected(engine=None):
+    """True when PREDICTOR_ENGINE asks for the batch engine, which callers fit up front with fit_many"""
+    return (engine or PREDICTOR_ENGINE) == 'batch'
+
+def select_engine(engines, history, engine=None):
+    """Pick the engine for a history: Prophet only when the series is long and wide enough"""
+    engine = engine or PREDICTOR_ENGINE
+    if engine != 'auto':
+        return engines[engine]
+
+    points = len(history.days)
+    span_days = int(np.max(history.days)) - int(np.min(history.days)) + 1
+    if points >= PROPHET_MIN_POINTS and span_days >= PROPHET_MIN_SPAN_DAYS:
+        return engines['prophet']
+    return engines['numpy']
@@ -7,163 +7,621 @@ This script connects to the CloudExpense database and generates training data fo
 It extracts historical transaction data and formats it for use by the cloud_predictor.py script.
 
 Usage:
-  python generate_training_data.py
+  python generate_training_data.py [--format columnar|json|both] [--chunk-size 10000]
+                                   [--incremental] [--months-back 6]
+                                   [--workers 1] [--partition-by month|user] [--retries 2]
+
+Output:
+  By default the data is written to the memory-mapped columnar store in training_store/
+  (see training_store.py). --format json keeps the legacy training_data.json export.
+  Rows are streamed from a server-side cursor and written incrementally, and the run
+  reports its throughput in rows/sec.
+
+  The columnar output also includes per-user shards in training_shards/ so the predictor
+  can train a user's forecast on that user's own history.
+
+  Every store (and every shard) also gets daily and monthly rollups per category or
+  (user, category): sum, count, mean and quantiles of the amounts (see training_store.py).
+  The predictor fits on the daily rollups instead of re-aggregating raw transactions.
+  Each shard also gets a mergeable quantile sketch of every (user, category)'s daily
+  spending, and the shards' sketches are merged into one population sketch per
+  category (see quantile_sketch.py). The predictor takes its caps from them.
+
+  With --incremental the existing store is kept: rows older than the window are expired
+  and only rows added since the last export are fetched. created_at comes from the
+  client and may be backdated, so the watermark is the highest exported id (ids only
+  grow) plus the time the export ran, which picks up rows that were still future-dated
+  then; the window is a separate created_at filter. The window starts at midnight for
+  full and incremental runs alike, since the store keeps days rather than timestamps. A refresh that adds and expires nothing leaves the store
+  untouched, so the predictor's training stamp (and its fitted model store) stays valid.
+
+  With --workers N the window is split into partitions (calendar months, or user_id
+  ranges with --partition-by user) fetched concurrently over a pool of N connections.
+  Each partition is spilled to a temporary file (EXPORT_SPILL_DIR) as it arrives, a
+  failed one is resumed from its last spilled row, and the partitions are merged back
+  into the sequential (created_at, id) order one block at a time, so the output
+  matches a single-query export.
 
 Configuration:
   The script reads database connection information from environment variables or defaults.
+  DB_DRIVER=sqlite reads the same `transactions` table from the SQLite file named by
+  DB_NAME instead of PostgreSQL (used as a local fixture by benchmark_suite.py).
 """
 
 import os
 import sys
-import json
-import psycopg2
+import time
+import heapq
+import pickle
+import queue
+import itertools
+import argparse
+import tempfile
+import threading
+import numpy as np
+from collections import namedtuple
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from training_store import (
+    TRAINING_SHARDS_DIR, TRAINING_STORE_DIR, JsonExportWriter, ShardedStoreWriter, TrainingColumns,
+    TrainingShards, TrainingStoreWriter, date_to_ordinal, export_json
+)
 
 # Database connection parameters (from environment or defaults)
+DB_DRIVER = os.environ.get('DB_DRIVER', 'postgres')
 DB_HOST = os.environ.get('DB_HOST', 'localhost')
 DB_PORT = os.environ.get('DB_PORT', '5432')
 DB_NAME = os.environ.get('DB_NAME', 'cloudexpense')
 DB_USER = os.environ.get('DB_USER', 'postgres')
 DB_PASSWORD = os.environ.get('DB_PASSWORD', '')
 
-# Output file
+# Legacy JSON export file (the columnar store location comes from training_store.py)
 OUTPUT_FILE = 'training_data.json'
 
+# Rows fetched per round trip; memory use is bounded by one chunk regardless of table size
+CHUNK_SIZE = int(os.environ.get('EXPORT_CHUNK_SIZE', '10000'))
+
+# Months of transaction history kept in the training data
+MONTHS_BACK = int(os.environ.get('TRAINING_MONTHS_BACK', '6'))
+
+# Printed by an incremental refresh that found nothing to change (ai-training-scheduler.js looks for it)
+UNCHANGED_MESSAGE = 'Training store unchanged'
+
+# Parallel export (--workers > 1): the window is fetched as partitions over a pool of
+# connections, split by calendar month or by user_id range
+EXPORT_WORKERS = int(os.environ.get('EXPORT_WORKERS', '1'))
+EXPORT_PARTITION_BY = os.environ.get('EXPORT_PARTITION_BY', 'month')
+EXPORT_PARTITIONS = int(os.environ.get('EXPORT_PARTITIONS', '0'))
+EXPORT_RETRIES = int(os.environ.get('EXPORT_RETRIES', '2'))
+EXPORT_RETRY_BACKOFF = float(os.environ.get('EXPORT_RETRY_BACKOFF', '0.5'))
+# Where partitions are spilled while they wait to be merged (default: the system temp dir)
+EXPORT_SPILL_DIR = os.environ.get('EXPORT_SPILL_DIR') or None
+
+# One chunk of exported rows as parallel columns, plus the highest id among them
+ExportChunk = namedtuple('ExportChunk', ['categories', 'days', 'amounts', 'user_ids', 'max_id'])
+
+# Where an incremental refresh picks up: the highest id exported so far and the end of that
+# export's window (rows dated after it were left for a later export)
+Watermark = namedtuple('Watermark', ['id', 'until'])
+
+# A slice of the export window: extra WHERE clause and its parameters
+ExportPartition = namedtuple('ExportPartition', ['label', 'clause', 'params'])
+
+def open_connection():
+    """Open a new database connection (PostgreSQL, or the SQLite file with DB_DRIVER=sqlite)"""
+    if DB_DRIVER == 'sqlite':
+        import sqlite3
+        # PARSE_DECLTYPES returns created_at TIMESTAMP columns as datetimes, like psycopg2.
+        # Pooled connections are handed between export threads, one thread at a time.
+        return sqlite3.connect(DB_NAME, detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)
+    
+    import psycopg2
+    return psycopg2.connect(
+        host=DB_HOST,
+        port=DB_PORT,
+        database=DB_NAME,
+        user=DB_USER,
+        password=DB_PASSWORD
+    )
+
 def connect_to_db():
-    """Connect to the PostgreSQL database and return connection"""
+    """Connect to the PostgreSQL database (or the SQLite file with DB_DRIVER=sqlite) and return connection"""
     try:
-        print(f"Connecting to database: {DB_NAME} at {DB_HOST}:{DB_PORT}")
-        conn = psycopg2.connect(
-            host=DB_HOST,
-            port=DB_PORT,
-            database=DB_NAME,
-            user=DB_USER,
-            password=DB_PASSWORD
-        )
-        return conn
+        if DB_DRIVER == 'sqlite':
+            print(f"Connecting to SQLite database: {DB_NAME}")
+        else:
+            print(f"Connecting to database: {DB_NAME} at {DB_HOST}:{DB_PORT}")
+        return open_connection()
     except Exception as e:
         print(f"Error connecting to database: {e}")
         sys.exit(1)
 
-def fetch_historical_data(conn, months_back=6):
-    """Fetch historical transaction data from the database"""
-    try:
+def is_sqlite(conn):
+    """True for a sqlite3 connection (DB_DRIVER=sqlite)"""
+    return type(conn).__module__.startswith('sqlite3')
+
+class ConnectionPool:
+    """Up to `size` database connections, each used by one export thread at a time
+    
+    Connections are opened on first use. A connection whose work raised is closed
+    rather than returned, so a retry always starts on a fresh connection.
+    """
+    
+    def __init__(self, size, connect=open_connection):
+        self.size = size
+        self.connect = connect
+        self.idle = queue.LifoQueue()
+        self.lock = threading.Lock()
+        self.opened = 0
+    
+    @contextmanager
+    def connection(self):
+        try:
+            conn = self.idle.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                can_open = self.opened < self.size
+                if can_open:
+                    self.opened += 1
+            if can_open:
+                try:
+                    conn = self.connect()
+                except BaseException:
+                    with self.lock:
+                        self.opened -= 1
+                    raise
+            else:
+                # Every connection is busy: wait for one to come back
+                conn = self.idle.get()
+        try:
+            yield conn
+        except BaseException:
+            self._discard(conn)
+            raise
+        self.idle.put(conn)
+    
+    def _discard(self, conn):
+        with self.lock:
+            self.opened -= 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+    
+    def close(self):
+        """Close every idle connection"""
+        while True:
+            try:
+                self._discard(self.idle.get_nowait())
+            except queue.Empty:
+                return
+
+def window_start(end_date, months_back=MONTHS_BACK):
+    """Midnight of the first day of the months_back window ending at end_date
+    
+    Whole days, so a full rebuild keeps the same rows an incremental refresh trims to.
+    """
+    return (end_date - timedelta(days=months_back * 30)).replace(hour=0, minute=0, second=0, microsecond=0)
+
+def export_window(months_back=MONTHS_BACK, since=None, start_date=None, end_date=None):
+    """WHERE clause, parameters and (start, end) datetimes of the rows an export fetches
+    
+    With since=Watermark only rows the last export didn't fetch are: those added after
+    it (a higher id), whatever date they carry, and those that were dated after its
+    window then. start_date overrides the months_back window; end_date defaults to now.
+    """
+    end_date = end_date or datetime.now()
+    start_date = start_date or window_start(end_date, months_back)
+    filters, params = "AND t.created_at >= %s AND t.created_at <= %s", [start_date, end_date]
+    if since:
+        filters += " AND (t.id > %s OR t.created_at > %s)"
+        params += [since.id, since.until]
+    return filters, params, (start_date, end_date)
+
+def export_query(filters):
+    """Expense transactions matching the filters, oldest first so each category's rows
+    reach the store writer already in date order"""
+    return f"""
+    SELECT 
+        t.id,
+        t.user_id,
+        t.category,
+        t.amount,
+        t.transaction_type,
+        DATE(t.created_at) as date,
+        t.created_at
+    FROM 
+        transactions t
+    WHERE 
+        t.transaction_type = 'expense'
+        {filters}
+    ORDER BY 
+        t.created_at, t.id
+    """
+
+def fetch_rows(conn, query, params, chunk_size, cursor_name='training_data_export'):
+    """Run an export query and yield its rows in lists of up to chunk_size"""
+    if is_sqlite(conn):
+        # SQLite has no server-side cursors and uses ? placeholders; fetchmany still
+        # steps through the result without materializing it
+        query = query.replace('%s', '?')
         cur = conn.cursor()
+    else:
+        cur = conn.cursor(name=cursor_name)
+        cur.itersize = chunk_size
+    try:
+        cur.execute(query, params)
         
-        # Calculate date range
-        end_date = datetime.now()
-        start_date = end_date - timedelta(days=months_back * 30)
-        
+        while True:
+            rows = cur.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        cur.close()
+
+def rows_to_chunk(rows):
+    """Format a list of exported rows as an ExportChunk, as required by cloud_predictor.py"""
+    return ExportChunk(
+        categories=[row[2] for row in rows],
+        days=np.fromiter((date_to_ordinal(row[5]) for row in rows), dtype=np.int32, count=len(rows)),
+        amounts=np.fromiter((float(row[3]) for row in rows), dtype=np.float64, count=len(rows)),
+        user_ids=[row[1] for row in rows],
+        max_id=max(row[0] for row in rows)
+    )
+
+def fetch_historical_data(conn, months_back=MONTHS_BACK, chunk_size=None, since=None, start_date=None, end_date=None):
+    """Stream historical transaction data from the database in chunks
+    
+    Rows are read through a named (server-side) cursor, so only one chunk is ever held
+    in memory. Each chunk is yielded as an ExportChunk of parallel columns plus the
+    highest id among them. With since=Watermark only rows the last export didn't fetch
+    are (see export_window). start_date overrides the months_back window (the
+    batch predictor uses it to stream only the current month).
+    """
+    chunk_size = chunk_size or CHUNK_SIZE
+    filters, params, (start_date, end_date) = export_window(months_back, since, start_date, end_date)
+    if since:
+        print(f"Fetching transactions added after id {since.id} or dated after {since.until.isoformat()}, "
+              f"from {start_date.strftime('%Y-%m-%d')} to {end_date.strftime('%Y-%m-%d')}")
+    else:
         print(f"Fetching transactions from {start_date.strftime('%Y-%m-%d')} to {end_date.strftime('%Y-%m-%d')}")
+    
+    for rows in fetch_rows(conn, export_query(filters), params, chunk_size):
+        yield rows_to_chunk(rows)
+
+def month_partitions(start_date, end_date):
+    """One partition per calendar month of the window, in time order"""
+    boundaries = []
+    month_start = (start_date.replace(day=1, hour=0, minute=0, second=0, microsecond=0) + timedelta(days=32)).replace(day=1)
+    while month_start <= end_date:
+        boundaries.append(month_start)
+        month_start = (month_start + timedelta(days=32)).replace(day=1)
+    
+    partitions = []
+    for i in range(len(boundaries) + 1):
+        clauses, params = [], []
+        if i > 0:
+            clauses.append("AND t.created_at >= %s")
+            params.append(boundaries[i - 1])
+        if i < len(boundaries):
+            clauses.append("AND t.created_at < %s")
+            params.append(boundaries[i])
+        label = (boundaries[i - 1] if i > 0 else start_date).strftime('%Y-%m')
+        partitions.append(ExportPartition(label, ' '.join(clauses), params))
+    return partitions
+
+def user_partitions(conn, filters, params, count):
+    """Up to count partitions splitting the window's user_id range evenly"""
+    query = f"SELECT MIN(t.user_id), MAX(t.user_id) FROM transactions t WHERE t.transaction_type = 'expense' {filters}"
+    if is_sqlite(conn):
+        query = query.replace('%s', '?')
+    cur = conn.cursor()
+    try:
+        cur.execute(query, params)
+        low, high = cur.fetchone()
+    finally:
+        cur.close()
+    if low is None:
+        return [ExportPartition('all users', '', [])]
+    
+    low, high = int(low), int(high)
+    step = max(1, -(-(high - low + 1) // max(1, count)))
+    return [
+        ExportPartition(f"users {first}-{min(first + step - 1, high)}", "AND t.user_id >= %s AND t.user_id <= %s", [first, min(first + step - 1, high)])
+        for first in range(low, high + 1, step)
+    ]
+
+def spill_partition(pool, partition, filters, params, chunk_size, retries, spill):
+    """Fetch one partition into its spill file, one block at a time; returns its row count
+    
+    A failed fetch is retried on a fresh connection from the last spilled row's
+    (created_at, id), so nothing but the spill file carries over between attempts.
+    """
+    query = export_query(f"{filters} {partition.clause}")
+    resume_query = export_query(f"{filters} {partition.clause} AND (t.created_at, t.id) > (%s, %s)")
+    last, count = None, 0
+    for attempt in range(retries + 1):
+        spilled = spill.tell()
+        try:
+            with pool.connection() as conn:
+                if last is None:
+                    blocks = fetch_rows(conn, query, params + partition.params, chunk_size)
+                else:
+                    blocks = fetch_rows(conn, resume_query, params + partition.params + list(last), chunk_size)
+                for block in blocks:
+                    pickle.dump(block, spill, protocol=pickle.HIGHEST_PROTOCOL)
+                    spilled = spill.tell()
+                    last, count = (block[-1][6], block[-1][0]), count + len(block)
+                # End the read transaction before the connection goes back to the pool
+                conn.rollback()
+            return count
+        except Exception as e:
+            # Drop a block torn by the failure; the retry fetches it again
+            spill.seek(spilled)
+            spill.truncate()
+            if attempt == retries:
+                raise
+            delay = EXPORT_RETRY_BACKOFF * 2 ** attempt
+            print(f"Partition {partition.label} failed after {count} rows ({e}) - retry {attempt + 1}/{retries} in {delay:.1f}s")
+            time.sleep(delay)
+
+def spilled_rows(spill):
+    """Rows of a spill file, reading one block at a time"""
+    spill.seek(0)
+    while True:
+        try:
+            block = pickle.load(spill)
+        except EOFError:
+            return
+        yield from block
+
+def rows_in_partition_order(futures, spills):
+    """Rows of each partition in turn, closing (and deleting) a spill file once it has been passed on"""
+    for future, spill in zip(futures, spills):
+        future.result()
+        yield from spilled_rows(spill)
+        spill.close()
+
+def fetch_historical_data_parallel(pool, workers, months_back=MONTHS_BACK, chunk_size=None, since=None,
+                                   partition_by=EXPORT_PARTITION_BY, partitions=EXPORT_PARTITIONS, retries=EXPORT_RETRIES,
+                                   end_date=None):
+    """Fetch the export window as partitions over a pool of connections, streaming the
+    same ExportChunks in the same (created_at, id) order as fetch_historical_data
+    
+    Each partition is fetched into its own temporary spill file (in EXPORT_SPILL_DIR) a
+    block at a time, and the files are read back a block at a time, so memory stays at
+    about one block per partition however large the window is.
+    
+    partition_by='month' splits the window by calendar month: partitions are already in
+    row order, so each is passed on as soon as it and every earlier one have arrived.
+    partition_by='user' splits the user_id range into `partitions` ranges (default two
+    per worker), which spreads a window dominated by one month. Those partitions
+    interleave in time, so they are merged on (created_at, id) once all have arrived.
+    A partition that fails is resumed from its last spilled row up to `retries` times.
+    """
+    chunk_size = chunk_size or CHUNK_SIZE
+    filters, params, (start_date, end_date) = export_window(months_back, since, end_date=end_date)
+    if partition_by == 'user':
+        with pool.connection() as conn:
+            parts = user_partitions(conn, filters, params, partitions or workers * 2)
+            conn.rollback()
+    else:
+        parts = month_partitions(start_date, end_date)
+    print(f"Fetching transactions from {start_date.strftime('%Y-%m-%d')} to {end_date.strftime('%Y-%m-%d')} "
+          f"as {len(parts)} {partition_by} partitions on {workers} connections")
+    
+    spills = []
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        spills = [tempfile.TemporaryFile(prefix='training_export_', dir=EXPORT_SPILL_DIR) for _ in parts]
+        futures = [executor.submit(spill_partition, pool, part, filters, params, chunk_size, retries, spill)
+                   for part, spill in zip(parts, spills)]
+        if partition_by == 'user':
+            for future in futures:
+                future.result()
+            merged = heapq.merge(*[spilled_rows(spill) for spill in spills], key=lambda row: (row[6], row[0]))
+        else:
+            merged = rows_in_partition_order(futures, spills)
         
-        # Execute query to get all expense transactions
-        query = """
-        SELECT 
-            t.id,
-            t.user_id,
-            t.category,
-            t.amount,
-            t.transaction_type,
-            DATE(t.created_at) as date
-        FROM 
-            transactions t
-        WHERE 
-            t.transaction_type = 'expense'
-            AND t.created_at >= %s
-            AND t.created_at <= %s
-        ORDER BY 
-            t.user_id, t.created_at
-        """
+        rows = []
+        for row in merged:
+            rows.append(row)
+            if len(rows) >= chunk_size:
+                yield rows_to_chunk(rows)
+                rows = []
+        if rows:
+            yield rows_to_chunk(rows)
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        for spill in spills:
+            spill.close()
+
+def load_watermark(meta):
+    """Read the Watermark recorded in a store's metadata (None for none, or an older format)"""
+    watermark = meta.get('watermark')
+    if not watermark or 'until' not in watermark:
+        return None
+    return Watermark(watermark['id'], datetime.fromisoformat(watermark['until']))
+
+def incremental_base(months_back):
+    """Return the existing store and shards to extend incrementally, or None if a full rebuild is needed"""
+    try:
+        columns = TrainingColumns.open(TRAINING_STORE_DIR)
+        shards = TrainingShards.open(TRAINING_SHARDS_DIR)
+    except (OSError, ValueError, KeyError) as e:
+        print(f"No usable training store for an incremental refresh ({e}) - doing a full rebuild")
+        return None
+    
+    if load_watermark(columns.meta) is None:
+        print("Training store has no watermark - doing a full rebuild")
+        return None
+    if columns.meta.get('months_back') != months_back:
+        print(f"Training store covers {columns.meta.get('months_back')} months, not {months_back} - doing a full rebuild")
+        return None
+    if shards.manifest.get('watermark') != columns.meta.get('watermark'):
+        print("Per-user shards are out of step with the training store - doing a full rebuild")
+        return None
+    return columns, shards
+
+def generate_training_data(output_format='columnar', chunk_size=None, incremental=False, months_back=MONTHS_BACK,
+                           workers=EXPORT_WORKERS, partition_by=EXPORT_PARTITION_BY, partitions=EXPORT_PARTITIONS,
+                           retries=EXPORT_RETRIES):
+    """Main function to generate training data
+    
+    A full rebuild re-exports the whole months_back window. An incremental refresh keeps
+    the existing store, drops rows that have fallen out of the window, and appends only
+    rows added since the store's watermark (see export_window). Updates or deletes of already exported
+    rows are only picked up by a full rebuild. When nothing was added or expired the
+    store is left as it is.
+    
+    With workers > 1 the rows are fetched as partitions over a pool of that many
+    connections (see fetch_historical_data_parallel); the output is the same.
+    """
+    writers = []
+    pool = None
+    try:
+        if workers > 1:
+            pool = ConnectionPool(workers)
+        else:
+            conn = connect_to_db()
         
-        cur.execute(query, (start_date, end_date))
-        results = cur.fetchall()
+        base = incremental_base(months_back) if incremental else None
+        base_shards = None
+        if base is not None:
+            base, base_shards = base
+        since = load_watermark(base.meta) if base is not None else None
         
-        print(f"Fetched {len(results)} transactions")
+        started = time.perf_counter()
+        end_date = datetime.now()
+        retained_rows = 0
+        expired_rows = 0
+        if base is not None:
+            window_start_day = date_to_ordinal(window_start(end_date, months_back))
+            retained_rows = sum(end - start for start, end in
+                                (base.category_range(category, since_day=window_start_day) for category in base.categories))
+            expired_rows = len(base) - retained_rows
         
-        # Format data as required by cloud_predictor.py
-        training_data = []
-        for row in results:
-            _, user_id, category, amount, _, date = row
-            
-            # Format data as expected by the prediction model
-            training_data.append({
-                'date': date.strftime('%Y-%m-%d'),
-                'category': category,
-                'amount': float(amount),
-                'user_id': user_id  # Keep user_id for filtering
-            })
-            
-        cur.close()
-        return training_data
+        if pool is not None:
+            chunks = fetch_historical_data_parallel(pool, workers, months_back, chunk_size=chunk_size, since=since,
+                                                    partition_by=partition_by, partitions=partitions, retries=retries,
+                                                    end_date=end_date)
+        else:
+            chunks = fetch_historical_data(conn, months_back, chunk_size=chunk_size, since=since, end_date=end_date)
+        first_chunk = next(chunks, None)
+        if base is not None and first_chunk is None and not expired_rows:
+            # Rewriting the same rows would only change the store's stamp and wipe the fitted models
+            print(f"{UNCHANGED_MESSAGE}: no transactions added or expired")
+            if pool is not None:
+                pool.close()
+            else:
+                conn.close()
+            return True
+        if first_chunk is not None:
+            chunks = itertools.chain([first_chunk], chunks)
         
-    except Exception as e:
-        print(f"Error fetching historical data: {e}")
-        if cur:
-            cur.close()
-        return []
-
-def group_by_user_id(transactions):
-    """Group transactions by user_id for separate training data"""
-    user_transactions = {}
-    
-    for transaction in transactions:
-        user_id = transaction['user_id']
+        # Incremental refreshes always go through the columnar store; JSON is re-exported from it
+        write_store = base is not None or output_format in ('columnar', 'both')
+        store_writer = TrainingStoreWriter(TRAINING_STORE_DIR) if write_store else None
+        # Per-user shards are written alongside the global store
+        shard_writer = ShardedStoreWriter(TRAINING_SHARDS_DIR) if write_store else None
+        json_writer = JsonExportWriter(OUTPUT_FILE) if output_format in ('json', 'both') and base is None else None
+        writers = [writer for writer in (store_writer, shard_writer, json_writer) if writer]
         
-        if user_id not in user_transactions:
-            user_transactions[user_id] = []
-            
-        # Create a copy without user_id for the training data
-        clean_transaction = transaction.copy()
-        del clean_transaction['user_id']
-        user_transactions[user_id].append(clean_transaction)
-    
-    return user_transactions
-
-def generate_training_data():
-    """Main function to generate training data"""
-    try:
-        conn = connect_to_db()
+        if base is not None:
+            # Keep the part of the existing store that is still inside the window
+            store_writer.append_columns(base, since_day=window_start_day, block_rows=chunk_size or CHUNK_SIZE)
+            shard_writer.append_shards(base_shards, since_day=window_start_day, block_rows=chunk_size or CHUNK_SIZE)
+            print(f"Kept {retained_rows} stored transactions, expired {expired_rows} outside the {months_back}-month window")
         
-        # Fetch all historical data
-        all_transactions = fetch_historical_data(conn)
+        total_rows = 0
+        max_id = since.id if since else None
+        for chunk in chunks:
+            for writer in (store_writer, json_writer):
+                if writer:
+                    writer.append(chunk.categories, chunk.days, chunk.amounts)
+            if shard_writer:
+                shard_writer.append(chunk.categories, chunk.days, chunk.amounts, chunk.user_ids)
+            max_id = chunk.max_id if max_id is None else max(max_id, chunk.max_id)
+            total_rows += len(chunk.categories)
+            print(f"Exported {total_rows} transactions...")
         
-        # Group by user_id
-        user_transactions = group_by_user_id(all_transactions)
+        elapsed = time.perf_counter() - started
+        rows_per_sec = total_rows / elapsed if elapsed > 0 else 0.0
+        store_meta = {
+            'months_back': months_back,
+            'refresh': 'incremental' if base is not None else 'full',
+            'rows_added': total_rows,
+            'rows_expired': expired_rows,
+            'export_seconds': round(elapsed, 3),
+            'export_workers': workers,
+            'rows_per_sec': round(rows_per_sec, 1)
+        }
+        if max_id is not None:
+            store_meta['watermark'] = {'id': max_id, 'until': end_date.isoformat()}
         
-        # Generate global training data (without user_id)
-        global_training_data = []
-        for transaction in all_transactions:
-            # Create a copy without user_id
-            clean_transaction = {
-                'date': transaction['date'],
-                'category': transaction['category'],
-                'amount': transaction['amount']
-            }
-            global_training_data.append(clean_transaction)
-            
-        # Write global training data to file
-        with open(OUTPUT_FILE, 'w') as f:
-            json.dump(global_training_data, f, indent=2)
-            
-        print(f"Generated training data with {len(global_training_data)} records")
-        print(f"Training data written to {OUTPUT_FILE}")
+        if store_writer:
+            meta = store_writer.close(store_meta)
+            print(f"Generated columnar training store with {meta['rows']} records across {len(meta['categories'])} categories")
+            print(f"Training data written to {TRAINING_STORE_DIR}/")
+        if shard_writer:
+            manifest = shard_writer.close({'watermark': store_meta.get('watermark')})
+            print(f"Wrote per-user training data for {manifest['users']} users across {len(manifest['shards'])} shards to {TRAINING_SHARDS_DIR}/")
+        if json_writer:
+            rows = json_writer.close()
+            print(f"Generated training data with {rows} records")
+            print(f"Training data written to {OUTPUT_FILE}")
+        writers = []
         
-        # TODO: In the future, create user-specific training files
-        # for user_id, transactions in user_transactions.items():
-        #     with open(f'training_data_{user_id}.json', 'w') as f:
-        #         json.dump(transactions, f, indent=2)
+        if base is not None and output_format in ('json', 'both'):
+            rows = export_json(TrainingColumns.open(TRAINING_STORE_DIR), OUTPUT_FILE)
+            print(f"Re-exported {rows} records to {OUTPUT_FILE}")
         
-        conn.close()
+        print(f"Exported {total_rows} rows in {elapsed:.2f}s ({rows_per_sec:.0f} rows/sec)")
+        
+        if pool is not None:
+            pool.close()
+        else:
+            conn.close()
         return True
         
     except Exception as e:
         print(f"Error generating training data: {e}")
+        # Leave the previous training data in place rather than a partial export
+        for writer in writers:
+            writer.abort()
+        if pool is not None:
+            pool.close()
         return False
 
+def parse_args(argv=None):
+    """Parse command line options"""
+    parser = argparse.ArgumentParser(description='CloudExpense AI training data generator')
+    parser.add_argument('--format', choices=['columnar', 'json', 'both'], default='columnar',
+                        help='Write the columnar training store, the legacy training_data.json, or both')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                        help='Rows fetched per round trip from the server-side cursor')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Append rows added since the last export instead of rebuilding the whole window')
+    parser.add_argument('--months-back', type=int, default=MONTHS_BACK,
+                        help='Months of history kept in the training data')
+    parser.add_argument('--workers', type=int, default=EXPORT_WORKERS,
+                        help='Database connections fetching partitions of the window in parallel (1 = one sequential query)')
+    parser.add_argument('--partition-by', choices=['month', 'user'], default=EXPORT_PARTITION_BY,
+                        help='Split the parallel export by calendar month or by user_id range')
+    parser.add_argument('--partitions', type=int, default=EXPORT_PARTITIONS,
+                        help='user_id ranges for --partition-by user (0 = two per worker)')
+    parser.add_argument('--retries', type=int, default=EXPORT_RETRIES,
+                        help='Times a failed partition is retried on a fresh connection')
+    return parser.parse_args(argv)
+
 if __name__ == "__main__":
+    args = parse_args()
     print("CloudExpense AI Training Data Generator")
     print("======================================")
-    success = generate_training_data()
+    success = generate_training_data(args.format, args.chunk_size, args.incremental, args.months_back,
+                                     args.workers, args.partition_by, args.partitions, args.retries)
     
     if success:
         print("Training data generation completed successfully!")
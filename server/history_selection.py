@@ -0,0 +1,164 @@
+"""
+Training history selection for cloud_predictor.py
+=================================================
+
+Every training record of a category used to go into its fit, so fit time and memory
+grew with the training set. A fit now gets at most PREDICTOR_HISTORY_MAX_POINTS series
+rows, whatever the size of training_data.json. History goes through these policies in
+order:
+
+  recency window    PREDICTOR_HISTORY_MONTHS (cloud_predictor.py) only reads history from
+                    the last N months. The read is a range slice of the sorted columns,
+                    so older rows are never loaded.
+  per-day totals    PREDICTOR_HISTORY_AGGREGATE=1 sums the rows to one per day (with its
+                    transaction count) before the cap is applied. 'auto', the default,
+                    does so when the engines fit daily totals anyway, so the result is
+                    the same. The daily rollups already arrive aggregated.
+  point cap         past PREDICTOR_HISTORY_MAX_POINTS rows (0 = no cap), the history is
+                    down-sampled by PREDICTOR_HISTORY_SAMPLING:
+                      recent      keep the newest rows
+                      stratified  keep the last PREDICTOR_HISTORY_KEEP_RECENT_DAYS days
+                                  whole. Older rows are thinned evenly within each
+                                  (month, weekday) stratum, with at least one row per
+                                  stratum when the cap allows. Weekly and yearly
+                                  seasonality stay covered.
+                      reservoir   keep the recent days whole and draw a uniform sample
+                                  of the older rows (reservoir sampling, Algorithm L).
+                                  It uses O(cap) memory and a fixed seed.
+
+Every policy is deterministic, so the same history always gives the same series, and
+fitted models and the result cache keep their hits. Thinning daily rows would show up
+as zero days when PREDICTOR_ZERO_FILL=1. In that case stratified and reservoir fall
+back to recent.
+"""
+
+import os
+import math
+import random
+
+import numpy as np
+
+import forecast_engines
+from training_store import History, month_start_days
+
+HISTORY_MAX_POINTS = int(os.environ.get('PREDICTOR_HISTORY_MAX_POINTS', '5000'))
+HISTORY_SAMPLING = os.environ.get('PREDICTOR_HISTORY_SAMPLING', 'stratified')
+HISTORY_AGGREGATE = os.environ.get('PREDICTOR_HISTORY_AGGREGATE', 'auto')
+HISTORY_KEEP_RECENT_DAYS = int(os.environ.get('PREDICTOR_HISTORY_KEEP_RECENT_DAYS', '28'))
+HISTORY_SAMPLE_SEED = int(os.environ.get('PREDICTOR_HISTORY_SAMPLE_SEED', '0'))
+
+SAMPLING_POLICIES = ('recent', 'stratified', 'reservoir')
+
+def selection_config():
+    """The selection settings that change forecasts, for cache keys and metadata"""
+    return {
+        'max_points': HISTORY_MAX_POINTS,
+        'sampling': sampling_policy(),
+        'aggregate': aggregates_daily(),
+        'keep_recent_days': HISTORY_KEEP_RECENT_DAYS,
+        'seed': HISTORY_SAMPLE_SEED,
+    }
+
+def sampling_policy():
+    if HISTORY_SAMPLING not in SAMPLING_POLICIES:
+        raise ValueError(f"Unknown history sampling {HISTORY_SAMPLING!r} (expected one of {', '.join(SAMPLING_POLICIES)})")
+    return 'recent' if forecast_engines.ZERO_FILL else HISTORY_SAMPLING
+
+def aggregates_daily():
+    if HISTORY_AGGREGATE == 'auto':
+        return bool(forecast_engines.fits_daily_totals())
+    return HISTORY_AGGREGATE == '1'
+
+def take(history, index):
+    """The rows of a history at the given positions (a slice stays a view)"""
+    return History(
+        history.days[index], history.amounts[index],
+        None if history.counts is None else history.counts[index]
+    )
+
+def aggregate_daily_counts(history):
+    """Per-day totals of a history sorted by day, keeping how many transactions each day sums"""
+    days = np.asarray(history.days)
+    if len(days) == 0 or (history.counts is not None and np.all(np.diff(days) > 0)):
+        return history
+    starts = np.flatnonzero(np.concatenate(([True], days[1:] != days[:-1])))
+    counts = np.ones(len(days), dtype=np.int64) if history.counts is None else np.asarray(history.counts, dtype=np.int64)
+    return History(
+        days[starts].astype(np.int32),
+        np.add.reduceat(np.asarray(history.amounts, dtype=np.float64), starts),
+        np.add.reduceat(counts, starts)
+    )
+
+def stratified_indices(days, budget):
+    """Positions of up to budget rows, spread evenly within each (month, weekday) stratum"""
+    strata = month_start_days(days).astype(np.int64) * 7 + np.asarray(days, dtype=np.int64) % 7
+    order = np.lexsort((np.asarray(days), strata))
+    labels, first, sizes = np.unique(strata[order], return_index=True, return_counts=True)
+    if budget >= len(labels):
+        # One row per stratum, and the rest of the budget in proportion to the stratum sizes
+        share, remainder = np.divmod((budget - len(labels)) * (sizes - 1), max(len(days) - len(labels), 1))
+        quota = 1 + share
+        # Rows the rounding left over go to the strata with the largest remainders
+        leftover = budget - int(quota.sum())
+        if leftover > 0:
+            quota[np.argsort(-remainder, kind='stable')[:leftover]] += 1
+    else:
+        quota = np.zeros(len(labels), dtype=np.int64)
+        quota[np.unique(np.linspace(0, len(labels) - 1, budget).round().astype(np.int64))] = 1
+    # Row r of a stratum with m rows and quota q is kept when floor(r*q/m) steps up at r+1
+    stratum = np.repeat(np.arange(len(labels)), sizes)
+    rank = np.arange(len(days)) - first[stratum]
+    keep = (rank + 1) * quota[stratum] // sizes[stratum] > rank * quota[stratum] // sizes[stratum]
+    return np.sort(order[keep])
+
+def reservoir_indices(count, budget, seed):
+    """Positions of a uniform sample of budget out of count rows (Algorithm L, O(budget) memory)"""
+    if budget <= 0:
+        return np.empty(0, dtype=np.int64)
+    rng = random.Random(seed)
+    reservoir = list(range(min(budget, count)))
+    if count > budget:
+        weight = math.exp(math.log(1.0 - rng.random()) / budget)
+        position = budget - 1
+        while True:
+            position += int(math.log(1.0 - rng.random()) / math.log(1.0 - weight)) + 1
+            if position >= count:
+                break
+            reservoir[rng.randrange(budget)] = position
+            weight *= math.exp(math.log(1.0 - rng.random()) / budget)
+    return np.sort(np.asarray(reservoir, dtype=np.int64))
+
+def sorted_by_day(history):
+    if np.all(np.diff(history.days) >= 0):
+        return history
+    return take(history, np.argsort(history.days, kind='stable'))
+
+def select_history(history, reference_day, max_points=None, sampling=None, keep_recent_days=None):
+    """A history aggregated per day and down-sampled to at most max_points rows (sorted by day
+    whenever either happens; otherwise returned as it is)"""
+    max_points = HISTORY_MAX_POINTS if max_points is None else max_points
+    sampling = sampling_policy() if sampling is None else sampling
+    keep_recent_days = HISTORY_KEEP_RECENT_DAYS if keep_recent_days is None else keep_recent_days
+    if aggregates_daily():
+        history = aggregate_daily_counts(sorted_by_day(history))
+    if max_points <= 0 or len(history.days) <= max_points:
+        return history
+    history = sorted_by_day(history)
+    if sampling == 'recent':
+        return take(history, slice(len(history.days) - max_points, None))
+
+    # The recent days stay whole (as much of them as the cap holds); older rows are sampled
+    recent_start = int(np.searchsorted(history.days, reference_day - keep_recent_days))
+    recent_start = max(recent_start, len(history.days) - max_points)
+    budget = max_points - (len(history.days) - recent_start)
+    if sampling == 'stratified':
+        older = stratified_indices(history.days[:recent_start], budget)
+    else:
+        older = reservoir_indices(recent_start, budget, HISTORY_SAMPLE_SEED)
+    return take(history, np.concatenate([older, np.arange(recent_start, len(history.days))]))
+
+def selection_summary(category_meta):
+    """Points used and available across a request's categories"""
+    used = sum(meta.get('points', 0) for meta in category_meta.values())
+    available = sum(meta.get('points_available', meta.get('points', 0)) for meta in category_meta.values())
+    return dict(selection_config(), points_used=used, points_available=available)
@@ -0,0 +1,387 @@
+"""
+Incremental per-(user, category) prediction state for cloud_predictor.py
+========================================================================
+
+The figures predict_category derives from the current month depend only on a few running
+statistics per category (cloud_predictor.current_stats): the month total, which days of
+the month have spending, and the latest expense. The fallback projection, the dynamic cap
+and the velocity factor are all computed from these. This module keeps the statistics
+per (user, month, category) and applies transaction insert, update and delete events to
+them in O(1):
+
+  total            running sum of the category's amounts this month
+  day_counts       transactions per day of the month (31 slots), which give the distinct
+                   days with spending and the latest day with spending
+
+An event's answer holds these figures for every category of the user's month,
+computed with the same functions the full prediction uses. Model-based forecasts can't
+be updated that way. The last one computed for each category is kept, clamped into the
+new [current total, cap] range as an estimate, and marked stale. refresh() reruns the
+full prediction for the user's month and stores fresh forecasts. A category goes stale
+when one of its own transactions changes; all of them go stale when the month's latest
+day moves, since that changes every forecast horizon.
+
+Caps come from the same spending sketches as the full prediction's (cloud_predictor.cap_sketch):
+the user's own shard sketch, or the population one until it has enough days. A month state
+loads them once per category and keeps them until the training shards are reloaded.
+
+Only the newest STATE_MONTHS_PER_USER months of each user are kept. Events dated before
+them are ignored, and an update that moves a transaction there removes it.
+check_incremental_state.py replays random event streams and checks every answer
+against the full recompute path.
+"""
+
+import os
+import math
+from collections import namedtuple
+from datetime import date, timedelta
+
+import numpy as np
+
+from cloud_predictor import CurrentStats, cap_sketch, dynamic_cap, projection_from_stats, velocity_factor
+from instrumentation import get_logger
+from training_store import TrainingColumns, date_to_ordinal
+
+logger = get_logger('predictor.incremental')
+
+STATE_MONTHS_PER_USER = int(os.environ.get('STATE_MONTHS_PER_USER', '2'))
+
+EVENT_TYPES = ('insert', 'update', 'delete')
+
+# One stored transaction: where it was counted and what it added
+Transaction = namedtuple('Transaction', ['user_id', 'month', 'category', 'day', 'amount'])
+
+class DayCounts:
+    """Transactions per day of the month, with the number of distinct days and the latest day"""
+
+    __slots__ = ('counts', 'days', 'last_day')
+
+    def __init__(self):
+        self.counts = [0] * 32
+        self.days = 0
+        self.last_day = 0
+
+    def add(self, day):
+        if self.counts[day] == 0:
+            self.days += 1
+            self.last_day = max(self.last_day, day)
+        self.counts[day] += 1
+
+    def remove(self, day):
+        self.counts[day] -= 1
+        if self.counts[day] == 0:
+            self.days -= 1
+            if day == self.last_day:
+                # At most 31 slots to scan back, whatever the transaction count
+                while self.last_day > 0 and self.counts[self.last_day] == 0:
+                    self.last_day -= 1
+
+class CategoryState:
+    """Running statistics of one category in one month, plus its last model-based forecast"""
+
+    __slots__ = ('total', 'transactions', 'days', 'forecast', 'method', 'stale')
+
+    def __init__(self):
+        self.total = 0.0
+        self.transactions = 0
+        self.days = DayCounts()
+        self.forecast = None
+        self.method = None
+        self.stale = True
+
+    def add(self, day, amount):
+        self.total += amount
+        self.transactions += 1
+        self.days.add(day)
+        self.stale = True
+
+    def remove(self, day, amount):
+        self.transactions -= 1
+        # Start from an exact zero again rather than carrying rounding residue
+        self.total = self.total - amount if self.transactions else 0.0
+        self.days.remove(day)
+        self.stale = True
+
+    def stats(self, month_start):
+        """The category's CurrentStats, as cloud_predictor.current_stats computes them from the rows"""
+        return CurrentStats(
+            total=self.total,
+            days_with_spending=self.days.days,
+            last_day_of_month=self.days.last_day,
+            latest_day=month_start + self.days.last_day - 1 if self.transactions else None
+        )
+
+class MonthState:
+    """Every category of one user's month, and the month's latest day with spending"""
+
+    def __init__(self, month_start, user_history=None, shards=None):
+        self.month_start = month_start
+        self.categories = {}
+        self.days = DayCounts()
+        self.transactions = {}
+        self.use_shards(user_history, shards)
+
+    def use_shards(self, user_history, shards):
+        """Take caps from these shards' sketches from now on"""
+        self.user_history = user_history
+        self.shards = shards
+        self.sketches = {}
+
+    def sketch(self, category):
+        """The category's cap sketch, loaded on first use"""
+        if category not in self.sketches:
+            self.sketches[category] = cap_sketch(category, self.user_history, self.shards)
+        return self.sketches[category]
+
+    def reference_date(self):
+        """The date the month is forecast from: its latest expense, as plan_prediction picks it"""
+        return date.fromordinal(self.month_start + max(self.days.last_day, 1) - 1)
+
+    def remaining_days(self):
+        reference = self.reference_date()
+        last_day_of_month = (reference.replace(day=1) + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+        return (last_day_of_month - reference).days
+
+    def add(self, transaction_id, transaction):
+        category = self.categories.get(transaction.category)
+        if category is None:
+            category = self.categories[transaction.category] = CategoryState()
+        category.add(transaction.day, transaction.amount)
+        self._track_day(self.days.add, transaction.day)
+        self.transactions[transaction_id] = transaction
+
+    def remove(self, transaction_id):
+        transaction = self.transactions.pop(transaction_id)
+        category = self.categories[transaction.category]
+        category.remove(transaction.day, transaction.amount)
+        if not category.transactions:
+            del self.categories[transaction.category]
+        self._track_day(self.days.remove, transaction.day)
+
+    def _track_day(self, update, day):
+        """Apply a day count update; a new latest day changes every category's forecast horizon"""
+        last_day = self.days.last_day
+        update(day)
+        if self.days.last_day != last_day:
+            for category in self.categories.values():
+                category.stale = True
+
+    def figures(self):
+        """Fallback projection, cap, velocity factor and forecast estimate per category"""
+        remaining_days = self.remaining_days()
+        categories = {}
+        for name, category in self.categories.items():
+            stats = category.stats(self.month_start)
+            if remaining_days <= 0:
+                fallback = cap = stats.total
+            else:
+                fallback = projection_from_stats(stats, name, remaining_days)
+                cap = dynamic_cap(stats, name, remaining_days, self.sketch(name))
+            if category.forecast is None:
+                estimate = fallback
+            else:
+                estimate = min(max(category.forecast, stats.total), cap)
+            categories[name] = {
+                'current': round(stats.total, 2),
+                'fallback': round(fallback, 2),
+                'cap': round(cap, 2),
+                'velocity_factor': velocity_factor(stats, name),
+                'estimate': round(estimate, 2),
+                'forecast': None if category.forecast is None else round(category.forecast, 2),
+                'method': category.method,
+                'stale': category.stale,
+            }
+        return {
+            'reference_date': self.reference_date().isoformat(),
+            'remaining_days': remaining_days,
+            'categories': categories,
+        }
+
+    def request(self):
+        """The month's transactions as the TrainingColumns of a full prediction request"""
+        transactions = list(self.transactions.values())
+        categories = list(dict.fromkeys(transaction.category for transaction in transactions))
+        index = {category: code for code, category in enumerate(categories)}
+        return TrainingColumns(
+            categories,
+            np.fromiter((index[t.category] for t in transactions), dtype=np.int32, count=len(transactions)),
+            np.fromiter((self.month_start + t.day - 1 for t in transactions), dtype=np.int32, count=len(transactions)),
+            np.fromiter((t.amount for t in transactions), dtype=np.float64, count=len(transactions))
+        )
+
+class IncrementalState:
+    """Per-user month states updated by transaction events"""
+
+    def __init__(self, months_per_user=None, shards=None):
+        self.months_per_user = months_per_user or STATE_MONTHS_PER_USER
+        self.shards = shards
+        self.users = {}
+        self.transactions = {}
+        self.events_applied = 0
+
+    def use_shards(self, shards):
+        """Switch to reloaded training shards; every month loads its sketches again"""
+        if shards is self.shards:
+            return
+        self.shards = shards
+        for user_id, months in self.users.items():
+            user_history = self.user_history(user_id)
+            for state in months.values():
+                state.use_shards(user_history, shards)
+
+    def user_history(self, user_id):
+        return self.shards.for_user(user_id) if self.shards is not None else None
+
+    def month(self, user_id, month_start, create=False):
+        months = self.users.get(user_id)
+        if months is None:
+            if not create:
+                return None
+            months = self.users[user_id] = {}
+        state = months.get(month_start)
+        if state is None and create:
+            state = months[month_start] = MonthState(month_start, self.user_history(user_id), self.shards)
+            # Keep only the newest months; their transactions can no longer be updated
+            for old_month in sorted(months)[:-self.months_per_user]:
+                for transaction_id in months.pop(old_month).transactions:
+                    self.transactions.pop(transaction_id, None)
+        return state
+
+    def in_window(self, user_id, month_start):
+        """False for a month older than every one of the user's newest months_per_user months,
+        which creating it would evict straight away"""
+        months = self.users.get(user_id)
+        if not months or month_start in months or len(months) < self.months_per_user:
+            return True
+        return month_start > min(months)
+
+    def parse_transaction(self, transaction_id, event, previous=None):
+        """The Transaction an insert or update event stores, validated before any state changes
+
+        An update may send only the fields that changed; every other event needs all of
+        user_id, date, category and amount. Missing or invalid fields raise ValueError.
+        """
+        fields = {}
+        for field in ('user_id', 'date', 'category', 'amount'):
+            if field in event and event[field] is not None:
+                fields[field] = event[field]
+            elif previous is not None and event.get('event') == 'update':
+                fields[field] = None
+            else:
+                raise ValueError(f"Transaction {transaction_id} has no {field}")
+
+        user_id = previous.user_id if fields['user_id'] is None else str(fields['user_id'])
+        if fields['date'] is None:
+            day = previous.month + previous.day - 1
+        else:
+            try:
+                day = date_to_ordinal(fields['date'])
+            except (TypeError, ValueError):
+                raise ValueError(f"Transaction {transaction_id} has an invalid date {fields['date']!r}")
+        category = previous.category if fields['category'] is None else fields['category']
+        if not isinstance(category, str) or not category:
+            raise ValueError(f"Transaction {transaction_id} has an invalid category {category!r}")
+        if fields['amount'] is None:
+            amount = previous.amount
+        else:
+            try:
+                amount = float(fields['amount'])
+            except (TypeError, ValueError):
+                amount = math.nan
+            if isinstance(fields['amount'], bool) or not math.isfinite(amount):
+                raise ValueError(f"Transaction {transaction_id} has an invalid amount {fields['amount']!r}")
+
+        month_start = date.fromordinal(day).replace(day=1).toordinal()
+        return Transaction(user_id, month_start, category, day - month_start + 1, amount)
+
+    def apply(self, event):
+        """Apply one insert/update/delete event; returns (user_id, month_start) of the month it left changed
+
+        Invalid events raise ValueError and leave the state as it was.
+        """
+        kind = event.get('event')
+        if kind not in EVENT_TYPES:
+            raise ValueError(f"Unknown event type {kind!r} (expected one of {', '.join(EVENT_TYPES)})")
+        if event.get('id') is None:
+            raise ValueError(f"{kind} event has no transaction id")
+        transaction_id = str(event['id'])
+        previous = self.transactions.get(transaction_id)
+
+        if kind == 'delete':
+            if previous is None:
+                logger.debug(f"🗑️ Delete of unknown transaction {transaction_id} ignored")
+                return None
+            self._remove(transaction_id, previous)
+            self.events_applied += 1
+            return previous.user_id, previous.month
+
+        # An insert of a known id replaces it; an update of an unknown one must be complete
+        transaction = self.parse_transaction(transaction_id, event, previous)
+        if not self.in_window(transaction.user_id, transaction.month):
+            logger.debug(f"🗓️ Transaction {transaction_id} is older than the {self.months_per_user} months kept "
+                         f"for user {transaction.user_id}; ignored")
+            if previous is None:
+                return None
+            # It moved out of the kept months: as far as the state goes, it was deleted
+            self._remove(transaction_id, previous)
+            self.events_applied += 1
+            return previous.user_id, previous.month
+        if previous is not None:
+            self._remove(transaction_id, previous)
+        self.month(transaction.user_id, transaction.month, create=True).add(transaction_id, transaction)
+        self.transactions[transaction_id] = transaction
+        self.events_applied += 1
+        return transaction.user_id, transaction.month
+
+    def _remove(self, transaction_id, transaction):
+        del self.transactions[transaction_id]
+        self.users[transaction.user_id][transaction.month].remove(transaction_id)
+
+    def figures(self, user_id, month_start):
+        """The answer for one user's month (see MonthState.figures)"""
+        state = self.month(user_id, month_start)
+        answer = {'user_id': user_id, 'month': date.fromordinal(month_start).strftime('%Y-%m')}
+        if state is None:
+            answer['categories'] = {}
+            return answer
+        answer.update(state.figures())
+        return answer
+
+    def apply_events(self, events):
+        """Apply events in order; returns the answer for every user month they changed"""
+        changed = []
+        for event in events:
+            key = self.apply(event)
+            if key is not None and key not in changed:
+                changed.append(key)
+        return [self.figures(user_id, month_start) for user_id, month_start in changed]
+
+    def latest_month(self, user_id):
+        months = self.users.get(str(user_id))
+        return max(months) if months else None
+
+    def stale(self):
+        """(user_id, month_start) of every month with a category whose forecast is stale"""
+        return [
+            (user_id, month_start)
+            for user_id, months in self.users.items()
+            for month_start, state in months.items()
+            if any(category.stale for category in state.categories.values())
+        ]
+
+    def refresh(self, user_id, month_start, predict):
+        """Rerun the full prediction for a user's month and store its forecasts
+
+        predict(request) takes the month's TrainingColumns and returns (predictions, meta)
+        like run_prediction. Returns the refreshed answer.
+        """
+        state = self.month(user_id, month_start)
+        if state is None:
+            return self.figures(user_id, month_start)
+        predictions, meta = predict(state.request())
+        for name, category in state.categories.items():
+            if name in predictions:
+                category.forecast = predictions[name]
+                category.method = meta.get('categories', {}).get(name, {}).get('method')
+                category.stale = False
+        return self.figures(user_id, month_start)
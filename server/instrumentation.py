@@ -0,0 +1,261 @@
+"""
+Logging, stage timings and profiling for cloud_predictor.py
+===========================================================
+
+Everything the predictor reports about itself goes through here:
+
+  logging   leveled logging to stderr via the 'predictor' logger. PREDICTOR_LOG_LEVEL
+            picks the level (default info); per-category detail is logged at debug.
+  timings   per-stage wall time in milliseconds (load, parse, fit, predict, cap,
+            serialize) for the request and for each category.
+  trace     one machine-readable JSON line per request on stderr, prefixed with
+            TRACE_PREFIX, holding the timings, memory and profile dump paths.
+            It is separate from the predictions on stdout. memory_mb separates the
+            request's own peak from the process's lifetime peak, which a long-lived
+            --serve or --workers process carries over from earlier requests.
+  profile   opt-in cProfile and/or tracemalloc per request (PREDICTOR_PROFILE=cprofile,
+            tracemalloc or all), dumped into PREDICTOR_PROFILE_DIR. cProfile covers the
+            process answering the request, not pool worker processes.
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+LOG_LEVEL = os.environ.get('PREDICTOR_LOG_LEVEL', 'info').upper()
+PROFILE = os.environ.get('PREDICTOR_PROFILE', '')
+PROFILE_DIR = os.environ.get('PREDICTOR_PROFILE_DIR', 'profiles')
+TRACE_ENABLED = os.environ.get('PREDICTOR_TRACE', '1') != '0'
+
+# Marks the trace line on stderr so callers can pick it out of the log output
+TRACE_PREFIX = 'PREDICTOR_TRACE '
+
+# Lines kept from the tracemalloc snapshot in the dump file
+TRACEMALLOC_TOP_LINES = 25
+
+# Library loggers kept quiet unless debugging: Stan's per-fit progress, Prophet's per-fit
+# warnings and its optional plotting import
+LIBRARY_LOG_LEVELS = {'cmdstanpy': logging.WARNING, 'prophet': logging.ERROR, 'prophet.plot': logging.CRITICAL}
+
+# Timer the current category's stages are recorded on (one category at a time per process)
+_category_timer = None
+
+def get_logger(name='predictor'):
+    """Logger under the 'predictor' hierarchy"""
+    return logging.getLogger(name)
+
+def configure_logging(level=None):
+    """Send 'predictor' log records to stderr as bare messages at the configured level"""
+    level = getattr(logging, (level or LOG_LEVEL).upper(), logging.INFO)
+    logger = logging.getLogger('predictor')
+    if not logger.handlers:
+        handler = logging.StreamHandler(sys.stderr)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(handler)
+        logger.propagate = False
+    logger.setLevel(level)
+    quiet_library_loggers()
+
+def quiet_library_loggers():
+    """Apply LIBRARY_LOG_LEVELS; call again after importing Prophet, which resets its own level"""
+    debugging = logging.getLogger('predictor').isEnabledFor(logging.DEBUG)
+    for name, level in LIBRARY_LOG_LEVELS.items():
+        library_logger = logging.getLogger(name)
+        if name == 'cmdstanpy' and not library_logger.handlers:
+            # cmdstanpy installs its own INFO handler on first use unless the logger already has one
+            library_logger.addHandler(logging.NullHandler())
+        library_logger.setLevel(logging.DEBUG if debugging else level)
+
+class StageTimer:
+    """Accumulates wall time per named stage, in milliseconds"""
+
+    def __init__(self):
+        self.ms = {}
+
+    def add(self, name, started):
+        """Add the time since started (a time.perf_counter() value) to a stage"""
+        self.ms[name] = self.ms.get(name, 0.0) + (time.perf_counter() - started) * 1000
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, started)
+
+    def as_dict(self):
+        return {name: round(ms, 2) for name, ms in self.ms.items()}
+
+def start_category_timing():
+    """Start a fresh timer that stage() and record_stage() record the current category on"""
+    global _category_timer
+    _category_timer = StageTimer()
+    return _category_timer
+
+@contextmanager
+def stage(name):
+    """Time a block as a stage of the current category (no-op outside a category)"""
+    timer = _category_timer
+    if timer is None:
+        yield
+        return
+    with timer.stage(name):
+        yield
+
+def record_stage(name, started):
+    """Record the time since started as a stage of the current category"""
+    if _category_timer is not None:
+        _category_timer.add(name, started)
+
+def peak_memory_mb():
+    """Lifetime peak resident memory of this process and of its finished or pooled children"""
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    usage = {
+        'self': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale,
+        'children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale,
+    }
+    return {name: round(mb, 1) for name, mb in usage.items()}
+
+def reset_peak_rss():
+    """Restart this process's peak resident memory count (Linux only); True if it was reset"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+def proc_status_mb(field):
+    """A memory field of /proc/self/status in MB (Linux only), or None: VmRSS is the current
+    resident memory, VmHWM its peak since the last reset_peak_rss"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(f"{field}:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except (OSError, ValueError):
+        pass
+    return None
+
+class MemoryTracker:
+    """Memory of one request, in a process that may have served others before it
+
+    On Linux the kernel's peak resident memory count is reset when the request starts,
+    so request_peak is this request's own peak, from request_start (the resident memory
+    it started with). Elsewhere both are None, and only request_growth (how far the
+    request raised the lifetime peak) is per request.
+    """
+
+    def __init__(self):
+        self.start = peak_memory_mb()
+        self.resettable = reset_peak_rss()
+        self.start_rss = proc_status_mb('VmRSS') if self.resettable else None
+
+    def finish(self):
+        process = peak_memory_mb()
+        if process is None:
+            return None
+        return {
+            'request_start': self.start_rss,
+            'request_peak': proc_status_mb('VmHWM') if self.resettable else None,
+            'request_growth': round(process['self'] - self.start['self'], 1),
+            'process_peak': process['self'],
+            'children_peak': process['children'],
+        }
+
+class RequestTrace:
+    """Stage timings, per-category timings and optional profiles for one request"""
+
+    def __init__(self, profile=None):
+        self.started = time.perf_counter()
+        self.timer = StageTimer()
+        self.categories = {}
+        self.profiler = None
+        self.tracing_memory = False
+        self.memory = MemoryTracker()
+        self.start_profiling(profile if profile is not None else PROFILE)
+
+    def start_profiling(self, profile):
+        """Start cProfile and/or tracemalloc ('cprofile', 'tracemalloc' or 'all') if not already running"""
+        if profile in ('cprofile', 'all') and self.profiler is None:
+            import cProfile
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        if profile in ('tracemalloc', 'all') and not self.tracing_memory:
+            import tracemalloc
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.tracing_memory = True
+
+    def stage(self, name):
+        return self.timer.stage(name)
+
+    def add_category(self, category, method, timings):
+        self.categories[category] = dict(timings or {}, method=method)
+
+    def _dump_path(self, suffix):
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        return os.path.join(PROFILE_DIR, f"request-{int(time.time() * 1000)}-{os.getpid()}{suffix}")
+
+    def _finish_profiles(self):
+        """Stop the profilers and write their dumps; returns what was written"""
+        dumps = {}
+        if self.profiler is not None:
+            self.profiler.disable()
+            try:
+                dumps['cprofile'] = self._dump_path('.prof')
+                self.profiler.dump_stats(dumps['cprofile'])
+            except OSError as e:
+                get_logger().warning(f"⚠️ Could not write cProfile dump: {e}")
+            self.profiler = None
+        if self.tracing_memory:
+            import tracemalloc
+            snapshot = tracemalloc.take_snapshot()
+            dumps['tracemalloc_peak_mb'] = round(tracemalloc.get_traced_memory()[1] / (1024 * 1024), 2)
+            tracemalloc.stop()
+            self.tracing_memory = False
+            try:
+                dumps['tracemalloc'] = self._dump_path('.tracemalloc.txt')
+                with open(dumps['tracemalloc'], 'w') as f:
+                    for stat in snapshot.statistics('lineno')[:TRACEMALLOC_TOP_LINES]:
+                        f.write(f"{stat}\n")
+            except OSError as e:
+                get_logger().warning(f"⚠️ Could not write tracemalloc dump: {e}")
+        return dumps
+
+    def finish(self):
+        """The trace as a JSON-friendly dict; stops any profiling"""
+        stages = self.timer.as_dict()
+        # Request-level fit/predict/cap are the totals over categories
+        for timings in self.categories.values():
+            for name, ms in timings.items():
+                if name != 'method':
+                    stages[name] = round(stages.get(name, 0.0) + ms, 2)
+        trace = {
+            'total_ms': round((time.perf_counter() - self.started) * 1000, 2),
+            'stages_ms': stages,
+            'categories': self.categories,
+            'memory_mb': self.memory.finish(),
+        }
+        dumps = self._finish_profiles()
+        if dumps:
+            trace['profile'] = dumps
+        return trace
+
+def emit_trace(trace):
+    """Write a finished trace as one JSON line on stderr"""
+    if TRACE_ENABLED:
+        sys.stderr.write(TRACE_PREFIX + json.dumps(trace) + '\n')
+        sys.stderr.flush()
@@ -0,0 +1,263 @@
+"""
+Fitted Prophet model store for cloud_predictor.py
+==================================================
+
+Fitted models are keyed by category plus a content hash of the series they were
+fitted on, serialized with Prophet's JSON model serialization and kept on disk,
+with a bounded in-memory LRU in front. The whole store is tied to a training data
+version: when training_data.json is regenerated the on-disk entries are dropped.
+Between regenerations the directory is held to MODEL_CACHE_DISK_ENTRIES files and
+MODEL_CACHE_DISK_MB megabytes by evicting the least recently used models (by file
+mtime, which reads refresh).
+
+WarmStartStore keeps the last fitted Prophet parameters per series (a user and
+category) so the next refit of that series can start the optimizer from them. It
+lives in its own directory because warm starts stay useful across training data
+versions. It is held to MODEL_WARM_START_DISK_ENTRIES files the same way, and when
+the training data changes, the parameters of series it no longer has are pruned.
+"""
+
+import os
+import json
+import shutil
+import hashlib
+from collections import OrderedDict
+
+from atomic_file import atomic_write
+from instrumentation import get_logger
+
+logger = get_logger('predictor.model_store')
+
+MODEL_CACHE_DIR = os.environ.get('MODEL_CACHE_DIR', 'model_cache')
+MODEL_CACHE_SIZE = int(os.environ.get('MODEL_CACHE_SIZE', '64'))
+WARM_START_DIR = os.environ.get('MODEL_WARM_START_DIR', 'model_warm_start')
+WARM_START_MEMORY_SIZE = int(os.environ.get('MODEL_WARM_START_SIZE', '1024'))
+
+# Limits of the on-disk directories (0 = unlimited); the least recently used files go first
+MODEL_CACHE_DISK_ENTRIES = int(os.environ.get('MODEL_CACHE_DISK_ENTRIES', '1024'))
+MODEL_CACHE_DISK_MB = float(os.environ.get('MODEL_CACHE_DISK_MB', '512'))
+WARM_START_DISK_ENTRIES = int(os.environ.get('MODEL_WARM_START_DISK_ENTRIES', '100000'))
+
+# Bump when the Prophet settings in predict_category change so stale fits are never reused
+MODEL_CONFIG_VERSION = 1
+
+VERSION_FILE = 'training_version.json'
+
+def series_key(category, df, variant=None):
+    """Build a store key from the category and a content hash of the (ds, y) series
+    
+    variant names optional model settings (such as holidays) that change the fit.
+    """
+    digest = hashlib.sha256()
+    digest.update(f"v{MODEL_CONFIG_VERSION}|{category}|".encode('utf-8'))
+    if variant:
+        digest.update(f"{variant}|".encode('utf-8'))
+    digest.update(df['ds'].values.astype('datetime64[ns]').tobytes())
+    digest.update(df['y'].values.astype('float64').tobytes())
+    safe_category = ''.join(c if c.isalnum() else '_' for c in str(category).lower())
+    return f"{safe_category}-{digest.hexdigest()[:32]}"
+
+def touch(path):
+    """Mark a stored file as just used, for evict_lru"""
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+def evict_lru(directory, max_entries=0, max_bytes=0):
+    """Remove the least recently used entry files (oldest mtime first) of a store directory
+    until at most max_entries files and max_bytes bytes remain (0 = no limit)
+
+    Returns how many files were removed.
+    """
+    if not max_entries and not max_bytes:
+        return 0
+    files = []
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if not entry.name.endswith('.json') or entry.name == VERSION_FILE:
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                files.append((stat.st_mtime_ns, stat.st_size, entry.path))
+    except OSError:
+        return 0
+
+    count = len(files)
+    total_bytes = sum(size for _, size, _ in files)
+    removed = 0
+    for _, size, path in sorted(files):
+        if (not max_entries or count <= max_entries) and (not max_bytes or total_bytes <= max_bytes):
+            break
+        try:
+            os.remove(path)
+            removed += 1
+        except OSError:
+            pass
+        # Gone either way (another process may have evicted it first)
+        count -= 1
+        total_bytes -= size
+    return removed
+
+class FittedModelStore:
+    """On-disk store of fitted Prophet models with an in-memory LRU in front"""
+
+    def __init__(self, cache_dir=MODEL_CACHE_DIR, max_entries=MODEL_CACHE_SIZE, max_disk_entries=MODEL_CACHE_DISK_ENTRIES,
+                 max_disk_mb=MODEL_CACHE_DISK_MB):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self.max_disk_bytes = int(max_disk_mb * 1024 * 1024)
+        self.memory = OrderedDict()
+        self.training_version = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def set_training_version(self, version):
+        """Invalidate every entry if the training data changed since the models were fitted
+
+        Returns True when the on-disk store was cleared for a new training data version.
+        """
+        version = list(version) if version else None
+        if version == self.training_version:
+            return False
+
+        version_path = os.path.join(self.cache_dir, VERSION_FILE)
+        stored_version = None
+        try:
+            with open(version_path, 'r') as f:
+                stored_version = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+        changed = stored_version != version
+        if changed:
+            logger.info(f"🗑️ Training data changed - clearing fitted model store {self.cache_dir}")
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
+            try:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                with open(version_path, 'w') as f:
+                    json.dump(version, f)
+            except OSError as e:
+                logger.warning(f"⚠️ Could not initialise fitted model store: {e}")
+
+        self.memory.clear()
+        self.training_version = version
+        return changed
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def _remember(self, key, model):
+        self.memory[key] = model
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    def get(self, key):
+        """Return a fitted model for this key, or None if it has to be fitted"""
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            touch(self._path(key))
+            self.hits += 1
+            return self.memory[key]
+
+        try:
+            from prophet.serialize import model_from_json
+            with open(self._path(key), 'r') as f:
+                model = model_from_json(f.read())
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except Exception as e:
+            logger.warning(f"⚠️ Discarding unreadable fitted model {key}: {e}")
+            self.misses += 1
+            return None
+
+        touch(self._path(key))
+        self._remember(key, model)
+        self.hits += 1
+        return model
+
+    def put(self, key, model):
+        """Store a freshly fitted model in memory and on disk"""
+        self._remember(key, model)
+        try:
+            from prophet.serialize import model_to_json
+            os.makedirs(self.cache_dir, exist_ok=True)
+            atomic_write(self._path(key), model_to_json(model))
+        except Exception as e:
+            logger.warning(f"⚠️ Could not persist fitted model {key}: {e}")
+            return
+        evicted = evict_lru(self.cache_dir, self.max_disk_entries, self.max_disk_bytes)
+        if evicted:
+            self.evictions += evicted
+            logger.debug(f"🗑️ Evicted {evicted} least recently used fitted models from {self.cache_dir}")
+
+class WarmStartStore:
+    """Last fitted parameters per series, kept in memory and as small JSON files on disk"""
+
+    def __init__(self, cache_dir=WARM_START_DIR, max_entries=WARM_START_MEMORY_SIZE, max_disk_entries=WARM_START_DISK_ENTRIES):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self.memory = OrderedDict()
+
+    def _path(self, series_id):
+        digest = hashlib.sha256(f"v{MODEL_CONFIG_VERSION}|{series_id}".encode('utf-8')).hexdigest()[:32]
+        return os.path.join(self.cache_dir, f"{digest}.json")
+
+    def _remember(self, series_id, record):
+        self.memory[series_id] = record
+        self.memory.move_to_end(series_id)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    def get(self, series_id):
+        """Return the stored warm start record for a series, or None"""
+        if series_id in self.memory:
+            self.memory.move_to_end(series_id)
+            return self.memory[series_id]
+        try:
+            with open(self._path(series_id), 'r') as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            return None
+        self._remember(series_id, record)
+        return record
+
+    def put(self, series_id, record):
+        """Remember a series' latest fitted parameters"""
+        self._remember(series_id, record)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            atomic_write(self._path(series_id), json.dumps(record))
+        except OSError as e:
+            logger.warning(f"⚠️ Could not persist warm start parameters for {series_id}: {e}")
+            return
+        evict_lru(self.cache_dir, self.max_disk_entries)
+
+    def prune(self, series_ids):
+        """Drop the parameters of every series not in series_ids; returns how many were removed"""
+        keep = {os.path.basename(self._path(series_id)) for series_id in series_ids}
+        self.memory = OrderedDict((series_id, record) for series_id, record in self.memory.items()
+                                  if os.path.basename(self._path(series_id)) in keep)
+        removed = 0
+        try:
+            with os.scandir(self.cache_dir) as entries:
+                for entry in entries:
+                    if entry.name.endswith('.json') and entry.name not in keep:
+                        try:
+                            os.remove(entry.path)
+                            removed += 1
+                        except OSError:
+                            pass
+        except OSError:
+            return 0
+        if removed:
+            logger.info(f"🗑️ Pruned warm start parameters of {removed} series no longer in the training data")
+        return removed
@@ -0,0 +1,138 @@
+/**
+ * CloudExpense Prediction Worker
+ *
+ * Keeps one long-lived `cloud_predictor.py --serve` process and sends every prediction
+ * request to it over stdin/stdout as newline-delimited JSON, so Python, Prophet and the
+ * training data are loaded once instead of on every request. The worker answers requests
+ * in the order they were sent. A worker that exits or stops answering is killed, its
+ * pending requests fail (predict.js falls back to the JavaScript prediction), and the
+ * next request starts a fresh one.
+ */
+
+const { spawn } = require('child_process');
+const path = require('path');
+
+// Configuration
+const PYTHON_COMMAND = process.platform === 'win32' ? 'python' : 'python3';
+const SCRIPT_PATH = path.join(__dirname, 'cloud_predictor.py');
+
+// A request that gets no answer within this time kills the worker (it is restarted on the next request)
+const REQUEST_TIMEOUT_MS = parseInt(process.env.PREDICTOR_REQUEST_TIMEOUT_MS || '60000', 10);
+
+// Lines the predictor writes to stderr with each request's timings
+const TRACE_PREFIX = 'PREDICTOR_TRACE ';
+
+let worker = null;
+
+// Requests sent to the current worker and not yet answered, oldest first
+let pending = [];
+
+function startWorker() {
+  console.log(`Starting Python prediction worker: ${PYTHON_COMMAND} ${SCRIPT_PATH} --serve`);
+  const child = spawn(PYTHON_COMMAND, [SCRIPT_PATH, '--serve'], { env: { ...process.env } });
+  let stdoutBuffer = '';
+  let stderrBuffer = '';
+
+  child.stdout.on('data', (data) => {
+    stdoutBuffer += data.toString();
+    let newline;
+    while ((newline = stdoutBuffer.indexOf('\n')) !== -1) {
+      const line = stdoutBuffer.slice(0, newline);
+      stdoutBuffer = stdoutBuffer.slice(newline + 1);
+      if (line.trim()) {
+        handleAnswer(child, line);
+      }
+    }
+  });
+
+  child.stderr.on('data', (data) => {
+    stderrBuffer += data.toString();
+    const lines = stderrBuffer.split('\n');
+    stderrBuffer = lines.pop();
+    lines.filter(line => line).forEach(logWorkerLine);
+  });
+
+  child.on('error', (err) => {
+    console.log(`Python prediction worker error: ${err.message}`);
+    stopWorker(child, err);
+  });
+
+  child.on('close', (code, signal) => {
+    console.log(`Python prediction worker exited with ${signal ? `signal ${signal}` : `code ${code}`}`);
+    stopWorker(child, new Error('prediction worker exited'));
+  });
+
+  // A failed write surfaces as an 'error' or 'close' on the process as well
+  child.stdin.on('error', () => {});
+  return child;
+}
+
+function handleAnswer(child, line) {
+  if (child !== worker) {
+    return;
+  }
+  let answer;
+  try {
+    answer = JSON.parse(line);
+  } catch (parseError) {
+    // Not an answer (stray library output); the request is still waiting for its own
+    console.log('Ignoring non-JSON output from Python prediction worker:', line);
+    return;
+  }
+  const request = pending.shift();
+  if (request) {
+    clearTimeout(request.timer);
+    request.resolve(answer);
+  }
+}
+
+function logWorkerLine(line) {
+  if (!line.startsWith(TRACE_PREFIX)) {
+    console.log(`Python predictor log: ${line}`);
+    return;
+  }
+  try {
+    const trace = JSON.parse(line.slice(TRACE_PREFIX.length));
+    console.log('Python predictor timings (ms):', JSON.stringify({ total: trace.total_ms, ...trace.stages_ms }));
+  } catch (traceError) {
+    console.log('Could not parse predictor trace:', traceError.message);
+  }
+}
+
+// Forget a worker that died or hung and fail every request it still owed an answer
+function stopWorker(child, err) {
+  if (child !== worker) {
+    return;
+  }
+  worker = null;
+  const failed = pending;
+  pending = [];
+  failed.forEach(request => {
+    clearTimeout(request.timer);
+    request.reject(err);
+  });
+  if (child.exitCode === null && child.signalCode === null) {
+    child.kill('SIGKILL');
+  }
+}
+
+/**
+ * Run one prediction request ({ user_id, records }) on the long-lived worker.
+ * Resolves with what the predictor prints for it ({ category: total }).
+ */
+function predict(request) {
+  if (!worker) {
+    worker = startWorker();
+  }
+  const child = worker;
+  return new Promise((resolve, reject) => {
+    const timer = setTimeout(() => {
+      console.log(`Python prediction worker gave no answer in ${REQUEST_TIMEOUT_MS}ms - restarting it`);
+      stopWorker(child, new Error('prediction worker timed out'));
+    }, REQUEST_TIMEOUT_MS);
+    pending.push({ resolve, reject, timer });
+    child.stdin.write(JSON.stringify(request) + '\n');
+  });
+}
+
+module.exports = { predict };
@@ -0,0 +1,204 @@
+"""
+Mergeable spending quantile sketches for the training stores
+============================================================
+
+predict_category's caps used to come from fixed multipliers on this month's daily
+average. A KLL sketch of each key's per-day spending totals gives the predictor the
+real distribution instead. It is held in O(k) space, however long the history, and
+it never reads the history itself.
+
+KLLSketch keeps its values in levels of compactors. An item at level h stands for
+2^h values. When a level outgrows its capacity it is sorted and every other item
+moves up a level, alternating between the even and odd positions. Two sketches merge
+by concatenating their levels and compacting, so sketches built separately (per
+shard, per month, per user) combine in O(k). Rank error is about 1.7/k, and a sketch
+is exact until it holds more than k values.
+
+A SpendingSketch pairs a sketch of per-day totals with the days of history it covers
+(from the key's first day of spending to the end of the store), so spending frequency
+is count / span_days. Merging two SpendingSketches adds their spans as well.
+
+Sketch tables are written next to a store's rollups, with one sketch per category
+code:
+
+  sketch_items.npy         float64 compactor items of every sketch, concatenated
+  sketch_levels.npy        int8 level of each item (its weight is 2^level)
+  sketch_item_offsets.npy  int64 start of each sketch's items (plus the total)
+  sketch_counts.npy / sketch_totals.npy / sketch_mins.npy / sketch_maxs.npy
+  sketch_spans.npy         int32 days of history each sketch covers
+
+Tables are opened memory-mapped. Loading one key's sketch reads only its own items.
+"""
+
+import os
+import math
+from collections import namedtuple
+
+import numpy as np
+
+# Compactor size: larger sketches are more accurate (rank error ~1.7/k) and bigger
+SKETCH_K = int(os.environ.get('SKETCH_K', '200'))
+
+SKETCH_FIELDS = ('items', 'levels', 'item_offsets', 'counts', 'totals', 'mins', 'maxs', 'spans')
+
+# A key's per-day spending totals and the days of history they were observed over
+SpendingSketch = namedtuple('SpendingSketch', ['daily', 'span_days'])
+
+class KLLSketch:
+    """Mergeable quantile sketch of a stream of values in O(k) space"""
+
+    def __init__(self, k=None):
+        self.k = k or SKETCH_K
+        self.levels = [np.empty(0, dtype=np.float64)]
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self.compactions = 0
+
+    def __len__(self):
+        return self.count
+
+    def capacity(self, level):
+        """Items a level may hold; lower levels get geometrically less room"""
+        depth = len(self.levels) - 1 - level
+        return max(2, int(math.ceil(self.k * (2 / 3) ** depth)))
+
+    def update(self, values):
+        """Add a batch of values"""
+        values = np.asarray(values, dtype=np.float64).ravel()
+        if not len(values):
+            return self
+        self.count += len(values)
+        self.total += float(values.sum())
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self._compress()
+        return self
+
+    def merge(self, other):
+        """Fold another sketch into this one (both keep summarizing their union)"""
+        if not other.count:
+            return self
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.empty(0, dtype=np.float64))
+        for level, items in enumerate(other.levels):
+            self.levels[level] = np.concatenate([self.levels[level], items])
+        self.count += other.count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.compactions += other.compactions
+        self._compress()
+        return self
+
+    def _compress(self):
+        # Adding a level shrinks the capacity of the ones below it, so repeat until all fit
+        compacted = True
+        while compacted:
+            compacted = False
+            for level in range(len(self.levels)):
+                items = self.levels[level]
+                if len(items) <= self.capacity(level):
+                    continue
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.empty(0, dtype=np.float64))
+                items = np.sort(items)
+                # An odd item out stays; the rest pair up and one of each pair moves up at twice the weight
+                odd = len(items) % 2
+                offset = self.compactions % 2
+                self.compactions += 1
+                self.levels[level] = items[:odd]
+                self.levels[level + 1] = np.concatenate([self.levels[level + 1], items[odd + offset::2]])
+                compacted = True
+
+    def weighted_items(self):
+        """Every item in sorted order with the number of values it stands for"""
+        items = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(items), 1 << level, dtype=np.int64) for level, items in enumerate(self.levels)])
+        order = np.argsort(items, kind='stable')
+        return items[order], weights[order]
+
+    def quantiles(self, qs):
+        """Values at the given quantiles (0 = min, 1 = max); NaN for an empty sketch"""
+        qs = np.asarray(qs, dtype=np.float64)
+        if not self.count:
+            return np.full(qs.shape, np.nan)
+        items, weights = self.weighted_items()
+        cumulative = np.cumsum(weights)
+        positions = np.searchsorted(cumulative, qs * cumulative[-1], side='left')
+        values = items[np.minimum(positions, len(items) - 1)]
+        return np.where(qs <= 0, self.min, np.where(qs >= 1, self.max, values))
+
+    def quantile(self, q):
+        return float(self.quantiles([q])[0])
+
+    def rank(self, value):
+        """Fraction of the values that are <= value"""
+        if not self.count:
+            return math.nan
+        items, weights = self.weighted_items()
+        return float(weights[:np.searchsorted(items, value, side='right')].sum()) / self.count
+
+    def size(self):
+        """Items held (bounded by about 3k, whatever the count)"""
+        return sum(len(items) for items in self.levels)
+
+def spending_sketch(days, totals, last_day, k=None):
+    """SpendingSketch of one key's per-day totals (days sorted), observed up to last_day"""
+    sketch = KLLSketch(k).update(totals)
+    span_days = int(last_day) - int(days[0]) + 1 if len(days) else 0
+    return SpendingSketch(sketch, span_days)
+
+def merge_spending(sketches, k=None):
+    """One SpendingSketch summarizing several (shards, months or users)"""
+    merged = KLLSketch(k)
+    span_days = 0
+    for sketch in sketches:
+        if sketch is None:
+            continue
+        merged.merge(sketch.daily)
+        span_days += sketch.span_days
+    return SpendingSketch(merged, span_days)
+
+def write_sketch_table(path, sketches, prefix='sketch'):
+    """Save SpendingSketches (one per category code) as <prefix>_<field>.npy arrays"""
+    item_offsets = np.zeros(len(sketches) + 1, dtype=np.int64)
+    items, levels = [], []
+    for index, sketch in enumerate(sketches):
+        for level, level_items in enumerate(sketch.daily.levels):
+            items.append(level_items)
+            levels.append(np.full(len(level_items), level, dtype=np.int8))
+        item_offsets[index + 1] = item_offsets[index] + sketch.daily.size()
+    table = {
+        'items': np.concatenate(items) if items else np.empty(0, dtype=np.float64),
+        'levels': np.concatenate(levels) if levels else np.empty(0, dtype=np.int8),
+        'item_offsets': item_offsets,
+        'counts': np.array([sketch.daily.count for sketch in sketches], dtype=np.int64),
+        'totals': np.array([sketch.daily.total for sketch in sketches], dtype=np.float64),
+        'mins': np.array([sketch.daily.min for sketch in sketches], dtype=np.float64),
+        'maxs': np.array([sketch.daily.max for sketch in sketches], dtype=np.float64),
+        'spans': np.array([sketch.span_days for sketch in sketches], dtype=np.int32),
+    }
+    for field in SKETCH_FIELDS:
+        np.save(os.path.join(path, f"{prefix}_{field}.npy"), table[field])
+    return {'k': sketches[0].daily.k if sketches else SKETCH_K, 'sketches': len(sketches), 'items': len(table['items'])}
+
+def load_sketch_table(path, prefix='sketch'):
+    """A sketch table's arrays, memory-mapped"""
+    return {field: np.load(os.path.join(path, f"{prefix}_{field}.npy"), mmap_mode='r') for field in SKETCH_FIELDS}
+
+def table_sketch(table, index, k=None):
+    """The SpendingSketch stored at one index of a loaded table"""
+    start, end = int(table['item_offsets'][index]), int(table['item_offsets'][index + 1])
+    sketch = KLLSketch(k)
+    items = np.asarray(table['items'][start:end], dtype=np.float64)
+    levels = np.asarray(table['levels'][start:end])
+    height = int(levels.max()) + 1 if len(levels) else 1
+    sketch.levels = [items[levels == level] for level in range(height)]
+    sketch.count = int(table['counts'][index])
+    sketch.total = float(table['totals'][index])
+    sketch.min = float(table['mins'][index])
+    sketch.max = float(table['maxs'][index])
+    return SpendingSketch(sketch, int(table['spans'][index]))
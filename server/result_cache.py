@@ -0,0 +1,265 @@
+"""
+On-disk prediction result cache for cloud_predictor.py
+======================================================
+
+The reports page asks for the same forecast again and again: every refresh sends the
+same current month records. Results are cached on disk, so they survive across the
+one-process-per-request spawns of routes/predict.js, keyed on a canonical hash of:
+
+  - the request rows (order-independent, however they arrived) and user id
+  - the training data version (regenerating training data changes every key)
+  - the reference date the forecast is made from
+  - the predictor settings that change forecasts
+
+Entries expire after RESULT_CACHE_TTL_SECONDS. Once there are more than
+RESULT_CACHE_SIZE entries, the least recently used are evicted.
+
+Identical requests arriving together are coalesced. The first takes an flock on the
+key's own lock file and computes; the others wait on the lock and then read its result.
+Requests with other keys never wait for it. The holder removes the lock file when it is
+done, so lock files don't pile up; one left by a killed process is swept once it is
+older than the TTL.
+Hit and miss totals are kept in the cache directory and reported in the output
+metadata. RESULT_CACHE=0 turns the cache off.
+"""
+
+import os
+import json
+import time
+import hashlib
+from contextlib import contextmanager
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows: no coalescing, every miss computes
+    fcntl = None
+
+from atomic_file import atomic_write
+from instrumentation import get_logger
+
+logger = get_logger('predictor.result_cache')
+
+RESULT_CACHE_ENABLED = os.environ.get('RESULT_CACHE', '1') != '0'
+RESULT_CACHE_DIR = os.environ.get('RESULT_CACHE_DIR', 'result_cache')
+RESULT_CACHE_TTL_SECONDS = float(os.environ.get('RESULT_CACHE_TTL_SECONDS', '900'))
+RESULT_CACHE_SIZE = int(os.environ.get('RESULT_CACHE_SIZE', '1000'))
+
+# Bump when the cached entry layout, the key or the forecasting logic changes
+RESULT_CACHE_VERSION = 2
+
+LOCKS_DIR = 'locks'
+STATS_FILE = 'stats.json'
+
+def canonical_columns(columns):
+    """Request rows sorted by (day, category, amount), independent of row order and category codes"""
+    codes = np.asarray(columns.codes, dtype=np.int64)
+    used = np.unique(codes)
+    names = sorted(columns.categories[code] for code in used)
+    rank = np.zeros(len(columns.categories), dtype=np.int64)
+    rank[used] = [names.index(columns.categories[code]) for code in used]
+    ranks = rank[codes]
+    days = np.asarray(columns.days, dtype=np.int64)
+    amounts = np.round(np.asarray(columns.amounts, dtype=np.float64), 2)
+    order = np.lexsort((amounts, ranks, days))
+    return {
+        'categories': names,
+        'days': days[order].tolist(),
+        'codes': ranks[order].tolist(),
+        'amounts': amounts[order].tolist(),
+    }
+
+def request_key(columns, user_id, training_version, reference_date, config):
+    """Hex digest identifying a request's result (columns: the parsed request, e.g. TrainingColumns)"""
+    payload = {
+        'version': RESULT_CACHE_VERSION,
+        'records': canonical_columns(columns),
+        'user_id': None if user_id is None else str(user_id),
+        'training_version': list(training_version) if training_version else None,
+        'reference_date': reference_date,
+        'config': config,
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode('utf-8')).hexdigest()
+
+class ResultCache:
+    """Predictions and metadata per request key, as JSON files with a TTL and an LRU size bound"""
+
+    def __init__(self, cache_dir=RESULT_CACHE_DIR, ttl_seconds=RESULT_CACHE_TTL_SECONDS,
+                 max_entries=RESULT_CACHE_SIZE, enabled=RESULT_CACHE_ENABLED):
+        self.cache_dir = cache_dir
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.enabled = enabled
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def _open_locked(self, path):
+        """Open and flock a lock file, or None if it can't be opened
+        
+        A lock file may be removed by its holder while others wait on it; a waiter that
+        wakes up holding a removed file opens the path again.
+        """
+        while True:
+            try:
+                lock_file = open(path, 'a')
+            except OSError as e:
+                logger.warning(f"⚠️ Could not open result cache lock ({e}) - continuing unlocked")
+                return None
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                if os.stat(path).st_ino == os.fstat(lock_file.fileno()).st_ino:
+                    return lock_file
+            except OSError:
+                pass
+            lock_file.close()
+
+    @contextmanager
+    def _flock(self, name, remove=False):
+        """Hold an exclusive flock on a lock file in the cache directory; with remove=True the
+        file is removed before the lock is released"""
+        if fcntl is None:
+            yield
+            return
+        path = os.path.join(self.cache_dir, LOCKS_DIR, name)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        except OSError:
+            pass
+        lock_file = self._open_locked(path)
+        if lock_file is None:
+            yield
+            return
+        with lock_file:
+            try:
+                yield
+            finally:
+                if remove:
+                    self._remove(path)
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def lock(self, key):
+        """Lock shared by the requests with this key only"""
+        return self._flock(f"{key}.lock", remove=True)
+
+    def get(self, key):
+        """(predictions, meta) for a key, or None when missing or expired"""
+        path = self._path(key)
+        try:
+            with open(path, 'r') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if time.time() - entry.get('created', 0) > self.ttl_seconds:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        try:
+            # The file's mtime is its last use, for LRU eviction
+            os.utime(path)
+        except OSError:
+            pass
+        return entry['predictions'], entry['meta']
+
+    def put(self, key, predictions, meta):
+        """Store a result and evict past the size bound"""
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            atomic_write(self._path(key), json.dumps({'created': time.time(), 'predictions': predictions, 'meta': meta}))
+            self.evict()
+        except OSError as e:
+            logger.warning(f"⚠️ Could not store prediction result: {e}")
+
+    def evict(self):
+        """Drop expired entries, then the least recently used ones beyond max_entries"""
+        now = time.time()
+        entries = []
+        with os.scandir(self.cache_dir) as scan:
+            for entry in scan:
+                if not entry.name.endswith('.json') or entry.name == STATS_FILE:
+                    continue
+                try:
+                    mtime = entry.stat().st_mtime
+                except OSError:
+                    continue
+                # A file not used within the TTL was also created before it, so it has expired
+                if now - mtime > self.ttl_seconds:
+                    self._remove(entry.path)
+                else:
+                    entries.append((mtime, entry.path))
+        self._sweep_locks(now)
+        if len(entries) > self.max_entries:
+            entries.sort()
+            for _, path in entries[:len(entries) - self.max_entries]:
+                self._remove(path)
+
+    def _sweep_locks(self, now):
+        """Remove key lock files older than the TTL, left behind by processes that were killed"""
+        try:
+            scan = os.scandir(os.path.join(self.cache_dir, LOCKS_DIR))
+        except OSError:
+            return
+        with scan:
+            for entry in scan:
+                if entry.name == 'stats.lock':
+                    continue
+                try:
+                    if now - entry.stat().st_mtime > self.ttl_seconds:
+                        self._remove(entry.path)
+                except OSError:
+                    continue
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def count(self, status):
+        """Add one hit or miss to the totals on disk and return them"""
+        stats_path = os.path.join(self.cache_dir, STATS_FILE)
+        stats = {'hits': 0, 'misses': 0}
+        try:
+            with self._flock('stats.lock'):
+                try:
+                    with open(stats_path, 'r') as f:
+                        stats.update(json.load(f))
+                except (OSError, ValueError):
+                    pass
+                stats['misses' if status == 'miss' else 'hits'] += 1
+                atomic_write(stats_path, json.dumps(stats))
+        except OSError as e:
+            logger.warning(f"⚠️ Could not update result cache stats: {e}")
+        return stats
+
+    def get_or_compute(self, key, compute, cacheable=None):
+        """(predictions, meta) for a key, calling compute() only if no cached or concurrent result exists
+
+        meta gains a 'result_cache' entry: status (hit, coalesced, miss or disabled) and the
+        hit and miss totals. A coalesced request waited for an identical one to finish.
+        Computed results are stored unless cacheable(result) says otherwise.
+        """
+        if not self.enabled:
+            predictions, meta = compute()
+            return predictions, dict(meta, result_cache={'status': 'disabled'})
+
+        result = self.get(key)
+        status = 'hit'
+        if result is None:
+            with self.lock(key):
+                result = self.get(key)
+                status = 'coalesced'
+                if result is None:
+                    status = 'miss'
+                    result = compute()
+                    if cacheable is None or cacheable(result):
+                        self.put(key, *result)
+
+        predictions, meta = result
+        stats = self.count(status)
+        logger.debug(f"🗃️ Result cache {status} ({stats['hits']} hits, {stats['misses']} misses)")
+        return predictions, dict(meta, result_cache=dict(stats, status=status))
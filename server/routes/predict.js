@@ -2,6 +2,7 @@
 const express = require('express');
 const router = express.Router();
 const db = require('../db');
+const predictorWorker = require('../predictor-worker');
 
 // POST /predict - Get user expenses and run local AI prediction
 router.post('/', async (req, res) => {
@@ -77,90 +78,41 @@ router.post('/', async (req, res) => {
       return res.status(400).json({ message: 'No expense data available for prediction' });
     }
     
-    // Always use Prophet AI for predictions
-    const { spawn } = require('child_process');
-    const path = require('path');
-    
-    // Adjust for different Python command based on environment
-    const pythonCommand = process.platform === 'win32' ? 'python' : 'python3';
-    const pythonScript = path.join(__dirname, '../cloud_predictor.py');
-    
-    console.log(`Using Python command: ${pythonCommand}`);
-    console.log(`Python script path: ${pythonScript}`);
-    console.log(`Platform: ${process.platform}`);
-    
-    const pythonProcess = spawn(pythonCommand, [pythonScript]);
-    
-    let output = '';
-    let errorOutput = '';
+    // Always use Prophet AI for predictions, on the long-lived Python worker (see predictor-worker.js).
+    // The user id lets the predictor train on this user's own history shard.
+    let predictions;
+    try {
+      predictions = await predictorWorker.predict({ user_id: String(userId), records: trainingData });
+      console.log('Parsed predictions:', predictions);
+    } catch (workerError) {
+      console.log(`Prophet AI failed (${workerError.message}), using mathematical fallback`);
+      // Fall back to simple prediction if Python fails
+      const fallbackPredictions = await generateFallbackPredictions(trainingData);
+      return res.status(200).json({ 
+        predictions: fallbackPredictions, 
+        data_points_used: trainingData.length,
+        message: 'Prediction successful (Enhanced Malaysian AI with Historical Learning)' 
+      });
+    }
     
-    pythonProcess.stdout.on('data', (data) => {
-      output += data.toString();
-      console.log('Python output received:', data.toString().substring(0, 100) + '...');
-    });
+    if (!predictions || typeof predictions !== 'object' || Object.keys(predictions).length === 0) {
+      // If Prophet returns empty, use fallback
+      const fallbackPredictions = await generateFallbackPredictions(trainingData);
+      console.log('Prophet AI returned empty results, using fallback');
+      return res.status(200).json({ 
+        predictions: fallbackPredictions, 
+        data_points_used: trainingData.length,
+        message: 'Prediction successful (Enhanced Malaysian AI with Historical Learning)' 
+      });
+    }
     
-    pythonProcess.stderr.on('data', (data) => {
-      errorOutput += data.toString();
-      console.log('=== PYTHON STDERR ===:', data.toString()); // Enhanced logging
-    });
-
-    pythonProcess.on('close', async (code) => {
-      console.log('=== PYTHON PROCESS RESULT ===');
-      console.log('Exit code:', code);
-      console.log('Full stderr:', errorOutput);
-      console.log('Full stdout:', output);
-      console.log('================================');
-      
-      if (code !== 0) {
-        console.error('Python predictor error:', errorOutput);
-        console.log('Prophet AI failed, using mathematical fallback');
-        // Fall back to simple prediction if Python fails
-        const fallbackPredictions = await generateFallbackPredictions(trainingData);
-        return res.status(200).json({ 
-          predictions: fallbackPredictions, 
-          data_points_used: trainingData.length,
-          message: 'Prediction successful (Enhanced Malaysian AI with Historical Learning)' 
-        });
-      }
-      
-      try {
-        console.log('Raw Python output:', output);
-        const predictions = JSON.parse(output);
-        console.log('Parsed predictions:', predictions);
-        
-        if (Object.keys(predictions).length === 0) {
-          // If Prophet returns empty, use fallback
-          const fallbackPredictions = await generateFallbackPredictions(trainingData);
-          console.log('Prophet AI returned empty results, using fallback');
-          return res.status(200).json({ 
-            predictions: fallbackPredictions, 
-            data_points_used: trainingData.length,
-            message: 'Prediction successful (Enhanced Malaysian AI with Historical Learning)' 
-          });
-        }
-        
-        console.log('Prophet AI prediction successful!');
-        res.status(200).json({ 
-          predictions, 
-          data_points_used: trainingData.length,
-          message: 'Prediction successful (Prophet AI)' 
-        });
-      } catch (parseError) {
-        console.error('Failed to parse Python output:', output);
-        console.log('Prophet AI output parsing failed, using mathematical fallback');
-        const fallbackPredictions = await generateFallbackPredictions(trainingData);
-        res.status(200).json({ 
-          predictions: fallbackPredictions, 
-          data_points_used: trainingData.length,
-          message: 'Prediction successful (Enhanced Malaysian AI with Historical Learning)' 
-        });
-      }
+    console.log('Prophet AI prediction successful!');
+    res.status(200).json({ 
+      predictions, 
+      data_points_used: trainingData.length,
+      message: 'Prediction successful (Prophet AI)' 
     });
     
-    // Send data to Python process
-    pythonProcess.stdin.write(JSON.stringify(trainingData));
-    pythonProcess.stdin.end();
-    
     // Helper function for ENHANCED Malaysian AI predictions
     async function generateFallbackPredictions(data) {
       const predictions = {};
@@ -177,29 +129,37 @@ router.post('/', async (req, res) => {
       // 📊 HISTORICAL LEARNING MEMORY - Get user's past patterns
       const historicalPatterns = {};
       try {
+        // One pass over the user's monthly totals for every category at once
+        const historyResult = await db.query(
+          `SELECT 
+             category,
+             AVG(total_spent) as avg_monthly_spend,
+             AVG(total_spent / EXTRACT(DAY FROM month + INTERVAL '1 month - 1 day')) as avg_daily_rate
+           FROM (
+             SELECT 
+               category,
+               DATE_TRUNC('month', created_at) as month,
+               SUM(amount) as total_spent
+             FROM transactions 
+             WHERE user_id = $1 AND category = ANY($2)
+             AND created_at >= NOW() - INTERVAL '6 months'
+             AND created_at < DATE_TRUNC('month', NOW())
+             GROUP BY category, DATE_TRUNC('month', created_at)
+           ) monthly_totals
+           GROUP BY category`,
+          [userId, categories]
+        );
+        const historyByCategory = {};
+        historyResult.rows.forEach(row => {
+          historyByCategory[row.category] = row;
+        });
+        
         for (const category of categories) {
-          const historyResult = await db.query(
-            `SELECT 
-               AVG(total_spent) as avg_monthly_spend,
-               AVG(total_spent / EXTRACT(DAY FROM DATE_TRUNC('month', created_at) + INTERVAL '1 month - 1 day')) as avg_daily_rate
-             FROM (
-               SELECT 
-                 EXTRACT(YEAR FROM created_at) as year,
-                 EXTRACT(MONTH FROM created_at) as month,
-                 SUM(amount) as total_spent
-               FROM transactions 
-               WHERE user_id = $1 AND category = $2
-               AND created_at >= NOW() - INTERVAL '6 months'
-               AND created_at < DATE_TRUNC('month', NOW())
-               GROUP BY EXTRACT(YEAR FROM created_at), EXTRACT(MONTH FROM created_at)
-             ) monthly_totals`,
-            [userId, category]
-          );
-          
-          if (historyResult.rows[0]?.avg_monthly_spend) {
+          const history = historyByCategory[category];
+          if (history?.avg_monthly_spend) {
             historicalPatterns[category] = {
-              avgMonthlySpend: parseFloat(historyResult.rows[0].avg_monthly_spend),
-              avgDailyRate: parseFloat(historyResult.rows[0].avg_daily_rate),
+              avgMonthlySpend: parseFloat(history.avg_monthly_spend),
+              avgDailyRate: parseFloat(history.avg_daily_rate),
               hasHistory: true
             };
             console.log(`📚 ${category} History: Avg RM${historicalPatterns[category].avgMonthlySpend.toFixed(2)}/month`);
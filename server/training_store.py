@@ -0,0 +1,944 @@
+"""
+Columnar training data store for the CloudExpense AI predictor
+===============================================================
+
+Training data is kept as a directory of NumPy arrays instead of one JSON array of dicts:
+
+  training_store/
+    meta.json              format version, row count, category dictionary
+    category_codes.npy     int32 index into meta.json's category list
+    day_ordinals.npy       int32 proleptic Gregorian ordinals (date.toordinal())
+    amounts.npy            float64 amounts
+    category_offsets.npy   int64 start of each category's rows (plus the total row count)
+    rollup_<period>_*.npy  per (category, day) and per (category, month) rollups of the rows
+
+The rollups are materialized when a store is written: for each category and each day
+(or month, keyed by the ordinal of its first day) the sum, count, mean and the
+ROLLUP_QUANTILES of the transaction amounts, laid out like the rows (partitioned by
+category with rollup_<period>_offsets.npy, sorted by period). Consumers that only need
+a statistic read a table bounded by categories x days, however many transactions
+there are.
+
+The arrays are opened memory-mapped, so loading the store costs a few page faults
+rather than parsing every record into Python objects.
+
+training_store (and training_shards) is a symlink to the current version directory,
+e.g. training_store.v1760000000000000000. A writer builds a new version next to it and
+repoints the link with one atomic rename, so the path always names a complete store.
+TrainingColumns.open() and TrainingShards.open() resolve the link once and read every
+file from that one version, so a refresh in the middle of an open can't pair one
+version's meta.json with another's arrays. The newest TRAINING_STORE_KEEP_VERSIONS
+versions are kept for readers that resolved an older link.
+
+Rows are partitioned by category and sorted by day inside each partition, so one
+category's history is a contiguous slice and a date range inside it is found with a
+binary search on the day column.
+
+Per-user history lives in training_shards/: users are hashed into a fixed number of
+shards, each a store of the same format keyed by "<user_id>/<category>", described by
+training_shards/manifest.json. The predictor opens only the requesting user's shard.
+Shard stores also hold sketch_*.npy: a KLL quantile sketch of each key's daily totals
+(see quantile_sketch.py), built from the daily rollup, which summarizes that user's
+spending distribution in constant space. The sketches of every shard are merged per
+category into training_shards/population_sketch_*.npy, the distribution of one user's
+daily spending across all users.
+"""
+
+import os
+import json
+import time
+import zlib
+import shutil
+from collections import namedtuple
+from datetime import date, datetime
+
+import numpy as np
+
+from quantile_sketch import SKETCH_K, load_sketch_table, merge_spending, spending_sketch, table_sketch, write_sketch_table
+
+TRAINING_STORE_DIR = os.environ.get('TRAINING_STORE_DIR', 'training_store')
+TRAINING_SHARDS_DIR = os.environ.get('TRAINING_SHARDS_DIR', 'training_shards')
+
+# Published versions kept per store, the current one included (see _publish)
+TRAINING_STORE_KEEP_VERSIONS = max(2, int(os.environ.get('TRAINING_STORE_KEEP_VERSIONS', '3')))
+
+# Users are hashed into this many per-user shards
+SHARD_COUNT = int(os.environ.get('TRAINING_SHARD_COUNT', '64'))
+
+STORE_FORMAT_VERSION = 2
+META_FILE = 'meta.json'
+CODES_FILE = 'category_codes.npy'
+DAYS_FILE = 'day_ordinals.npy'
+AMOUNTS_FILE = 'amounts.npy'
+OFFSETS_FILE = 'category_offsets.npy'
+SHARDS_MANIFEST_FILE = 'manifest.json'
+
+# Rollup periods and the per-group statistics stored for each
+ROLLUP_PERIODS = ('daily', 'monthly')
+ROLLUP_QUANTILES = (0.5, 0.9)
+ROLLUP_FIELDS = ('periods', 'sums', 'counts', 'means') + tuple(f"p{int(q * 100)}" for q in ROLLUP_QUANTILES)
+
+# Rows rolled up per pass when a store is finalized (whole categories, so a larger
+# category is rolled up on its own)
+ROLLUP_BLOCK_ROWS = 1000000
+
+# Ordinal of 1970-01-01, used to turn day ordinals into datetime64 values
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+# A category's (or a request's) expense history as parallel arrays. counts, when set,
+# holds how many transactions each row stands for (rows read from the daily rollup).
+History = namedtuple('History', ['days', 'amounts', 'counts'], defaults=(None,))
+
+def empty_history():
+    """History with no records"""
+    return History(np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float64))
+
+def concat_histories(*histories):
+    """Concatenate histories, keeping their order"""
+    counts = None
+    if any(h.counts is not None for h in histories):
+        counts = np.concatenate([
+            h.counts if h.counts is not None else np.ones(len(h.days), dtype=np.int64) for h in histories
+        ]).astype(np.int64, copy=False)
+    return History(
+        np.concatenate([h.days for h in histories]).astype(np.int32, copy=False),
+        np.concatenate([h.amounts for h in histories]).astype(np.float64, copy=False),
+        counts
+    )
+
+def history_points(history):
+    """Transactions a history stands for (rollup rows count every transaction they sum)"""
+    if history.counts is not None:
+        return int(np.sum(history.counts))
+    return len(history.days)
+
+def date_to_ordinal(value):
+    """Day ordinal of a date, datetime or 'YYYY-MM-DD' / ISO timestamp string"""
+    if isinstance(value, datetime):
+        return value.date().toordinal()
+    if isinstance(value, date):
+        return value.toordinal()
+    return date.fromisoformat(str(value)[:10]).toordinal()
+
+def parse_days(values):
+    """Day ordinals of many dates at once ('YYYY-MM-DD' / ISO timestamp strings, dates or datetimes)"""
+    if len(values) == 0:
+        return np.empty(0, dtype=np.int32)
+    # Only the calendar date matters; numpy parses the 'YYYY-MM-DD' prefix in one pass
+    dates = np.array([str(value)[:10] for value in values], dtype='U10').astype('datetime64[D]')
+    return (dates.astype(np.int64) + EPOCH_ORDINAL).astype(np.int32)
+
+def day_of_month(days):
+    """Day of the month (1-31) of each day ordinal"""
+    dates = ordinals_to_datetime64(days).astype('datetime64[D]')
+    return (dates - dates.astype('datetime64[M]')).astype(np.int64) + 1
+
+def aggregate_daily(history):
+    """Per-day spending totals of a history, one entry per day with spending"""
+    if len(history.days) == 0:
+        return empty_history()
+    days, inverse = np.unique(history.days, return_inverse=True)
+    return History(days.astype(np.int32), np.bincount(inverse, weights=history.amounts))
+
+def month_start_days(days):
+    """Ordinal of the first day of the month of each day ordinal"""
+    months = (np.asarray(days, dtype=np.int64) - EPOCH_ORDINAL).astype('datetime64[D]').astype('datetime64[M]')
+    return (months.astype('datetime64[D]').astype(np.int64) + EPOCH_ORDINAL).astype(np.int32)
+
+def rollup_rows(codes, periods, amounts):
+    """Sum, count, mean and quantiles per (code, period) of rows sorted by code then period
+    
+    Returns the group codes and a dict of ROLLUP_FIELDS arrays, one entry per group.
+    Sums add each group's rows in their stored order, so they match aggregate_daily.
+    """
+    codes = np.asarray(codes, dtype=np.int32)
+    periods = np.asarray(periods, dtype=np.int32)
+    amounts = np.asarray(amounts, dtype=np.float64)
+    if len(codes) == 0:
+        dtypes = {'periods': np.int32, 'counts': np.int64}
+        return codes, {field: np.empty(0, dtype=dtypes.get(field, np.float64)) for field in ROLLUP_FIELDS}
+    
+    starts = np.flatnonzero(np.r_[True, (codes[1:] != codes[:-1]) | (periods[1:] != periods[:-1])])
+    counts = np.diff(np.r_[starts, len(codes)])
+    group_ids = np.repeat(np.arange(len(starts)), counts)
+    sums = np.bincount(group_ids, weights=amounts)
+    
+    # Sorting by (group, amount) keeps every group contiguous, so quantiles interpolate
+    # between neighbours inside the group like np.percentile
+    ordered = amounts[np.lexsort((amounts, group_ids))]
+    rollup = {'periods': periods[starts], 'sums': sums, 'counts': counts.astype(np.int64), 'means': sums / counts}
+    for q in ROLLUP_QUANTILES:
+        position = q * (counts - 1)
+        low = np.floor(position).astype(np.int64)
+        high = np.minimum(low + 1, counts - 1)
+        lower = ordered[starts + low]
+        rollup[f"p{int(q * 100)}"] = lower + (ordered[starts + high] - lower) * (position - low)
+    return codes[starts], rollup
+
+def rollup_columns(codes, days, amounts, offsets, period):
+    """One rollup of partitioned columns as ROLLUP_FIELDS arrays plus per-category offsets"""
+    periods = days if period == 'daily' else month_start_days(days)
+    group_codes, rollup = rollup_rows(codes, periods, amounts)
+    rollup['offsets'] = np.zeros(len(offsets), dtype=np.int64)
+    np.cumsum(np.bincount(group_codes, minlength=len(offsets) - 1), out=rollup['offsets'][1:])
+    return rollup
+
+def write_rollups(store_path, offsets, block_rows=None):
+    """Materialize the daily and monthly rollups of a written store; returns their row counts
+    
+    Categories are rolled up in blocks of about block_rows rows, so memory stays bounded
+    by one block (or one larger category) while the result covers the whole store.
+    """
+    block_rows = block_rows or ROLLUP_BLOCK_ROWS
+    codes = np.load(os.path.join(store_path, CODES_FILE), mmap_mode='r')
+    days = np.load(os.path.join(store_path, DAYS_FILE), mmap_mode='r')
+    amounts = np.load(os.path.join(store_path, AMOUNTS_FILE), mmap_mode='r')
+    
+    parts = {period: [] for period in ROLLUP_PERIODS}
+    block_start = 0
+    for code in range(len(offsets) - 1):
+        block_end = int(offsets[code + 1])
+        if block_end - block_start < block_rows and code < len(offsets) - 2:
+            continue
+        for period in ROLLUP_PERIODS:
+            periods = days[block_start:block_end]
+            if period == 'monthly':
+                periods = month_start_days(periods)
+            group_codes, rollup = rollup_rows(codes[block_start:block_end], periods, amounts[block_start:block_end])
+            parts[period].append((group_codes, rollup))
+        block_start = block_end
+    
+    rows = {}
+    for period in ROLLUP_PERIODS:
+        group_codes = np.concatenate([part[0] for part in parts[period]] or [np.empty(0, dtype=np.int32)])
+        category_offsets = np.zeros(len(offsets), dtype=np.int64)
+        np.cumsum(np.bincount(group_codes, minlength=len(offsets) - 1), out=category_offsets[1:])
+        np.save(os.path.join(store_path, f"rollup_{period}_offsets.npy"), category_offsets)
+        for field in ROLLUP_FIELDS:
+            column = np.concatenate([part[1][field] for part in parts[period]] or [rollup_rows([], [], [])[1][field]])
+            np.save(os.path.join(store_path, f"rollup_{period}_{field}.npy"), column)
+        rows[period] = len(group_codes)
+    return {'rows': rows, 'quantiles': list(ROLLUP_QUANTILES)}
+
+def write_sketches(store_path, offsets):
+    """Build one spending sketch per category from a written store's daily rollup; returns their summary"""
+    periods = np.load(os.path.join(store_path, 'rollup_daily_periods.npy'), mmap_mode='r')
+    sums = np.load(os.path.join(store_path, 'rollup_daily_sums.npy'), mmap_mode='r')
+    rollup_offsets = np.load(os.path.join(store_path, 'rollup_daily_offsets.npy'))
+    last_day = int(periods.max()) if len(periods) else 0
+    sketches = []
+    for code in range(len(offsets) - 1):
+        start, end = int(rollup_offsets[code]), int(rollup_offsets[code + 1])
+        sketches.append(spending_sketch(periods[start:end], sums[start:end], last_day))
+    return write_sketch_table(store_path, sketches)
+
+def ordinals_to_datetime64(days):
+    """Convert day ordinals to a datetime64[ns] array"""
+    return (np.asarray(days, dtype=np.int64) - EPOCH_ORDINAL).astype('datetime64[D]').astype('datetime64[ns]')
+
+def columns_from_records(records):
+    """Encode a list of {date, category, amount} dicts as (categories, codes, days, amounts)"""
+    # Categories keep their first-appearance order so codes are stable for a given input
+    categories = list(dict.fromkeys(record['category'] for record in records))
+    category_index = {category: code for code, category in enumerate(categories)}
+    codes = np.fromiter((category_index[record['category']] for record in records), dtype=np.int32, count=len(records))
+    days = parse_days([record['date'] for record in records])
+    amounts = np.fromiter((float(record['amount']) for record in records), dtype=np.float64, count=len(records))
+
+    return categories, codes, days, amounts
+
+def partition_columns(categories, codes, days, amounts):
+    """Sort rows by (category, day) and return them with per-category offsets"""
+    codes = np.asarray(codes, dtype=np.int32)
+    days = np.asarray(days, dtype=np.int32)
+    amounts = np.asarray(amounts, dtype=np.float64)
+
+    # lexsort is stable, so same-day rows keep their original order
+    order = np.lexsort((days, codes))
+    codes, days, amounts = codes[order], days[order], amounts[order]
+
+    offsets = np.zeros(len(categories) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(codes, minlength=len(categories)), out=offsets[1:])
+    return codes, days, amounts, offsets
+
+def _version_number(path, name):
+    """The version of a "<store>.v<number>" directory name of path's store, or None"""
+    prefix = f"{os.path.basename(path)}.v"
+    suffix = name[len(prefix):]
+    return int(suffix) if name.startswith(prefix) and suffix.isdigit() else None
+
+def _publish(tmp_path, path):
+    """Make a finished store the one at path without path ever going missing
+    
+    tmp_path becomes a new version directory and the path symlink is repointed at it in
+    one rename, so readers see either the old store or the new one, never a mix.
+    """
+    parent = os.path.dirname(path) or '.'
+    version = f"{os.path.basename(path)}.v{time.time_ns()}"
+    os.rename(tmp_path, os.path.join(parent, version))
+    # Relative, so the store and its versions can be moved together
+    link_path = f"{path}.{os.getpid()}.link"
+    if os.path.lexists(link_path):
+        os.remove(link_path)
+    os.symlink(version, link_path)
+    if os.path.isdir(path) and not os.path.islink(path):
+        # A store written before versions were published: a directory can't be renamed over,
+        # so this one last swap leaves path briefly missing
+        old_path = f"{path}.old"
+        shutil.rmtree(old_path, ignore_errors=True)
+        os.rename(path, old_path)
+        os.replace(link_path, path)
+        shutil.rmtree(old_path, ignore_errors=True)
+    else:
+        os.replace(link_path, path)
+    _prune_versions(path)
+
+def _prune_versions(path):
+    """Remove all but the newest TRAINING_STORE_KEEP_VERSIONS versions of a store"""
+    parent = os.path.dirname(path) or '.'
+    versions = sorted(
+        (number, name) for number, name in
+        ((_version_number(path, name), name) for name in os.listdir(parent)) if number is not None
+    )
+    current = os.path.basename(os.path.realpath(path))
+    for _, name in versions[:-TRAINING_STORE_KEEP_VERSIONS]:
+        if name != current:
+            shutil.rmtree(os.path.join(parent, name), ignore_errors=True)
+
+def _write_meta(store_path, rows, categories, extra_meta=None):
+    meta = {
+        'format': STORE_FORMAT_VERSION,
+        'rows': int(rows),
+        'categories': list(categories),
+        'generated_at': datetime.now().isoformat(),
+    }
+    if extra_meta:
+        meta.update(extra_meta)
+    with open(os.path.join(store_path, META_FILE), 'w') as f:
+        json.dump(meta, f, indent=2)
+    return meta
+
+class TrainingStoreWriter:
+    """Incrementally writes a training store without holding the rows in memory
+
+    Appended rows are spilled to one raw file per category as they arrive. close()
+    concatenates the spills in category order into the final memory-mapped columns,
+    so peak memory is bounded by one chunk (or one out-of-order category) rather than
+    by the total row count.
+    """
+
+    def __init__(self, path=TRAINING_STORE_DIR):
+        self.path = path
+        self.tmp_path = f"{path}.tmp"
+        self.spill_path = os.path.join(self.tmp_path, 'spill')
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+        os.makedirs(self.spill_path)
+
+        self.categories = []
+        self.category_index = {}
+        self.counts = []
+        self.last_day = []
+        self.needs_sort = set()
+        self.spills = {}
+        self.rows = 0
+
+    def _code(self, category):
+        code = self.category_index.get(category)
+        if code is None:
+            code = self.category_index[category] = len(self.categories)
+            self.categories.append(category)
+            self.counts.append(0)
+            self.last_day.append(None)
+            self.spills[code] = (
+                open(os.path.join(self.spill_path, f"{code}.days"), 'wb'),
+                open(os.path.join(self.spill_path, f"{code}.amounts"), 'wb')
+            )
+        return code
+
+    def append(self, categories, days, amounts):
+        """Append a chunk of rows given as per-row category names, day ordinals and amounts"""
+        if len(categories) == 0:
+            return
+        chunk_categories, chunk_codes = np.unique(np.asarray(categories, dtype=object), return_inverse=True)
+        self.append_encoded(list(chunk_categories), chunk_codes, days, amounts)
+
+    def append_encoded(self, categories, codes, days, amounts):
+        """Append a chunk of dictionary-encoded rows (codes index into categories)"""
+        codes = np.asarray(codes).reshape(-1)
+        days = np.asarray(days, dtype=np.int32)
+        amounts = np.asarray(amounts, dtype=np.float64)
+
+        for local_code, category in enumerate(categories):
+            mask = codes == local_code
+            count = int(np.count_nonzero(mask))
+            if count == 0:
+                continue
+            code = self._code(category)
+            category_days = days[mask]
+
+            # Rows usually arrive in date order; remember categories that didn't
+            previous_day = self.last_day[code]
+            if (previous_day is not None and category_days[0] < previous_day) or np.any(np.diff(category_days) < 0):
+                self.needs_sort.add(code)
+            latest_day = int(category_days.max())
+            self.last_day[code] = latest_day if previous_day is None else max(previous_day, latest_day)
+
+            days_file, amounts_file = self.spills[code]
+            category_days.tofile(days_file)
+            amounts[mask].tofile(amounts_file)
+            self.counts[code] += count
+            self.rows += count
+
+    def append_columns(self, columns, since_day=None, block_rows=100000):
+        """Copy every category of an existing store (optionally only rows from since_day on)"""
+        copied = 0
+        for category in columns.categories:
+            start, end = columns.category_range(category, since_day=since_day)
+            for block_start in range(start, end, block_rows):
+                block_end = min(block_start + block_rows, end)
+                self.append_encoded(
+                    [category],
+                    np.zeros(block_end - block_start, dtype=np.int32),
+                    columns.days[block_start:block_end],
+                    columns.amounts[block_start:block_end]
+                )
+                copied += block_end - block_start
+        return copied
+
+    def close(self, extra_meta=None):
+        """Finalize the store, swap it into place and return its metadata"""
+        for days_file, amounts_file in self.spills.values():
+            days_file.close()
+            amounts_file.close()
+
+        try:
+            shape = (self.rows,)
+            codes_out = np.lib.format.open_memmap(os.path.join(self.tmp_path, CODES_FILE), mode='w+', dtype=np.int32, shape=shape)
+            days_out = np.lib.format.open_memmap(os.path.join(self.tmp_path, DAYS_FILE), mode='w+', dtype=np.int32, shape=shape)
+            amounts_out = np.lib.format.open_memmap(os.path.join(self.tmp_path, AMOUNTS_FILE), mode='w+', dtype=np.float64, shape=shape)
+            offsets = np.zeros(len(self.categories) + 1, dtype=np.int64)
+
+            position = 0
+            for code, count in enumerate(self.counts):
+                end = position + count
+                spill_days = np.memmap(os.path.join(self.spill_path, f"{code}.days"), dtype=np.int32, mode='r')
+                spill_amounts = np.memmap(os.path.join(self.spill_path, f"{code}.amounts"), dtype=np.float64, mode='r')
+                if code in self.needs_sort:
+                    order = np.argsort(spill_days, kind='stable')
+                    days_out[position:end] = spill_days[order]
+                    amounts_out[position:end] = spill_amounts[order]
+                else:
+                    days_out[position:end] = spill_days
+                    amounts_out[position:end] = spill_amounts
+                codes_out[position:end] = code
+                del spill_days, spill_amounts
+                position = end
+                offsets[code + 1] = end
+
+            for column in (codes_out, days_out, amounts_out):
+                column.flush()
+            del codes_out, days_out, amounts_out
+            np.save(os.path.join(self.tmp_path, OFFSETS_FILE), offsets)
+            shutil.rmtree(self.spill_path)
+            rollups = write_rollups(self.tmp_path, offsets)
+
+            meta = _write_meta(self.tmp_path, self.rows, self.categories, dict(extra_meta or {}, rollups=rollups))
+        except Exception:
+            self.abort()
+            raise
+
+        _publish(self.tmp_path, self.path)
+        return meta
+
+    def abort(self):
+        """Discard a partially written store"""
+        for days_file, amounts_file in self.spills.values():
+            days_file.close()
+            amounts_file.close()
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+
+class BufferedStoreWriter:
+    """Writes a store with many categories, sorting its rows once in close()
+
+    TrainingStoreWriter keeps two spill files per category, which doesn't scale to the
+    thousands of (user, category) keys in a shard. This writer spills all rows to a
+    single set of raw files instead and partitions them when the store is finalized,
+    so peak memory is bounded by the size of this one store.
+    
+    With publish=False the store is just renamed to path on close(), for stores built
+    inside a directory that is itself published later (the shards of a shard set).
+    """
+
+    def __init__(self, path, publish=True):
+        self.path = path
+        self.publish = publish
+        self.tmp_path = f"{path}.tmp"
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+        os.makedirs(self.tmp_path)
+
+        self.categories = []
+        self.category_index = {}
+        self.rows = 0
+        self.spill_files = [
+            open(os.path.join(self.tmp_path, f"spill.{name}"), 'wb')
+            for name in ('codes', 'days', 'amounts')
+        ]
+
+    def _code(self, category):
+        code = self.category_index.get(category)
+        if code is None:
+            code = self.category_index[category] = len(self.categories)
+            self.categories.append(category)
+        return code
+
+    def append(self, categories, days, amounts):
+        """Append a chunk of rows given as per-row category names, day ordinals and amounts"""
+        if len(categories) == 0:
+            return
+        chunk_categories, chunk_codes = np.unique(np.asarray(categories, dtype=object), return_inverse=True)
+        self.append_encoded(list(chunk_categories), chunk_codes, days, amounts)
+
+    def append_encoded(self, categories, codes, days, amounts):
+        """Append a chunk of dictionary-encoded rows (codes index into categories)"""
+        mapping = np.array([self._code(category) for category in categories], dtype=np.int32)
+        codes = mapping[np.asarray(codes).reshape(-1)]
+        codes_file, days_file, amounts_file = self.spill_files
+        codes.tofile(codes_file)
+        np.asarray(days, dtype=np.int32).tofile(days_file)
+        np.asarray(amounts, dtype=np.float64).tofile(amounts_file)
+        self.rows += len(codes)
+
+    def close(self, extra_meta=None):
+        """Partition the buffered rows, swap the store into place and return its metadata"""
+        for spill_file in self.spill_files:
+            spill_file.close()
+        try:
+            codes, days, amounts, offsets = partition_columns(
+                self.categories,
+                np.fromfile(os.path.join(self.tmp_path, 'spill.codes'), dtype=np.int32),
+                np.fromfile(os.path.join(self.tmp_path, 'spill.days'), dtype=np.int32),
+                np.fromfile(os.path.join(self.tmp_path, 'spill.amounts'), dtype=np.float64)
+            )
+            np.save(os.path.join(self.tmp_path, CODES_FILE), codes)
+            np.save(os.path.join(self.tmp_path, DAYS_FILE), days)
+            np.save(os.path.join(self.tmp_path, AMOUNTS_FILE), amounts)
+            np.save(os.path.join(self.tmp_path, OFFSETS_FILE), offsets)
+            for name in ('codes', 'days', 'amounts'):
+                os.remove(os.path.join(self.tmp_path, f"spill.{name}"))
+            del codes, days, amounts
+            rollups = write_rollups(self.tmp_path, offsets)
+            sketches = write_sketches(self.tmp_path, offsets)
+            meta = _write_meta(self.tmp_path, self.rows, self.categories,
+                               dict(extra_meta or {}, rollups=rollups, sketches=sketches))
+        except Exception:
+            self.abort()
+            raise
+
+        if self.publish:
+            _publish(self.tmp_path, self.path)
+        else:
+            os.rename(self.tmp_path, self.path)
+        return meta
+
+    def abort(self):
+        """Discard a partially written store"""
+        for spill_file in self.spill_files:
+            spill_file.close()
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+
+def shard_for_user(user_id, shard_count):
+    """Name of the shard holding a user's history (stable across processes and runs)"""
+    return f"shard_{zlib.crc32(str(user_id).encode('utf-8')) % shard_count:03d}"
+
+def user_category_key(user_id, category):
+    """Category dictionary entry for one user's category inside a shard"""
+    return f"{user_id}/{category}"
+
+class ShardedStoreWriter:
+    """Routes rows into per-user shards and writes the shard manifest
+
+    Users are hashed into shard_count shards. Each shard is a regular store whose
+    category dictionary holds "<user_id>/<category>" keys, so one user's history in
+    one category is still a single contiguous, day-sorted slice.
+    """
+
+    def __init__(self, path=TRAINING_SHARDS_DIR, shard_count=SHARD_COUNT):
+        self.path = path
+        self.tmp_path = f"{path}.tmp"
+        self.shard_count = shard_count
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+        os.makedirs(self.tmp_path)
+        self.writers = {}
+        self.user_shards = {}
+
+    def _shard(self, user_id):
+        shard = self.user_shards.get(user_id)
+        if shard is None:
+            shard = self.user_shards[user_id] = shard_for_user(user_id, self.shard_count)
+        return shard
+
+    def _writer(self, shard):
+        writer = self.writers.get(shard)
+        if writer is None:
+            writer = self.writers[shard] = BufferedStoreWriter(os.path.join(self.tmp_path, shard), publish=False)
+        return writer
+
+    def append(self, categories, days, amounts, user_ids):
+        """Append a chunk of rows, routing each to its user's shard"""
+        if len(categories) == 0:
+            return
+        keys = np.array([user_category_key(user_id, category) for user_id, category in zip(user_ids, categories)], dtype=object)
+        shards = np.array([self._shard(user_id) for user_id in user_ids], dtype=object)
+        days = np.asarray(days, dtype=np.int32)
+        amounts = np.asarray(amounts, dtype=np.float64)
+        for shard in np.unique(shards):
+            mask = shards == shard
+            self._writer(shard).append(keys[mask], days[mask], amounts[mask])
+
+    def append_shards(self, shards, since_day=None, block_rows=100000):
+        """Copy the rows of existing shards (optionally only rows from since_day on)"""
+        copied = 0
+        for shard in shards.shard_names():
+            columns = shards.open_shard(shard)
+            writer = self._writer(shard)
+            for key in columns.categories:
+                start, end = columns.category_range(key, since_day=since_day)
+                for block_start in range(start, end, block_rows):
+                    block_end = min(block_start + block_rows, end)
+                    writer.append_encoded(
+                        [key],
+                        np.zeros(block_end - block_start, dtype=np.int32),
+                        columns.days[block_start:block_end],
+                        columns.amounts[block_start:block_end]
+                    )
+                    copied += block_end - block_start
+        return copied
+
+    def close(self, extra_meta=None):
+        """Finalize every shard, write the manifest and swap the shard set into place"""
+        try:
+            shard_stats = {}
+            all_users = set()
+            population = {}
+            for shard in sorted(self.writers):
+                meta = self.writers[shard].close()
+                users = {key.split('/', 1)[0] for key in meta['categories']}
+                all_users.update(users)
+                shard_stats[shard] = {'rows': meta['rows'], 'users': len(users)}
+                # Fold every user's sketch into its category's population sketch (O(k) per category)
+                table = load_sketch_table(os.path.join(self.tmp_path, shard))
+                for index, key in enumerate(meta['categories']):
+                    category = key.split('/', 1)[1]
+                    user_sketch = table_sketch(table, index, meta['sketches']['k'])
+                    population[category] = merge_spending([population.get(category), user_sketch], meta['sketches']['k'])
+            categories = sorted(population)
+            population_meta = write_sketch_table(
+                self.tmp_path, [population[category] for category in categories], 'population_sketch'
+            )
+
+            manifest = {
+                'format': STORE_FORMAT_VERSION,
+                'shard_count': self.shard_count,
+                'users': len(all_users),
+                'rows': sum(stats['rows'] for stats in shard_stats.values()),
+                'shards': shard_stats,
+                'population_sketches': dict(population_meta, categories=categories),
+                'generated_at': datetime.now().isoformat(),
+            }
+            if extra_meta:
+                manifest.update(extra_meta)
+            with open(os.path.join(self.tmp_path, SHARDS_MANIFEST_FILE), 'w') as f:
+                json.dump(manifest, f, indent=2)
+        except Exception:
+            self.abort()
+            raise
+
+        _publish(self.tmp_path, self.path)
+        return manifest
+
+    def abort(self):
+        """Discard partially written shards"""
+        for writer in self.writers.values():
+            writer.abort()
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+
+class JsonExportWriter:
+    """Incrementally writes the legacy training_data.json layout (an indented array of dicts)"""
+
+    def __init__(self, output_file):
+        self.output_file = output_file
+        self.tmp_file = f"{output_file}.tmp"
+        self.file = open(self.tmp_file, 'w')
+        self.rows = 0
+
+    def append(self, categories, days, amounts):
+        """Append a chunk of rows given as per-row category names, day ordinals and amounts"""
+        for category, day, amount in zip(categories, days, amounts):
+            record = {
+                'date': date.fromordinal(int(day)).isoformat(),
+                'category': category,
+                'amount': float(amount)
+            }
+            self.file.write(',\n  ' if self.rows else '[\n  ')
+            self.file.write(json.dumps(record, indent=2).replace('\n', '\n  '))
+            self.rows += 1
+
+    def close(self):
+        self.file.write('\n]' if self.rows else '[]')
+        self.file.close()
+        os.replace(self.tmp_file, self.output_file)
+        return self.rows
+
+    def abort(self):
+        """Discard a partially written export"""
+        self.file.close()
+        if os.path.exists(self.tmp_file):
+            os.remove(self.tmp_file)
+
+def write_training_store(path, categories, codes, days, amounts, extra_meta=None):
+    """Write in-memory columns to a store directory, replacing any existing store atomically"""
+    writer = TrainingStoreWriter(path)
+    writer.append_encoded(categories, codes, days, amounts)
+    return writer.close(extra_meta)
+
+def export_json(columns, output_file):
+    """Export a store back to the legacy training_data.json array of dicts"""
+    writer = JsonExportWriter(output_file)
+    for code, category in enumerate(columns.categories):
+        start, end = int(columns.offsets[code]), int(columns.offsets[code + 1])
+        writer.append([category] * (end - start), columns.days[start:end], columns.amounts[start:end])
+    return writer.close()
+
+class TrainingColumns:
+    """Column-oriented training data, memory-mapped when loaded from a store"""
+
+    def __init__(self, categories, codes, days, amounts, offsets=None, meta=None, path=None):
+        self.categories = list(categories)
+        self.category_index = {category: code for code, category in enumerate(self.categories)}
+        if offsets is None:
+            # Unpartitioned input (JSON records): build the index once at load time
+            codes, days, amounts, offsets = partition_columns(self.categories, codes, days, amounts)
+        self.codes = codes
+        self.days = days
+        self.amounts = amounts
+        self.offsets = offsets
+        self.meta = meta or {}
+        self.path = path
+        self.rollups = {}
+        self.sketches = None
+
+    @classmethod
+    def open(cls, path=TRAINING_STORE_DIR):
+        """Open a store directory with memory-mapped columns
+        
+        A published store's link is resolved once, so every file comes from the same version.
+        """
+        path = os.path.realpath(path)
+        with open(os.path.join(path, META_FILE), 'r') as f:
+            meta = json.load(f)
+        if meta.get('format') != STORE_FORMAT_VERSION:
+            raise ValueError(f"Unsupported training store format {meta.get('format')}")
+        return cls(
+            meta['categories'],
+            np.load(os.path.join(path, CODES_FILE), mmap_mode='r'),
+            np.load(os.path.join(path, DAYS_FILE), mmap_mode='r'),
+            np.load(os.path.join(path, AMOUNTS_FILE), mmap_mode='r'),
+            np.load(os.path.join(path, OFFSETS_FILE)),
+            meta,
+            path
+        )
+
+    @classmethod
+    def from_records(cls, records):
+        """Build columns from legacy JSON records"""
+        return cls(*columns_from_records(records))
+
+    @classmethod
+    def empty(cls):
+        return cls([], np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float64))
+
+    def __len__(self):
+        return len(self.amounts)
+
+    def category_range(self, category, since_day=None, until_day=None):
+        """Row range [start, end) of a category, optionally limited to since_day <= day <= until_day"""
+        code = self.category_index.get(category)
+        if code is None:
+            return 0, 0
+        start, end = int(self.offsets[code]), int(self.offsets[code + 1])
+        if since_day is not None or until_day is not None:
+            category_days = self.days[start:end]
+            if until_day is not None:
+                end = start + int(np.searchsorted(category_days, until_day, side='right'))
+            if since_day is not None:
+                start += int(np.searchsorted(category_days, since_day, side='left'))
+        return start, max(start, end)
+
+    def history(self, category, since_day=None, until_day=None):
+        """Days and amounts of one category's records, sorted by day"""
+        start, end = self.category_range(category, since_day, until_day)
+        return History(self.days[start:end], self.amounts[start:end])
+
+    def daily_totals(self, category, since_day=None, until_day=None):
+        """Per-day spending totals of one category, one entry per day with spending"""
+        return self.daily_history(category, since_day, until_day)
+
+    def rollup(self, period):
+        """A rollup's ROLLUP_FIELDS arrays and offsets: memory-mapped from the store when it
+        has them, otherwise (JSON input, older stores) computed from the rows on first use"""
+        rollup = self.rollups.get(period)
+        if rollup is None:
+            if self.path is not None and 'rollups' in self.meta:
+                rollup = {
+                    field: np.load(os.path.join(self.path, f"rollup_{period}_{field}.npy"), mmap_mode='r')
+                    for field in ROLLUP_FIELDS
+                }
+                rollup['offsets'] = np.load(os.path.join(self.path, f"rollup_{period}_offsets.npy"))
+            else:
+                rollup = rollup_columns(self.codes, self.days, self.amounts, self.offsets, period)
+            self.rollups[period] = rollup
+        return rollup
+
+    def rollup_range(self, category, period, since_day=None, until_day=None):
+        """Rollup row range [start, end) of a category, limited to since_day <= period key <= until_day"""
+        code = self.category_index.get(category)
+        if code is None:
+            return 0, 0
+        rollup = self.rollup(period)
+        start, end = int(rollup['offsets'][code]), int(rollup['offsets'][code + 1])
+        if since_day is not None or until_day is not None:
+            periods = rollup['periods'][start:end]
+            if until_day is not None:
+                end = start + int(np.searchsorted(periods, until_day, side='right'))
+            if since_day is not None:
+                start += int(np.searchsorted(periods, since_day, side='left'))
+        return start, max(start, end)
+
+    def daily_history(self, category, since_day=None, until_day=None):
+        """One category's per-day totals from the daily rollup, with each day's transaction count"""
+        start, end = self.rollup_range(category, 'daily', since_day, until_day)
+        rollup = self.rollup('daily')
+        return History(rollup['periods'][start:end], rollup['sums'][start:end], rollup['counts'][start:end])
+
+    def monthly(self, category, since_day=None, until_day=None):
+        """One category's monthly rollup (periods are the first day of each month) as ROLLUP_FIELDS arrays"""
+        start, end = self.rollup_range(category, 'monthly', since_day, until_day)
+        rollup = self.rollup('monthly')
+        return {field: rollup[field][start:end] for field in ROLLUP_FIELDS}
+
+    def sketch(self, category):
+        """SpendingSketch of one category's daily totals, or None when the store has no sketches"""
+        code = self.category_index.get(category)
+        if code is None or self.path is None or 'sketches' not in self.meta:
+            return None
+        if self.sketches is None:
+            self.sketches = load_sketch_table(self.path)
+        return table_sketch(self.sketches, code, self.meta['sketches'].get('k', SKETCH_K))
+
+class UserHistoryView:
+    """One user's histories inside a shard, with the same history() interface as TrainingColumns"""
+
+    def __init__(self, columns, user_id):
+        self.columns = columns
+        self.user_id = user_id
+
+    def history(self, category, since_day=None, until_day=None):
+        if self.columns is None:
+            return empty_history()
+        return self.columns.history(user_category_key(self.user_id, category), since_day, until_day)
+
+    def daily_history(self, category, since_day=None, until_day=None):
+        if self.columns is None:
+            return empty_history()._replace(counts=np.empty(0, dtype=np.int64))
+        return self.columns.daily_history(user_category_key(self.user_id, category), since_day, until_day)
+
+    def monthly(self, category, since_day=None, until_day=None):
+        if self.columns is None:
+            return rollup_rows([], [], [])[1]
+        return self.columns.monthly(user_category_key(self.user_id, category), since_day, until_day)
+
+    def sketch(self, category):
+        if self.columns is None:
+            return None
+        return self.columns.sketch(user_category_key(self.user_id, category))
+
+class TrainingShards:
+    """Per-user shards, opened lazily one shard at a time"""
+
+    def __init__(self, path, manifest):
+        self.path = path
+        self.manifest = manifest
+        self.users = manifest.get('users', 0)
+        self.opened = {}
+        self.population_sketches = None
+
+    @classmethod
+    def open(cls, path=TRAINING_SHARDS_DIR):
+        """Read the shard manifest; shards themselves are only opened when a user needs them
+        
+        The link is resolved once, so shards opened later come from the manifest's version.
+        """
+        path = os.path.realpath(path)
+        with open(os.path.join(path, SHARDS_MANIFEST_FILE), 'r') as f:
+            manifest = json.load(f)
+        if manifest.get('format') != STORE_FORMAT_VERSION:
+            raise ValueError(f"Unsupported training shard format {manifest.get('format')}")
+        return cls(path, manifest)
+
+    def shard_names(self):
+        return sorted(self.manifest.get('shards', {}))
+
+    def open_shard(self, shard):
+        columns = self.opened.get(shard)
+        if columns is None:
+            columns = self.opened[shard] = TrainingColumns.open(os.path.join(self.path, shard))
+        return columns
+
+    def population_sketch(self, category):
+        """SpendingSketch of one user's daily totals in a category across all users, or None"""
+        population = self.manifest.get('population_sketches')
+        if not population or category not in population['categories']:
+            return None
+        if self.population_sketches is None:
+            self.population_sketches = load_sketch_table(self.path, 'population_sketch')
+        return table_sketch(self.population_sketches, population['categories'].index(category), population.get('k'))
+
+    def series_keys(self):
+        """Every "<user_id>/<category>" key in the shards, read from their meta.json files"""
+        keys = set()
+        for shard in self.shard_names():
+            with open(os.path.join(self.path, shard, META_FILE), 'r') as f:
+                keys.update(json.load(f)['categories'])
+        return keys
+
+    def for_user(self, user_id):
+        """History view of one user; empty if the user has no exported history"""
+        shard = shard_for_user(user_id, self.manifest['shard_count'])
+        if shard not in self.manifest.get('shards', {}):
+            return UserHistoryView(None, user_id)
+        return UserHistoryView(self.open_shard(shard), user_id)
+
+def main():
+    """Convert between training_data.json and the columnar store"""
+    import argparse
+    parser = argparse.ArgumentParser(description='CloudExpense columnar training store tools')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    import_parser = subparsers.add_parser('import', help='Build the columnar store from a JSON export')
+    import_parser.add_argument('json_file', nargs='?', default='training_data.json')
+    export_parser = subparsers.add_parser('export', help='Export the columnar store as JSON')
+    export_parser.add_argument('json_file', nargs='?', default='training_data.json')
+    parser.add_argument('--store', default=TRAINING_STORE_DIR, help='Store directory')
+    args = parser.parse_args()
+
+    if args.command == 'import':
+        with open(args.json_file, 'r') as f:
+            records = json.load(f)
+        meta = write_training_store(args.store, *columns_from_records(records))
+        print(f"Wrote {meta['rows']} records to {args.store}/")
+    else:
+        columns = TrainingColumns.open(args.store)
+        export_json(columns, args.json_file)
+        print(f"Exported {len(columns)} records to {args.json_file}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""
+Binary wire protocol for cloud_predictor.py
+===========================================
+
+JSON stays the default. With `--wire msgpack` the predictor reads and writes
+length-prefixed MessagePack frames instead: a 4-byte big-endian body length followed by
+one MessagePack map. The same framing is used for a one-shot request on stdin and for
+every request and response of `--serve` (stdio or Unix socket).
+
+A request map has the keys of a JSON request (user_id, meta, profile, deadline_ms), but
+its expenses come as typed columns rather than one dict per record:
+
+  columns: {
+    categories  array of category names (the dictionary)
+    codes       bin, little-endian int32 index into categories, one per expense
+    days        bin, little-endian int32 days since 1970-01-01, one per expense
+    amounts     bin, little-endian float64, one per expense
+  }
+
+The bin columns are wrapped with np.frombuffer and handed to the predictor as
+TrainingColumns, so no per-record objects are built and no date strings are parsed.
+A `records` array of {date, category, amount} maps is accepted too.
+
+The response map is what the JSON output would hold ({category: total}, or
+{predictions, meta} with meta), with totals as binary doubles.
+
+msgpack is only imported when the binary protocol is used.
+"""
+
+import struct
+
+import numpy as np
+
+from training_store import EPOCH_ORDINAL, TrainingColumns
+
+WIRE_FORMATS = ('json', 'msgpack')
+
+# Frame header: body length as an unsigned 32-bit big-endian integer
+FRAME_HEADER = struct.Struct('>I')
+
+# Frames larger than this are refused rather than allocated
+MAX_FRAME_BYTES = 1 << 30
+
+def _msgpack():
+    try:
+        import msgpack
+    except ImportError:
+        raise RuntimeError("The msgpack wire protocol needs the msgpack package (pip install msgpack)")
+    return msgpack
+
+def _read_exactly(stream, size):
+    """size bytes from a binary stream, or fewer only at end of stream"""
+    body = bytearray(size)
+    view = memoryview(body)
+    received = 0
+    while received < size:
+        count = stream.readinto(view[received:])
+        if not count:
+            break
+        received += count
+    return body if received == size else body[:received]
+
+def read_frame(stream):
+    """Body of the next frame on a binary stream, or None at a clean end of stream"""
+    header = _read_exactly(stream, FRAME_HEADER.size)
+    if not header:
+        return None
+    if len(header) < FRAME_HEADER.size:
+        raise ValueError("Truncated frame header")
+    (size,) = FRAME_HEADER.unpack(header)
+    if size > MAX_FRAME_BYTES:
+        raise ValueError(f"Frame of {size} bytes exceeds the {MAX_FRAME_BYTES} byte limit")
+    body = _read_exactly(stream, size)
+    if len(body) < size:
+        raise ValueError(f"Truncated frame: expected {size} bytes, got {len(body)}")
+    return body
+
+def write_frame(stream, body):
+    """Write one length-prefixed frame to a binary stream"""
+    stream.write(FRAME_HEADER.pack(len(body)))
+    stream.write(body)
+    stream.flush()
+
+def columns_from_wire(columns):
+    """TrainingColumns over the bin columns of a request, without copying them per record"""
+    categories = [str(category) for category in columns.get('categories', [])]
+    codes = np.frombuffer(columns.get('codes', b''), dtype='<i4')
+    days = np.frombuffer(columns.get('days', b''), dtype='<i4')
+    amounts = np.frombuffer(columns.get('amounts', b''), dtype='<f8')
+    if not len(codes) == len(days) == len(amounts):
+        raise ValueError(f"Column lengths differ: {len(codes)} codes, {len(days)} days, {len(amounts)} amounts")
+    if len(codes) and (codes.min() < 0 or codes.max() >= len(categories)):
+        raise ValueError("Category code outside the categories array")
+    return TrainingColumns(categories, codes, (days + EPOCH_ORDINAL).astype(np.int32), amounts.astype(np.float64))
+
+def decode_request(body):
+    """A msgpack request frame as a request payload, with typed columns in place of records"""
+    payload = _msgpack().unpackb(body, raw=False)
+    if isinstance(payload, dict) and 'columns' in payload:
+        payload = dict(payload)
+        payload['records'] = columns_from_wire(payload.pop('columns'))
+    return payload
+
+def encode_response(payload):
+    """A response payload (predictions, or predictions with meta) as a msgpack frame body"""
+    return _msgpack().packb(payload, use_bin_type=True)
+
+def encode_request(records, **fields):
+    """A msgpack request frame body for {date, category, amount} records (for clients and benchmarks)"""
+    columns = TrainingColumns.from_records(records)
+    wire_columns = {
+        'categories': columns.categories,
+        'codes': np.asarray(columns.codes, dtype='<i4').tobytes(),
+        'days': (np.asarray(columns.days, dtype=np.int64) - EPOCH_ORDINAL).astype('<i4').tobytes(),
+        'amounts': np.asarray(columns.amounts, dtype='<f8').tobytes(),
+    }
+    return _msgpack().packb(dict(fields, columns=wire_columns), use_bin_type=True)
+
+def decode_response(body):
+    """A msgpack response frame body as a dict (for clients and benchmarks)"""
+    return _msgpack().unpackb(body, raw=False)